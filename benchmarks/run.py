@@ -0,0 +1,186 @@
+"""
+Offline microbenchmarks of the exporter pipeline.
+
+Runs every stage against synthetic stats and an in-memory CloudWatch client, so
+that neither a qdbd nor AWS credentials are needed:
+
+    $ python -m benchmarks --nodes 1 --uids 1000 --metrics 200
+"""
+
+import argparse
+import gc
+import logging
+import sys
+import time
+import tracemalloc
+
+from qdb_cloudwatch import columnar
+from qdb_cloudwatch.check import Filter, filter_stats
+from qdb_cloudwatch.cloudwatch import MetricConverter, _qdb_to_cloudwatch, push_metrics
+from qdb_cloudwatch.driver import _parse_list
+
+from .synthetic import cluster_stats
+
+
+class NoopClient:
+    """
+    CloudWatch client that accepts and counts every request without sending it.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.metrics = 0
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.requests += 1
+        self.metrics += len(MetricData)
+
+
+def _count(stats):
+    return sum(
+        len(xs["cumulative"]) + sum(len(xs_) for xs_ in xs["by_uid"].values())
+        for xs in stats.values()
+    )
+
+
+def _stages(stats, include, exclude):
+    """
+    Returns a list of `(name, fn, n)`: calling `fn()` runs the stage once over `n`
+    input datapoints.
+    """
+    metric_filter = Filter(include=include, exclude=exclude)
+    filtered = metric_filter(stats)
+    metrics = _qdb_to_cloudwatch(filtered)
+
+    n_stats = _count(stats)
+    n_filtered = _count(filtered)
+
+    # Warmed up by a first cycle, like in a long-running exporter.
+    converter = MetricConverter()
+    converter(filtered)
+
+    return [
+        ("filter_stats", lambda: filter_stats(stats, include, exclude), n_stats),
+        ("Filter (reused)", lambda: metric_filter(stats), n_stats),
+        ("_qdb_to_cloudwatch", lambda: _qdb_to_cloudwatch(filtered), n_filtered),
+        ("MetricConverter (steady state)", lambda: converter(filtered), n_filtered),
+        (
+            "columnar.to_cloudwatch",
+            lambda: columnar.to_cloudwatch(stats, metric_filter),
+            n_stats,
+        ),
+        (
+            "push_metrics (no-op client)",
+            lambda: push_metrics(metrics, "benchmark", client=NoopClient()),
+            len(metrics),
+        ),
+    ]
+
+
+def _time(fn, repeat):
+    """
+    Returns the best wall time of `repeat` runs of `fn`, in seconds.
+    """
+    best = float("inf")
+
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def _memory(fn):
+    """
+    Returns the peak number of bytes allocated while running `fn` once, and the
+    number of memory blocks allocated for its result.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        ret = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    del ret
+    return peak, sum(x.count for x in snapshot.statistics("filename"))
+
+
+def run(n_nodes=1, n_uids=100, n_metrics=200, include=None, exclude=None, repeat=5):
+    """
+    Runs all stages and returns a list of dicts, one per stage.
+    """
+    stats = cluster_stats(n_nodes, n_uids, n_metrics)
+    ret = []
+
+    for name, fn, n in _stages(stats, include, exclude):
+        seconds = _time(fn, repeat)
+        peak, blocks = _memory(fn)
+        ret.append(
+            {
+                "stage": name,
+                "datapoints": n,
+                "seconds": seconds,
+                "datapoints_per_second": n / seconds if seconds > 0 else float("inf"),
+                "peak_bytes": peak,
+                "allocated_blocks": blocks,
+            }
+        )
+
+    return ret
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the exporter pipeline against synthetic stats."
+    )
+    parser.add_argument("--nodes", type=int, default=1, help="Number of nodes.")
+    parser.add_argument(
+        "--uids", type=int, default=100, help="Number of users per node."
+    )
+    parser.add_argument(
+        "--metrics", type=int, default=200, help="Number of metrics per user."
+    )
+    parser.add_argument(
+        "--filter-include",
+        default=r"requests\.,network\.,memory\.",
+        help="Comma-separated include patterns.",
+    )
+    parser.add_argument(
+        "--filter-exclude", default=r"_1$", help="Comma-separated exclude patterns."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Number of timed runs per stage."
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    # The pipeline logs every step at INFO, which would dominate the timings.
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    args = get_args()
+    results = run(
+        args.nodes,
+        args.uids,
+        args.metrics,
+        _parse_list(args.filter_include),
+        _parse_list(args.filter_exclude),
+        args.repeat,
+    )
+
+    print(
+        f"{'stage':<30} {'datapoints':>10} {'ms':>10} {'datapoints/s':>14} {'peak KiB':>10} "
+        f"{'blocks':>10}"
+    )
+    for x in results:
+        print(
+            f"{x['stage']:<30} {x['datapoints']:>10} {x['seconds'] * 1000:>10.2f} "
+            f"{x['datapoints_per_second']:>14.0f} {x['peak_bytes'] / 1024:>10.0f} "
+            f"{x['allocated_blocks']:>10}"
+        )
@@ -0,0 +1,69 @@
+"""
+Synthetic statistics, shaped like the output of `quasardb.stats.of_node`.
+"""
+
+import random
+
+import quasardb.stats as qdbst
+
+# (prefix, type, unit) of the metric families found on a typical node.
+_families = [
+    ("requests.", qdbst.Type.ACCUMULATOR, qdbst.Unit.COUNT),
+    ("network.", qdbst.Type.ACCUMULATOR, qdbst.Unit.BYTES),
+    ("memory.", qdbst.Type.GAUGE, qdbst.Unit.BYTES),
+    ("persistence.", qdbst.Type.GAUGE, qdbst.Unit.BYTES),
+    ("engine.", qdbst.Type.ACCUMULATOR, qdbst.Unit.NANOSECONDS),
+    ("async_pipelines.", qdbst.Type.GAUGE, qdbst.Unit.COUNT),
+    ("cpu.", qdbst.Type.GAUGE, qdbst.Unit.NONE),
+]
+
+
+def metric_names(n_metrics):
+    """
+    Returns `n_metrics` distinct metric names, spread over all families.
+    """
+    return [f"{_families[i % len(_families)][0]}metric_{i}" for i in range(n_metrics)]
+
+
+def _metric(i, rng):
+    _, type_, unit = _families[i % len(_families)]
+    return {"value": rng.randint(0, 1 << 40), "type": type_, "unit": unit}
+
+
+def node_stats(n_uids=100, n_metrics=200, seed=0):
+    """
+    Returns the stats of a single node, as `of_node` would.
+    """
+    rng = random.Random(seed)
+    names = metric_names(n_metrics)
+
+    ret = {
+        "by_uid": {
+            uid: {k: _metric(i, rng) for i, k in enumerate(names)}
+            for uid in range(n_uids)
+        },
+        "cumulative": {k: _metric(i, rng) for i, k in enumerate(names)},
+    }
+
+    ret["cumulative"]["check.online"] = {
+        "value": 1,
+        "type": qdbst.Type.ACCUMULATOR,
+        "unit": qdbst.Unit.NONE,
+    }
+    ret["cumulative"]["check.duration_ms"] = {
+        "value": rng.randint(1, 1000),
+        "type": qdbst.Type.ACCUMULATOR,
+        "unit": qdbst.Unit.MILLISECONDS,
+    }
+
+    return ret
+
+
+def cluster_stats(n_nodes=1, n_uids=100, n_metrics=200, seed=0):
+    """
+    Returns stats shaped like the output of `get_all_stats`.
+    """
+    return {
+        f"10.0.0.{i + 1}:2836": node_stats(n_uids, n_metrics, seed + i)
+        for i in range(n_nodes)
+    }
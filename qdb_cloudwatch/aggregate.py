@@ -0,0 +1,103 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of series an Aggregator keeps track of by default.
+DEFAULT_MAX_SERIES = 100000
+
+
+class _Accumulator:
+    """
+    Running SampleCount/Sum/Min/Max of a single series.
+    """
+
+    __slots__ = ("name", "unit", "dims", "count", "sum", "min", "max")
+
+    def __init__(self, name, unit, dims, value):
+        self.name = name
+        self.unit = unit
+        self.dims = dims
+        self.count = 1
+        self.sum = value
+        self.min = value
+        self.max = value
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def to_metric(self):
+        return {
+            "MetricName": self.name,
+            "Unit": self.unit,
+            "Dimensions": self.dims,
+            "StatisticValues": {
+                "SampleCount": float(self.count),
+                "Sum": self.sum,
+                "Minimum": self.min,
+                "Maximum": self.max,
+            },
+        }
+
+
+def _series_key(m):
+    return (m["MetricName"], tuple(d["Value"] for d in m["Dimensions"]))
+
+
+class Aggregator:
+    """
+    Folds datapoints sampled at a high frequency into CloudWatch statistic sets.
+
+    Every call to `add()` folds one sample of each series into a constant-size
+    accumulator; `flush()` returns one `StatisticValues` datapoint per series and
+    starts a new window. This gives finer-grained min/max/average with the same
+    number of datapoints as a single sample per publish interval.
+
+    At most `max_series` series are tracked per window, further ones are dropped.
+    """
+
+    def __init__(self, max_series=DEFAULT_MAX_SERIES):
+        self.max_series = max_series
+        self._acc = {}
+        self._dropped = 0
+
+    def __len__(self):
+        return len(self._acc)
+
+    def add(self, metrics):
+        """
+        Folds CloudWatch datapoints, as returned by `_qdb_to_cloudwatch`, into the
+        current window.
+        """
+        for m in metrics:
+            key = _series_key(m)
+            acc = self._acc.get(key)
+
+            if acc is not None:
+                acc.add(m["Value"])
+            elif len(self._acc) < self.max_series:
+                self._acc[key] = _Accumulator(
+                    m["MetricName"], m["Unit"], m["Dimensions"], m["Value"]
+                )
+            else:
+                self._dropped += 1
+
+    def flush(self):
+        """
+        Returns the statistic sets of the current window and starts a new one.
+        """
+        if self._dropped:
+            logger.warning(
+                f"Dropped {self._dropped} samples, more than {self.max_series} series"
+            )
+
+        ret = [acc.to_metric() for acc in self._acc.values()]
+
+        self._acc = {}
+        self._dropped = 0
+
+        return ret
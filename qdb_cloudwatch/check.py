@@ -1,16 +1,35 @@
-import copy
+import itertools
 import json
 import logging
 import random
 import re
+import socket
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import timedelta
+from functools import partial
 
 import quasardb
 import quasardb.stats as qdbst
 
+from . import instrument
+
 logger = logging.getLogger(__name__)
 
+# Time given to every node to return its statistics.
+DEFAULT_NODE_TIMEOUT_SECONDS = 30
+
+# Time given to the initial connection to the cluster.
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 15
+
+# Number of keys a `WriteProbe` rotates through.
+DEFAULT_PROBE_KEYS = 8
+
+# Seconds after which a `StatsReader` lists the statistic keys of a node again.
+DEFAULT_KEY_REFRESH_SECONDS = 300
+
 
 def _slurp(x):
     with open(x, "r") as fp:
@@ -24,7 +43,10 @@ def _parse_user_security_file(x):
 
 
 def get_qdb_conn(
-    uri, cluster_public_key_file=None, user_security_file=None, timeout_seconds=15
+    uri,
+    cluster_public_key_file=None,
+    user_security_file=None,
+    timeout_seconds=DEFAULT_CONNECT_TIMEOUT_SECONDS,
 ):
     logger.info("Getting qdb connection")
     if cluster_public_key_file and user_security_file:
@@ -38,57 +60,293 @@ def get_qdb_conn(
             timeout=timedelta(seconds=timeout_seconds),
         )
     else:
-        return quasardb.Cluster(uri)
+        return quasardb.Cluster(uri, timeout=timedelta(seconds=timeout_seconds))
+
+
+class Connection:
+    """
+    Long-lived qdb connection, shared across collection cycles.
+
+    The `quasardb.Cluster` and the node handles are opened lazily and cached, so
+    that a daemon does not pay for a new connection on every cycle. Whenever a
+    qdb call fails, `reset()` drops them and the next use reconnects.
+    """
+
+    def __init__(
+        self,
+        uri,
+        cluster_public_key_file=None,
+        user_security_file=None,
+        timeout_seconds=DEFAULT_CONNECT_TIMEOUT_SECONDS,
+    ):
+        self.uri = uri
+        self._cluster_public_key_file = cluster_public_key_file
+        self._user_security_file = user_security_file
+        self._timeout_seconds = timeout_seconds
+        self._cluster = None
+        self._nodes = {}
+        # Nodes may be collected from concurrently, see `_collect_from_nodes`.
+        self._lock = threading.Lock()
+
+    def cluster(self):
+        with self._lock:
+            if self._cluster is None:
+                with instrument.timed("qdb.connect"):
+                    self._cluster = get_qdb_conn(
+                        self.uri,
+                        self._cluster_public_key_file,
+                        self._user_security_file,
+                        self._timeout_seconds,
+                    )
+
+            return self._cluster
+
+    def endpoints(self):
+        """
+        Returns the endpoints of all nodes in the cluster.
+        """
+        return self.cluster().endpoints()
+
+    def node(self, endpoint):
+        if endpoint not in self._nodes:
+            self._nodes[endpoint] = self.cluster().node(endpoint)
+
+        return self._nodes[endpoint]
+
+    def forget_node(self, endpoint):
+        """
+        Drops the cached handle of a single node, it is reopened on next use.
+        """
+        self._nodes.pop(endpoint, None)
+
+    def reset(self):
+        logger.info("Resetting qdb connection")
+        self.close()
+
+    def close(self):
+        self._nodes = {}
+
+        with self._lock:
+            if self._cluster is not None:
+                try:
+                    self._cluster.close()
+                except quasardb.Error as e:
+                    logger.warning(f"Failed to close qdb connection: {e}")
+                finally:
+                    self._cluster = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 def _get_endpoint_from_uri(cluster_uri):
     return cluster_uri[6:]  # remove the leading 'qdb://'
 
 
+def _with_connection(cluster_uri, cluster_public_key_file, user_security_file, conn):
+    """
+    Returns `(conn, owned)`: the connection to use, and whether the caller must close it.
+    """
+    if conn is not None:
+        return (conn, False)
+
+    return (Connection(cluster_uri, cluster_public_key_file, user_security_file), True)
+
+
+def _elapsed_us(start):
+    return (time.perf_counter_ns() - start) / 1000
+
+
 def _check_node_online(conn, endpoint):
+    """
+    Returns `(online, latencies)`, latencies being the time it took to read the
+    sample entry, in microseconds, when it succeeded.
+    """
     logger.info(f"Checking node online [{endpoint}]")
 
     node = conn.node(endpoint)
     entry = node.integer("$qdb.statistics.startup_epoch")  # entry always exists
     ret = 0  # pessimistic
+    latencies = {}
 
     try:
+        start = time.perf_counter_ns()
         entry.get()
+        latencies["check.online.read_latency"] = _elapsed_us(start)
         ret = 1
     except quasardb.Error as e:
         logger.error(f"Failed to read sample entry: {e} [{endpoint}]")
 
-    return ret
+    return ret, latencies
+
 
+def _check_node_writable(conn, endpoint, key=None):
+    """
+    Writes a random value and reads it back. Returns `(writable, latencies)`,
+    latencies being the time the write and the read took, in microseconds, when
+    they succeeded.
 
-def _check_node_writable(conn, endpoint):
+    Without a `key`, a new entry is created and removed afterwards. Otherwise
+    `key` is updated in place and kept, see `WriteProbe`.
+    """
     logger.info(f"Checking node writable [{endpoint}]")
 
-    key = f"_qdb_write_check_{uuid.uuid4().hex}"  # almost zero chance of collision
+    cleanup = key is None
+    if cleanup:
+        key = f"_qdb_write_check_{uuid.uuid4().hex}"  # almost zero chance of collision
+
     value = random.randint(-9223372036854775808, 9223372036854775807)
     node = conn.node(endpoint)
     entry = node.integer(key)
     ret = 0  # pessimistic
+    latencies = {}
 
     try:
-        entry.put(value)
+        start = time.perf_counter_ns()
+        if cleanup:
+            entry.put(value)
+        else:
+            entry.update(value)
+        latencies["node.writable.put_latency"] = _elapsed_us(start)
+
+        start = time.perf_counter_ns()
         if entry.get() == value:
+            latencies["node.writable.get_latency"] = _elapsed_us(start)
             ret = 1
     except quasardb.Error as e:
         logger.error(f"Failed to put/get test entry '{key}': {e} [{endpoint}]")
     finally:
+        if cleanup:
+            try:
+                entry.remove()
+            except quasardb.AliasNotFoundError:
+                pass
+            except quasardb.Error as e:
+                logger.error(f"Failed to clean up test entry '{key}': {e} [{endpoint}]")
+
+    return ret, latencies
+
+
+class WriteProbe:
+    """
+    Write check that rotates through a fixed set of `n_keys` keys, specific to this
+    exporter, and updates them in place.
+
+    The default check creates and removes a new entry on every run, which takes
+    three round trips and churns the cluster's entries. A probe takes two round
+    trips (update and get) and never leaves more than `n_keys` entries behind.
+    Rotating through several keys spreads the probes over several entries, and so
+    usually over several shards.
+
+    Keys are named after `exporter_id`, the hostname by default, so that exporters
+    on different hosts do not update the same entries.
+    """
+
+    def __init__(self, exporter_id=None, n_keys=DEFAULT_PROBE_KEYS):
+        exporter_id = exporter_id or socket.gethostname()
+        self.keys = [f"_qdb_write_check_{exporter_id}_{i}" for i in range(n_keys)]
+
+        # Start at a random key, so that one-shot runs rotate as well.
+        self._next = itertools.count(random.randrange(n_keys))
+
+    def __call__(self, conn, endpoint):
+        key = self.keys[next(self._next) % len(self.keys)]
+        return _check_node_writable(conn, endpoint, key)
+
+
+def _critical_metrics(online, writable, latencies=None):
+    ret = {
+        "check.online": {
+            "value": online,
+            "type": qdbst.Type.GAUGE,
+            "unit": qdbst.Unit.NONE,
+        },
+        "node.writable": {
+            "value": writable,
+            "type": qdbst.Type.GAUGE,
+            "unit": qdbst.Unit.NONE,
+        },
+    }
+
+    for k, v in (latencies or {}).items():
+        ret[k] = {"value": v, "type": qdbst.Type.GAUGE, "unit": qdbst.Unit.MICROSECONDS}
+
+    return ret
+
+
+def _node_critical_stats(conn, endpoint, write_probe=None):
+    write_probe = write_probe or _check_node_writable
+
+    with instrument.timed("qdb.critical_checks"):
+        online, latencies = _check_node_online(conn, endpoint)
+        writable, latencies_ = write_probe(conn, endpoint)
+
+    latencies.update(latencies_)
+    return {
+        "cumulative": _critical_metrics(online, writable, latencies),
+        "by_uid": {},
+    }
+
+
+def _collect_from_nodes(conn, endpoints, fn, timeout_seconds):
+    """
+    Invokes `fn(conn, endpoint)` for all endpoints in parallel, one thread per node.
+
+    Every node gets `timeout_seconds` to answer: nodes that fail or are still busy
+    when it expires are logged and left out of the result, without holding up the
+    others. Returns a dict of `{endpoint: fn(conn, endpoint)}`.
+
+    The handles of these nodes are reopened on next use. When a qdb call failed, or
+    no node answered at all, the whole connection is reset instead, as the cluster
+    handle itself may be broken.
+    """
+    if not endpoints:
+        return {}
+
+    pool = ThreadPoolExecutor(max_workers=len(endpoints))
+    fn = instrument.thread_profiled(fn)
+    futures = {pool.submit(fn, conn, endpoint): endpoint for endpoint in endpoints}
+    done, not_done = wait(futures, timeout=timeout_seconds)
+
+    # Do not wait for nodes that timed out, their threads finish in the background.
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    ret = {}
+    qdb_errors = 0
+    for future in done:
+        endpoint = futures[future]
         try:
-            entry.remove()
-        except quasardb.AliasNotFoundError:
-            pass
-        except quasardb.Error as e:
-            logger.error(f"Failed to clean up test entry '{key}': {e} [{endpoint}]")
+            ret[endpoint] = future.result()
+        except Exception as e:
+            logger.error(f"Failed to collect stats: {e} [{endpoint}]")
+            conn.forget_node(endpoint)
+            qdb_errors += isinstance(e, quasardb.Error)
+
+    for future in not_done:
+        endpoint = futures[future]
+        logger.error(
+            f"Timed out after {timeout_seconds}s collecting stats [{endpoint}]"
+        )
+        conn.forget_node(endpoint)
 
+    if qdb_errors or not ret:
+        conn.reset()
+
+    instrument.count("nodes_dropped", len(endpoints) - len(ret))
     return ret
 
 
 def get_critical_stats(
-    cluster_uri, cluster_public_key_file=None, user_security_file=None
+    cluster_uri,
+    cluster_public_key_file=None,
+    user_security_file=None,
+    conn=None,
+    all_nodes=False,
+    node_timeout_seconds=DEFAULT_NODE_TIMEOUT_SECONDS,
+    write_probe=None,
 ):
     """
     Return the minimal set of cluster health metrics required for alerting.
@@ -100,20 +358,36 @@ def get_critical_stats(
     alerting path.
 
     Future extensions may allow users to define their own critical metrics.
+
+    When `conn` (a `Connection`) is provided it is reused and left open, otherwise a
+    connection is opened for the duration of the call.
+
+    With `all_nodes`, every endpoint of the cluster is checked in parallel instead of
+    only the one from `cluster_uri`. A node that does not answer within
+    `node_timeout_seconds` is reported as offline.
+
+    `write_probe` replaces the default write check, e.g. with a `WriteProbe`. Both
+    report the latencies of the reads and writes they make, next to the checks.
     """
     logger.info("Getting critical stats")
 
     endpoint = _get_endpoint_from_uri(cluster_uri)
-    ret = {endpoint: {"cumulative": {}, "by_uid": {}}}
-    online = 0
-    writable = 0
+    ret = {endpoint: {"cumulative": _critical_metrics(0, 0), "by_uid": {}}}
+
+    conn, owned = _with_connection(
+        cluster_uri, cluster_public_key_file, user_security_file, conn
+    )
+
+    fn = partial(_node_critical_stats, write_probe=write_probe)
 
     try:
-        with get_qdb_conn(
-            cluster_uri, cluster_public_key_file, user_security_file
-        ) as conn:
-            online = _check_node_online(conn, endpoint)
-            writable = _check_node_writable(conn, endpoint)
+        # A single node goes through the same path, so that it gets the same timeout.
+        endpoints = conn.endpoints() if all_nodes else [endpoint]
+        results = _collect_from_nodes(conn, endpoints, fn, node_timeout_seconds)
+        ret = {
+            x: results.get(x, {"cumulative": _critical_metrics(0, 0), "by_uid": {}})
+            for x in endpoints
+        }
     except quasardb.Error as e:
         # _check_node_* helpers do not raise quasardb errors.
         # Any exception here means the qdb connection could not be established.
@@ -121,78 +395,310 @@ def get_critical_stats(
             f"Failed to establish qdb connection, reporting endpoint as offline: {e}"
         )
 
-    ret[endpoint]["cumulative"]["check.online"] = {
-        "value": online,
-        "type": qdbst.Type.GAUGE,
-        "unit": qdbst.Unit.NONE,
-    }
-    ret[endpoint]["cumulative"]["node.writable"] = {
-        "value": writable,
-        "type": qdbst.Type.GAUGE,
-        "unit": qdbst.Unit.NONE,
-    }
+    if owned:
+        conn.close()
+    elif not all(
+        x["cumulative"]["check.online"]["value"]
+        and x["cumulative"]["node.writable"]["value"]
+        for x in ret.values()
+    ):
+        # The cached handles may be stale, start from a fresh connection next time.
+        conn.reset()
 
     return ret
 
 
-def get_all_stats(cluster_uri, cluster_public_key_file=None, user_security_file=None):
-    logger.info("Getting all the stats")
+def _metric_id(k):
+    """
+    Returns `(metric, suffix)` of a statistic key, e.g. `("requests.out_bytes",
+    "unit")` for `$qdb.statistics.requests.out_bytes.uid_1.unit`. The suffix is
+    `None` for values.
+    """
+    metric = qdbst.user_clean_pattern.sub("", k)[len(qdbst.stats_prefix) :]
 
-    with get_qdb_conn(cluster_uri, cluster_public_key_file, user_security_file) as conn:
-        endpoint = _get_endpoint_from_uri(cluster_uri)
-        node = conn.node(endpoint)
-        stats = qdbst.of_node(node)
+    parts = metric.rsplit(".", 1)
+    if len(parts) > 1 and parts[1] in ("type", "unit"):
+        return parts[0], parts[1]
 
-        return {endpoint: stats}
+    return metric, None
 
 
-def _do_filter_metrics(metrics, fn):
-    return {key: metrics[key] for key in metrics if fn(key)}
+class StatsReader:
+    """
+    Equivalent of `qdbst.of_node` that only reads the statistics that pass a filter.
 
+    `of_node` lists all statistic keys of a node, reads the type and unit of every
+    metric, then every single value, even though most are filtered out afterwards.
+    Instead, the keys are listed once per node and matched against `metric_filter`
+    (a `Filter`). The matching value keys, and the types and units of the matching
+    metrics, are cached for `refresh_seconds`. Every call then only reads the
+    matching values, with the entry type (integer or blob) known in advance. Metrics
+    listed in `extra` are kept even if they do not pass the filter.
 
-def _do_filter(stats, fn):
+    The cache of a node is dropped early when one of its keys has disappeared.
     """
-    Performs actual filtering of stats, keeping only those where fn(name) equals True
+
+    def __init__(
+        self,
+        metric_filter,
+        refresh_seconds=DEFAULT_KEY_REFRESH_SECONDS,
+        extra=(),
+        clock=time.monotonic,
+    ):
+        self.metric_filter = metric_filter
+        self.refresh_seconds = refresh_seconds
+        self.extra = set(extra)
+        self._clock = clock
+
+        # endpoint -> (expiry, value keys, index of type and unit per metric)
+        self._keys = {}
+
+    def _keep(self, metric):
+        return metric in self.extra or self.metric_filter.keep(metric)
+
+    def _list_keys(self, node, endpoint):
+        with instrument.timed("qdb.list_keys"):
+            ks = qdbst._get_all_keys(node)
+
+        values = []
+        meta = {}
+
+        for k in ks:
+            metric, suffix = _metric_id(k)
+            if metric.startswith("serialized") or not self._keep(metric):
+                continue
+
+            if suffix is None:
+                values.append(k)
+            else:
+                # A single type and unit key per metric is enough to index it.
+                meta.setdefault((metric, suffix), k)
+
+        idx = qdbst._index_keys(node, list(meta.values()))
+
+        logger.info(
+            f"Reading {len(values)} out of {len(ks)} statistic keys [{endpoint}]"
+        )
+        return values, idx
+
+    def _get_value(self, node, k, x):
+        if x["type"] == qdbst.Type.LABEL:
+            return qdbst._clean_blob(node.blob(k).get())
+
+        try:
+            return node.integer(k).get()
+        except quasardb.IncompatibleTypeError:
+            return qdbst._get_stat_value(node, k)
+
+    def __call__(self, node, endpoint):
+        now = self._clock()
+        cached = self._keys.get(endpoint)
+
+        if cached is None or cached[0] <= now:
+            cached = (now + self.refresh_seconds, *self._list_keys(node, endpoint))
+            self._keys[endpoint] = cached
+
+        _, values, idx = cached
+        start = time.monotonic()
+        raw = {}
+
+        for k in values:
+            try:
+                raw[k] = self._get_value(node, k, idx[_metric_id(k)[0]])
+            except quasardb.AliasNotFoundError:
+                # The statistic is gone, e.g. a user was removed: list keys again
+                # on the next call.
+                self._keys.pop(endpoint, None)
+
+        ret = {
+            "by_uid": qdbst._by_uid(raw, idx),
+            "cumulative": qdbst._cumulative(raw, idx),
+        }
+
+        # Same as `of_node`.
+        ret["cumulative"]["check.online"] = {
+            "value": 1,
+            "type": qdbst.Type.ACCUMULATOR,
+            "unit": qdbst.Unit.NONE,
+        }
+        ret["cumulative"]["check.duration_ms"] = {
+            "value": int((time.monotonic() - start) * 1000),
+            "type": qdbst.Type.ACCUMULATOR,
+            "unit": qdbst.Unit.MILLISECONDS,
+        }
+
+        return ret
+
+
+def _node_all_stats(conn, endpoint, reader=None):
+    with instrument.timed("qdb.of_node"):
+        if reader is not None:
+            return reader(conn.node(endpoint), endpoint)
+
+        return qdbst.of_node(conn.node(endpoint))
+
+
+def get_all_stats(
+    cluster_uri,
+    cluster_public_key_file=None,
+    user_security_file=None,
+    conn=None,
+    all_nodes=False,
+    node_timeout_seconds=DEFAULT_NODE_TIMEOUT_SECONDS,
+    reader=None,
+):
     """
+    Returns the statistics of the node from `cluster_uri` as `{endpoint: stats}`.
+
+    With `all_nodes`, the statistics of every endpoint of the cluster are collected
+    in parallel and merged. Nodes that fail or do not answer within
+    `node_timeout_seconds` are left out, so that a busy node cannot hold up a whole
+    collection cycle.
 
-    for node_id in stats:
-        for group_id in stats[node_id]:
-            if group_id == "cumulative":
-                stats[node_id][group_id] = _do_filter_metrics(
-                    stats[node_id][group_id], fn
-                )
-            elif group_id == "by_uid":
-                for uid in stats[node_id][group_id]:
-                    stats[node_id][group_id][uid] = _do_filter_metrics(
-                        stats[node_id][group_id][uid], fn
+    With a `reader` (a `StatsReader`), only the statistics that pass its filter are
+    read from the nodes.
+    """
+    logger.info("Getting all the stats")
+
+    endpoint = _get_endpoint_from_uri(cluster_uri)
+    conn, owned = _with_connection(
+        cluster_uri, cluster_public_key_file, user_security_file, conn
+    )
+
+    try:
+        endpoints = conn.endpoints() if all_nodes else [endpoint]
+        return _collect_from_nodes(
+            conn,
+            endpoints,
+            partial(_node_all_stats, reader=reader),
+            node_timeout_seconds,
+        )
+    except quasardb.Error:
+        conn.reset()
+        raise
+    finally:
+        if owned:
+            conn.close()
+
+
+class Filter:
+    """
+    Compiled include/exclude metric filter.
+
+    The patterns are compiled once and the keep/drop decision is cached per metric
+    name: the same few hundred names repeat for every uid, so each one is matched
+    only once for the lifetime of the filter. A `Filter` can therefore be reused
+    across daemon cycles.
+
+    Semantics are those of `filter_stats`: a metric is kept when it matches at least
+    one of the `include` patterns (if any are given) and none of the `exclude` ones.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = include
+        self.exclude = exclude
+        self._include = _compile_patterns(include)
+        self._exclude = _compile_patterns(exclude)
+        self._decisions = {}
+
+    def _match(self, metric_name):
+        if self._include is not None and not any(
+            p.search(metric_name) for p in self._include
+        ):
+            return False
+
+        if self._exclude is not None and any(
+            p.search(metric_name) for p in self._exclude
+        ):
+            return False
+
+        return True
+
+    def keep(self, metric_name):
+        """
+        Returns `True` if `metric_name` passes the filter.
+        """
+        try:
+            return self._decisions[metric_name]
+        except KeyError:
+            ret = self._decisions[metric_name] = self._match(metric_name)
+            return ret
+
+    def _filter_metrics(self, metrics):
+        keep = self.keep
+        return {k: v for k, v in metrics.items() if keep(k)}
+
+    def __call__(self, stats):
+        """
+        Returns a filtered view of `stats`, built in a single pass.
+
+        The input is not modified: only the containers are new, the individual
+        metric dicts are shared with `stats`.
+        """
+        with instrument.timed("filter"):
+            return self._filter(stats)
+
+    def _filter(self, stats):
+        logger.info("Filtering stats based on include/exclude filters")
+        ret = {}
+
+        for node_id, groups in stats.items():
+            ret[node_id] = {}
+
+            for group_id, xs in groups.items():
+                if group_id == "cumulative":
+                    ret[node_id][group_id] = self._filter_metrics(xs)
+                elif group_id == "by_uid":
+                    ret[node_id][group_id] = {
+                        uid: self._filter_metrics(xs_) for uid, xs_ in xs.items()
+                    }
+                else:
+                    raise RuntimeError(
+                        "Internal error: unrecognized stats group id: {}".format(
+                            group_id
+                        )
                     )
-            else:
-                raise RuntimeError(
-                    "Internal error: unrecognized stats group id: {}".format(group_id)
-                )
-    return stats
 
+        return ret
 
-def filter_stats(stats, include=None, exclude=None):
-    logger.info("Filtering stats based on include/exclude filters")
-    stats_ = copy.deepcopy(stats)
 
-    if include is not None:
-        # Returns `true` if any of the `include` patterns is found in the metric name.
-        def _filter_include(metric_name):
-            return any(
-                pattern for pattern in include if re.search(pattern, metric_name)
-            )
+class TierFilter(Filter):
+    """
+    Filter of the metrics of a single collection tier.
+
+    Tiers are groups of metrics, each defined by a `Filter` of include patterns, that
+    are collected at different intervals. A metric belongs to the first of `tiers`
+    that matches it, or to the default tier (`index` None) if none does. A
+    `TierFilter` keeps the metrics that pass `base` and belong to tier `index`.
+    """
+
+    def __init__(self, base, tiers, index=None):
+        super().__init__()
+        self.base = base
+        self.tiers = tiers
+        self.index = index
 
-        stats_ = _do_filter(stats_, _filter_include)
+    def _tier(self, metric_name):
+        for i, x in enumerate(self.tiers):
+            if x.keep(metric_name):
+                return i
 
-    if exclude is not None:
-        # Returns `false` if any of the `exclude` patterns is found in the metric name.
-        def _filter_exclude(metric_name):
-            return not any(
-                pattern for pattern in exclude if re.search(pattern, metric_name)
-            )
+        return None
 
-        stats_ = _do_filter(stats_, _filter_exclude)
+    def _match(self, metric_name):
+        return self.base.keep(metric_name) and self._tier(metric_name) == self.index
 
-    return stats_
+
+def _compile_patterns(patterns):
+    if patterns is None:
+        return None
+
+    return [re.compile(pattern) for pattern in patterns]
+
+
+def filter_stats(stats, include=None, exclude=None):
+    """
+    Filters stats based on include/exclude patterns. To filter repeatedly with the
+    same patterns, build a `Filter` once and call it instead.
+    """
+    return Filter(include, exclude)(stats)
@@ -1,10 +1,36 @@
 import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-import boto3
 from quasardb.stats import Unit
 
+from . import instrument
+from .ratelimit import DEFAULT_MAX_ATTEMPTS, is_retryable, with_retries
+
 logger = logging.getLogger(__name__)
 
+# Number of PutMetricData requests that are in flight at the same time by default.
+DEFAULT_MAX_IN_FLIGHT = 8
+
+# Limits of a single PutMetricData request.
+MAX_METRICS_PER_REQUEST = 1000
+MAX_REQUEST_BYTES = 1000 * 1000
+
+# Request bodies larger than this are gzip-compressed by botocore.
+COMPRESSION_MIN_BYTES = 1024
+
+# Estimated number of bytes taken by a field name in a form-encoded request, e.g.
+# `&MetricData.member.1000.Dimensions.member.30.Value=`. This is the most verbose
+# of the protocols the API supports, so that the estimates are upper bounds.
+_FIELD_BYTES = 56
+
+# Estimated number of bytes of a serialized number or timestamp.
+_NUMBER_BYTES = 32
+
+# Outcome of a single PutMetricData request: `error` is None when it succeeded.
+BatchResult = namedtuple("BatchResult", ["index", "size", "error"])
+
 _stat_unit_to_cloudwatch_unit = {
     Unit.NONE: "None",
     Unit.COUNT: "Count",
@@ -16,10 +42,30 @@ _stat_unit_to_cloudwatch_unit = {
     Unit.SECONDS: "Seconds",
 }
 
+# Units of counters converted to per-second rates, see `rates.RateConverter`.
+_stat_unit_to_cloudwatch_rate_unit = {
+    Unit.COUNT: "Count/Second",
+    Unit.BYTES: "Bytes/Second",
+}
+
 
-def _get_client():
+def get_client():
     logger.info("Getting cloudwatch client")
-    return boto3.client("cloudwatch")
+
+    # boto3 takes a noticeable time to import, and is not needed at all with the EMF
+    # sink: it is only imported once a client is actually needed.
+    import boto3
+    from botocore.config import Config
+
+    # Retries are done by `ratelimit.with_retries`, which also adapts the request
+    # rate to throttling: botocore's own retries would multiply the attempts.
+    config = Config(
+        retries={"total_max_attempts": 1},
+        disable_request_compression=False,
+        request_min_compression_size_bytes=COMPRESSION_MIN_BYTES,
+    )
+    with instrument.timed("cloudwatch.connect"):
+        return boto3.client("cloudwatch", config=config)
 
 
 def _coerce_metric(k, v):
@@ -28,23 +74,32 @@ def _coerce_metric(k, v):
         # by the regular metrics.
         return None
 
-    if v["unit"] == Unit.NANOSECONDS:
-        v["unit"] = Unit.MICROSECONDS
-        v["value"] /= 1000
+    # Do not modify `v` in place: filtered stats share their metric dicts with the
+    # collected ones.
+    unit = v["unit"]
+    value = v["value"]
 
-    return (_stat_unit_to_cloudwatch_unit.get(v["unit"], "None"), float(v["value"]))
+    if unit == Unit.NANOSECONDS:
+        unit = Unit.MICROSECONDS
+        value /= 1000
+
+    if v.get("rate"):
+        return (_stat_unit_to_cloudwatch_rate_unit.get(unit, "None"), float(value))
+
+    return (_stat_unit_to_cloudwatch_unit.get(unit, "None"), float(value))
 
 
 def _to_metric(k, v):
-    try:
-        x = _coerce_metric(k, v)
-        if x:
-            (u, v_) = x
-            return {"MetricName": k, "Value": v_, "Unit": u}
-    except:
+    if not isinstance(v["value"], (int, float)):
+        # Labels cannot be sent.
         logger.debug(f"The key '{k}' cannot be sent")
         return None
 
+    x = _coerce_metric(k, v)
+    if x:
+        u, v_ = x
+        return {"MetricName": k, "Value": v_, "Unit": u}
+
 
 def _qdb_to_cloudwatch(stats):
     # We want to flatten all metrics into a tuple of 3 items:
@@ -76,17 +131,320 @@ def _qdb_to_cloudwatch(stats):
     return ret
 
 
-def push_stats(stats, namespace):
-    client = _get_client()
-    stats_ = _qdb_to_cloudwatch(stats)
+def _template(k, v, dims):
+    """
+    Returns `(divisor, template)` to convert the values of metric `k` like
+    `_coerce_metric`: datapoints are `{**template, "Value": value / divisor}`. The
+    template is `None` for metrics that are not sent.
+    """
+    if k.startswith("cpu."):
+        return (1, None)
+
+    unit = v["unit"]
+    divisor = 1
+
+    if unit == Unit.NANOSECONDS:
+        unit = Unit.MICROSECONDS
+        divisor = 1000
+
+    units = (
+        _stat_unit_to_cloudwatch_rate_unit
+        if v.get("rate")
+        else _stat_unit_to_cloudwatch_unit
+    )
+    return divisor, {
+        "MetricName": k,
+        "Unit": units.get(unit, "None"),
+        "Dimensions": dims,
+    }
+
+
+class MetricConverter:
+    """
+    Equivalent of `_qdb_to_cloudwatch` for repeated conversions of the same series.
+
+    Between two cycles only the values change. The name, unit, value divisor and
+    dimensions of every (node, uid, metric) are computed once and kept as a
+    template, with one `Dimensions` list shared by all metrics of a node or uid. A
+    steady-state cycle then only copies templates and fills in values. Templates of
+    series that were not converted in the last call are evicted.
+    """
+
+    def __init__(self):
+        # (node_id, uid, metric) -> [generation, unit, rate, divisor, template], the
+        # template is None for metrics that are not sent.
+        self._templates = {}
+
+        # (node_id, uid) -> Dimensions
+        self._dims = {}
+
+        self._generation = 0
+
+    def _get_dims(self, node_id, uid):
+        key = (node_id, uid)
+        ret = self._dims.get(key)
+
+        if ret is None:
+            ret = [{"Name": "NodeId", "Value": str(node_id)}]
+            if uid is not None:
+                ret.insert(0, {"Name": "UserId", "Value": str(uid)})
+
+            self._dims[key] = ret
+
+        return ret
+
+    def _convert(self, ret, node_id, uid, xs):
+        """
+        Appends the datapoints of `xs` to `ret`, returns the number of series seen.
+        """
+        gen = self._generation
+        templates = self._templates
+        n = 0
+
+        for k, v in xs.items():
+            value = v["value"]
+            if not isinstance(value, (int, float)):
+                continue
+
+            n += 1
+            key = (node_id, uid, k)
+            entry = templates.get(key)
+            unit = v["unit"]
+            rate = v.get("rate")
+
+            if entry is None or entry[1] != unit or entry[2] != rate:
+                entry = templates[key] = [
+                    gen,
+                    unit,
+                    rate,
+                    *_template(k, v, self._get_dims(node_id, uid)),
+                ]
+            else:
+                entry[0] = gen
+
+            if entry[4] is not None:
+                m = entry[4].copy()
+                m["Value"] = value / entry[3]
+                ret.append(m)
+
+        return n
+
+    def __call__(self, stats):
+        self._generation += 1
+        ret = []
+        n = 0
+
+        for node_id, xs in stats.items():
+            for uid, xs_ in xs["by_uid"].items():
+                n += self._convert(ret, node_id, uid, xs_)
+
+            n += self._convert(ret, node_id, None, xs["cumulative"])
+
+        # Evict the series that are gone, e.g. of a removed user.
+        if len(self._templates) > n:
+            gen = self._generation
+            self._templates = {k: x for k, x in self._templates.items() if x[0] == gen}
+            groups = {(node_id, uid) for (node_id, uid, _) in self._templates}
+            self._dims = {k: x for k, x in self._dims.items() if k in groups}
+
+        return ret
+
+
+def _metric_size(m):
+    """
+    Estimates the number of bytes a datapoint takes in a PutMetricData request.
+    """
+    ret = 2 * _FIELD_BYTES + len(m["MetricName"]) + len(m.get("Unit", ""))
+
+    if "Value" in m:
+        ret += _FIELD_BYTES + _NUMBER_BYTES
+    if "StatisticValues" in m:
+        ret += 4 * (_FIELD_BYTES + _NUMBER_BYTES)
+    if "Timestamp" in m:
+        ret += _FIELD_BYTES + _NUMBER_BYTES
+    if "StorageResolution" in m:
+        ret += _FIELD_BYTES + _NUMBER_BYTES
+
+    for d in m.get("Dimensions", []):
+        ret += 2 * _FIELD_BYTES + len(d["Name"]) + len(d["Value"])
+
+    return ret
+
+
+def _payload_size(batch):
+    """
+    Estimates the number of bytes of a PutMetricData payload.
+    """
+    return sum(_metric_size(m) for m in batch)
+
+
+def pack_batches(
+    metrics, max_metrics=MAX_METRICS_PER_REQUEST, max_bytes=MAX_REQUEST_BYTES
+):
+    """
+    Packs datapoints into as few PutMetricData requests as possible.
+
+    Every request is filled up to `max_metrics` datapoints, or until its estimated
+    size would exceed `max_bytes`, whichever comes first.
+    """
+    ret = []
+    batch = []
+    size = 0
+
+    # Leave room for the other parameters of the request, e.g. the namespace.
+    max_bytes -= 4 * _FIELD_BYTES
+
+    for m in metrics:
+        n = _metric_size(m)
+
+        if batch and (len(batch) >= max_metrics or size + n > max_bytes):
+            ret.append(batch)
+            batch = []
+            size = 0
+
+        batch.append(m)
+        size += n
+
+    if batch:
+        ret.append(batch)
+
+    return ret
+
+
+def _put_batch(client, namespace, index, batch, limiter, max_attempts):
+    try:
+        with_retries(
+            lambda: client.put_metric_data(Namespace=namespace, MetricData=batch),
+            limiter,
+            max_attempts,
+        )
+    except Exception as e:
+        logger.error(f"Failed to push batch {index} of {len(batch)} metrics: {e}")
+        instrument.count("api_errors")
+        return BatchResult(index, len(batch), e)
+
+    instrument.count("batches")
+    instrument.count("metrics", len(batch))
+    instrument.count("bytes", _payload_size(batch))
+    return BatchResult(index, len(batch), None)
+
+
+def send_batches(
+    client,
+    namespace,
+    batches,
+    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    limiter=None,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+):
+    """
+    Sends all batches with at most `max_in_flight` concurrent PutMetricData requests.
+
+    Throttling, server and network errors are retried up to `max_attempts` times,
+    and the request rate is bounded by `limiter` (a `ratelimit.RateLimiter`), if
+    any. A failing batch does not affect the others. Returns one `BatchResult` per
+    batch, in the same order as `batches`.
+    """
+    if not batches:
+        return []
+
+    # boto3 clients are thread-safe, the same client is shared by all workers.
+    put_batch = instrument.thread_profiled(_put_batch)
+    with ThreadPoolExecutor(max_workers=min(max_in_flight, len(batches))) as pool:
+        futures = [
+            pool.submit(put_batch, client, namespace, i, batch, limiter, max_attempts)
+            for i, batch in enumerate(batches)
+        ]
+        return [f.result() for f in futures]
+
+
+def _spool_batch(spool, namespace, batch, now):
+    try:
+        spool.append(
+            namespace,
+            [m if "Timestamp" in m else {**m, "Timestamp": now} for m in batch],
+        )
+    except OSError as e:
+        logger.error(f"Failed to spool {len(batch)} metrics: {e}")
+
+
+def push_metrics(
+    metrics,
+    namespace,
+    client=None,
+    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    suppressor=None,
+    limiter=None,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+    max_metrics_per_request=MAX_METRICS_PER_REQUEST,
+    spool=None,
+):
+    """
+    Pushes CloudWatch datapoints, e.g. as returned by `_qdb_to_cloudwatch`.
+
+    When a `spool` (a `spool.Spool`) is given, batches that failed with an error
+    that may go away, e.g. a network error, are spooled to be sent later. Their
+    datapoints that have no `Timestamp` yet are stamped with the time of this push.
+    """
+    client = client or get_client()
+    now = datetime.now(timezone.utc)
+
+    if suppressor is not None:
+        metrics = suppressor.select(metrics)
+
+    batches = pack_batches(metrics, max_metrics_per_request)
+
+    logger.info(f"Pushing {len(metrics)} metrics in {len(batches)} requests")
+    with instrument.timed("push"):
+        results = send_batches(
+            client, namespace, batches, max_in_flight, limiter, max_attempts
+        )
+
+    failed = [x for x in results if x.error is not None]
+    if failed:
+        logger.error(
+            f"Failed to push {sum(x.size for x in failed)} metrics in {len(failed)} out of {len(results)} requests"
+        )
+
+    if suppressor is not None:
+        for x in results:
+            if x.error is None:
+                suppressor.record(batches[x.index])
+
+    if spool is not None:
+        for x in failed:
+            if is_retryable(x.error):
+                _spool_batch(spool, namespace, batches[x.index], now)
+
+    logger.info(f"Pushed {len(metrics) - sum(x.size for x in failed)} metrics")
+
+    return results
+
 
-    metrics_per_req = 20
-    metrics = [
-        stats_[i : i + metrics_per_req] for i in range(0, len(stats_), metrics_per_req)
-    ]
+def push_stats(
+    stats,
+    namespace,
+    client=None,
+    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    suppressor=None,
+    limiter=None,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+    sink=None,
+):
+    """
+    Pushes stats with PutMetricData or, when given, through `sink` (a `sinks.Sink`).
+    """
+    metrics = _qdb_to_cloudwatch(stats)
 
-    logger.info(f"Pushing {len(stats_)} metrics")
-    for metric in metrics:
-        _ = client.put_metric_data(Namespace=namespace, MetricData=metric)
+    if sink is not None:
+        return sink.push(metrics, namespace, suppressor)
 
-    logger.info(f"Pushed {len(stats_)} metrics")
+    return push_metrics(
+        metrics,
+        namespace,
+        client=client,
+        max_in_flight=max_in_flight,
+        suppressor=suppressor,
+        limiter=limiter,
+        max_attempts=max_attempts,
+    )
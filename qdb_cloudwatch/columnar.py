@@ -0,0 +1,176 @@
+import logging
+
+import numpy as np
+from quasardb.stats import Unit
+
+from .cloudwatch import _stat_unit_to_cloudwatch_unit
+
+logger = logging.getLogger(__name__)
+
+
+class Frame:
+    """
+    Columnar representation of the stats returned by `get_all_stats`.
+
+    The nested dicts are flattened once into parallel arrays, one row per datapoint.
+    Node/uid pairs ("groups") and metric names are dictionary-encoded: the `group`
+    and `metric` columns hold indices into `groups` and `metrics`, so that filtering
+    only needs to look at the distinct metric names and unit conversion runs as a
+    single vectorized step. CloudWatch dicts are only built by `to_cloudwatch()`.
+
+    Non-numeric values (labels) cannot be sent to CloudWatch and are left out. Stats
+    without a unit get the unit code -1, which converts to CloudWatch's "None".
+    """
+
+    def __init__(self, groups, metrics, group, metric, value, unit):
+        # List of (node_id, uid) pairs, uid is None for cumulative stats.
+        self.groups = groups
+        # List of distinct metric names.
+        self.metrics = metrics
+
+        self.group = group
+        self.metric = metric
+        self.value = value
+        self.unit = unit
+
+    def __len__(self):
+        return len(self.value)
+
+    @classmethod
+    def from_stats(cls, stats, metric_filter=None):
+        """
+        Flattens `stats`. With a `metric_filter` (a `check.Filter`), the rows it
+        drops are skipped while flattening, the filter being evaluated once per
+        distinct metric name.
+        """
+        groups = []
+        metrics = []
+        # Metric name -> code, or -1 if it is filtered out.
+        metric_codes = {}
+
+        group = []
+        metric = []
+        value = []
+        unit = []
+
+        def _add(xs):
+            g = len(groups) - 1
+            for k, v in xs.items():
+                code = metric_codes.get(k)
+                if code is None:
+                    if metric_filter is None or metric_filter.keep(k):
+                        code = len(metrics)
+                        metrics.append(k)
+                    else:
+                        code = -1
+
+                    metric_codes[k] = code
+
+                x = v["value"]
+                if code < 0 or not isinstance(x, (int, float)):
+                    continue
+
+                group.append(g)
+                metric.append(code)
+                value.append(x)
+                unit.append(-1 if v["unit"] is None else v["unit"].value)
+
+        for node_id, xs in stats.items():
+            for uid, xs_ in xs["by_uid"].items():
+                groups.append((node_id, uid))
+                _add(xs_)
+
+            groups.append((node_id, None))
+            _add(xs["cumulative"])
+
+        return cls(
+            groups,
+            metrics,
+            np.array(group, dtype=np.int32),
+            np.array(metric, dtype=np.int32),
+            np.array(value, dtype=np.float64),
+            np.array(unit, dtype=np.int16),
+        )
+
+    def _take(self, mask):
+        return Frame(
+            self.groups,
+            self.metrics,
+            self.group[mask],
+            self.metric[mask],
+            self.value[mask],
+            self.unit[mask],
+        )
+
+    def filter(self, metric_filter):
+        """
+        Returns the rows whose metric passes `metric_filter` (a `check.Filter`).
+
+        The filter is evaluated once per distinct metric name.
+        """
+        keep = np.fromiter(
+            (metric_filter.keep(k) for k in self.metrics),
+            dtype=bool,
+            count=len(self.metrics),
+        )
+        return self._take(keep[self.metric])
+
+    def coerce(self):
+        """
+        Vectorized equivalent of `cloudwatch._coerce_metric`: drops CPU metrics and
+        converts nanoseconds to microseconds.
+        """
+        no_cpu = np.fromiter(
+            (not k.startswith("cpu.") for k in self.metrics),
+            dtype=bool,
+            count=len(self.metrics),
+        )
+        ret = self._take(no_cpu[self.metric])
+
+        ns = ret.unit == Unit.NANOSECONDS.value
+        ret.value[ns] /= 1000
+        ret.unit[ns] = Unit.MICROSECONDS.value
+
+        return ret
+
+    def to_cloudwatch(self):
+        """
+        Serializes the rows as CloudWatch datapoints, like `_qdb_to_cloudwatch`.
+        """
+        dims = [
+            (
+                [{"Name": "NodeId", "Value": str(node_id)}]
+                if uid is None
+                else [
+                    {"Name": "UserId", "Value": str(uid)},
+                    {"Name": "NodeId", "Value": str(node_id)},
+                ]
+            )
+            for (node_id, uid) in self.groups
+        ]
+        units = {u.value: _stat_unit_to_cloudwatch_unit.get(u, "None") for u in Unit}
+
+        return [
+            {
+                "MetricName": self.metrics[m],
+                "Value": v,
+                "Unit": units.get(u, "None"),
+                "Dimensions": dims[g],
+            }
+            for (g, m, v, u) in zip(
+                self.group.tolist(),
+                self.metric.tolist(),
+                self.value.tolist(),
+                self.unit.tolist(),
+            )
+        ]
+
+
+def to_cloudwatch(stats, metric_filter):
+    """
+    Filters `stats` and converts them to CloudWatch datapoints through a `Frame`.
+    """
+    ret = Frame.from_stats(stats, metric_filter).coerce()
+
+    logger.info(f"Kept {len(ret)} datapoints")
+    return ret.to_cloudwatch()
@@ -1,9 +1,56 @@
 import argparse
+import copy
+import json
 import logging
+import os
+import re
+import signal
+import socket
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import ExitStack
+from datetime import datetime, timezone
 
-from .check import filter_stats, get_all_stats, get_critical_stats
-from .cloudwatch import push_stats
+from .check import (
+    DEFAULT_CONNECT_TIMEOUT_SECONDS,
+    DEFAULT_KEY_REFRESH_SECONDS,
+    DEFAULT_NODE_TIMEOUT_SECONDS,
+    Connection,
+    Filter,
+    StatsReader,
+    TierFilter,
+    WriteProbe,
+    _get_endpoint_from_uri,
+    get_all_stats,
+    get_critical_stats,
+)
+from . import instrument
+from .aggregate import Aggregator
+from .cloudwatch import (
+    DEFAULT_MAX_IN_FLIGHT,
+    MAX_METRICS_PER_REQUEST,
+    MetricConverter,
+    _qdb_to_cloudwatch,
+)
+from .ratelimit import DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_RATE, RateLimiter
+from .rates import RateConverter
+from .schedule import Schedule, run_forever
+from .sinks import (
+    DEFAULT_DRAIN_RATE,
+    DEFAULT_DRAIN_SECONDS,
+    DEFAULT_PROMETHEUS_ADDRESS,
+    CloudWatchSink,
+    EmfSink,
+    NullSink,
+    PrometheusSink,
+)
+from .snapshot import Recorder, read_snapshots
+from .spool import DEFAULT_SPOOL_MAX_BYTES, Spool
+from .suppress import DEFAULT_HEARTBEAT_CYCLES, Suppressor
+from .topk import DEFAULT_RANK_METRIC, TopUsers
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +66,145 @@ def _parse_list(x):
     return [token.strip() for token in x.split(",") if token.strip()]
 
 
-def get_args():
+# Options that can be set per cluster in a --config file: key -> argument dest.
+_cluster_options = {
+    "name": "name",
+    "cluster": "cluster_uri",
+    "cluster_public_key": "cluster_public_key",
+    "user_security_file": "user_security_file",
+    "namespace": "namespace",
+    "filter_include": "filter_include",
+    "filter_exclude": "filter_exclude",
+    "all_nodes": "all_nodes",
+    "top_users": "top_users",
+    "top_users_by": "top_users_by",
+    "write_probe": "write_probe",
+}
+
+# Default number of clusters that are collected from at the same time.
+DEFAULT_MAX_CONCURRENT_CLUSTERS = 4
+
+
+# Cluster names are directories of --state-dir.
+_valid_cluster_name = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+def _check_cluster_option(parser, k, v):
+    """
+    Validates the value of a --config cluster option like the command line does.
+    """
+    if k in ("filter_include", "filter_exclude"):
+        valid = isinstance(v, str) or (
+            isinstance(v, list) and all(isinstance(x, str) for x in v)
+        )
+    elif k == "all_nodes":
+        valid = isinstance(v, bool)
+    elif k == "top_users":
+        valid = isinstance(v, int) and not isinstance(v, bool) and v >= 1
+    elif k == "write_probe":
+        valid = v in ("create", "rotate")
+    elif k == "name":
+        # Like the names `_cluster_name` derives from uris.
+        valid = (
+            isinstance(v, str)
+            and _valid_cluster_name.match(v) is not None
+            and v not in (".", "..")
+        )
+    else:
+        valid = isinstance(v, str)
+
+    if not valid:
+        parser.error(f"Invalid value for '{k}' in --config: {v!r}")
+
+
+def _cluster_name(cluster_uri):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", cluster_uri.split("://", 1)[-1])
+
+
+def _load_clusters(parser, args):
+    """
+    Returns the arguments of every cluster to export. Every cluster of the --config
+    file gets a copy of the command line arguments, with its own options on top.
+    Without --config, there is only the cluster of the command line.
+    """
+    if args.config is None:
+        args.name = _cluster_name(args.cluster_uri)
+        return [args]
+
+    try:
+        with open(args.config, "r") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        parser.error(f"Failed to read --config {args.config}: {e}")
+
+    clusters = config.get("clusters") if isinstance(config, dict) else None
+    if not clusters:
+        parser.error(f"No clusters in --config {args.config}")
+
+    ret = []
+    for x in clusters:
+        unknown = set(x) - set(_cluster_options)
+        if unknown:
+            parser.error(f"Unknown cluster options in --config: {sorted(unknown)}")
+
+        if "cluster" not in x:
+            parser.error("Every cluster in --config needs a 'cluster' uri")
+
+        for k, v in x.items():
+            _check_cluster_option(parser, k, v)
+
+        args_ = argparse.Namespace(**vars(args))
+        for k, v in x.items():
+            setattr(args_, _cluster_options[k], v)
+
+        # Filters may be given as lists, or like on the command line.
+        for k in ("filter_include", "filter_exclude"):
+            v = getattr(args_, k)
+            if isinstance(v, str):
+                setattr(args_, k, _parse_list(v))
+
+        if "name" not in x:
+            args_.name = _cluster_name(args_.cluster_uri)
+
+        if args.state_dir is not None:
+            args_.state_dir = os.path.join(args.state_dir, args_.name)
+
+        ret.append(args_)
+
+    names = [x.name for x in ret]
+    if len(set(names)) != len(names):
+        parser.error(f"Cluster names in --config must be unique, got: {names}")
+
+    return ret
+
+
+def _parse_tier(parser, x):
+    """
+    Parses a --tier `SECONDS:PATTERNS` value into `(seconds, patterns)`.
+    """
+    interval, _, patterns = x.partition(":")
+
+    try:
+        interval = float(interval)
+    except ValueError:
+        interval = 0
+
+    patterns = _parse_list(patterns)
+    if interval <= 0 or patterns is None:
+        parser.error(f"Invalid --tier, expected SECONDS:PATTERNS, got: {x}")
+
+    return interval, patterns
+
+
+def _tick_interval(args):
+    """
+    Returns the interval between two cycles: the shortest of --interval and of the
+    --tier intervals.
+    """
+    return min([args.interval] + [interval for (interval, _) in args.tiers])
+
+
+def get_args(argv=None):
     parser = argparse.ArgumentParser(
         description=("Fetch QuasarDB metrics for local node and export to CloudWatch.")
     )
@@ -55,6 +240,20 @@ def get_args():
         default="QuasarDB",
     )
 
+    parser.add_argument(
+        "--config",
+        dest="config",
+        help="JSON file listing several clusters to export from, each with its own credentials, namespace and filters, see the README. Other options apply to all clusters.",
+    )
+
+    parser.add_argument(
+        "--max-concurrent-clusters",
+        dest="max_concurrent_clusters",
+        type=int,
+        help=f"Maximum number of clusters of --config that are collected from at the same time. Defaults to {DEFAULT_MAX_CONCURRENT_CLUSTERS}.",
+        default=DEFAULT_MAX_CONCURRENT_CLUSTERS,
+    )
+
     parser.add_argument(
         "--filter-include",
         dest="filter_include",
@@ -67,7 +266,395 @@ def get_args():
         help="Optional comma-separated list of regex patterns to filter metrics. Only metrics that contain none of the patterns will be reported.",
     )
 
-    ret = parser.parse_args()
+    parser.add_argument(
+        "--filter-pushdown",
+        dest="filter_pushdown",
+        action="store_true",
+        help="Apply --filter-include and --filter-exclude before reading stats from the nodes, so that filtered out stats are never read. The matching keys are cached, see --key-refresh-interval.",
+    )
+
+    parser.add_argument(
+        "--key-refresh-interval",
+        dest="key_refresh_interval",
+        type=float,
+        help=f"Number of seconds after which --filter-pushdown lists the stats keys of a node again, to pick up new stats and users. Defaults to {DEFAULT_KEY_REFRESH_SECONDS}.",
+        default=DEFAULT_KEY_REFRESH_SECONDS,
+    )
+
+    parser.add_argument(
+        "--all-nodes",
+        dest="all_nodes",
+        action="store_true",
+        help="Collect metrics from every node of the cluster in parallel, rather than only from the node in --cluster.",
+    )
+
+    parser.add_argument(
+        "--node-timeout",
+        dest="node_timeout",
+        type=float,
+        help=f"Number of seconds every node gets to return its metrics. Defaults to {DEFAULT_NODE_TIMEOUT_SECONDS}.",
+        default=DEFAULT_NODE_TIMEOUT_SECONDS,
+    )
+
+    parser.add_argument(
+        "--daemon",
+        dest="daemon",
+        action="store_true",
+        help="Keep running and collect metrics every --interval seconds, reusing the qdb and CloudWatch connections across runs.",
+    )
+
+    parser.add_argument(
+        "--interval",
+        dest="interval",
+        type=float,
+        help="Number of seconds between two collections in daemon mode. Defaults to 60.",
+        default=60.0,
+    )
+
+    parser.add_argument(
+        "--write-probe",
+        dest="write_probe",
+        choices=["create", "rotate"],
+        help="How node.writable is checked: 'create' writes, reads and removes a new entry every time, 'rotate' updates and reads one of a few fixed entries per exporter, which is cheaper. Defaults to 'create'.",
+        default="create",
+    )
+
+    parser.add_argument(
+        "--tier",
+        dest="tiers",
+        action="append",
+        metavar="SECONDS:PATTERNS",
+        help="Collect the metrics that match any of the comma-separated regex PATTERNS every SECONDS instead of every --interval, e.g. '600:rocksdb\\.,persistence\\.'. Can be repeated: a metric belongs to the first tier it matches. Intervals must be multiples of the shortest one. Critical metrics are pushed at the shortest interval. Implies --filter-pushdown and requires --daemon.",
+    )
+
+    parser.add_argument(
+        "--critical-interval",
+        dest="critical_interval",
+        type=float,
+        help="In daemon mode, check whether nodes are online and writable every this many seconds, e.g. 10, on a loop of their own, and push these critical metrics at high resolution (1 second), in a single request per namespace. All other stats keep being collected every --interval.",
+    )
+
+    parser.add_argument(
+        "--cycle-deadline",
+        dest="cycle_deadline",
+        type=float,
+        help="Number of seconds after which a collection cycle pushes whatever it has gathered, leaving out the nodes that did not answer. Defaults to --interval, or to the shortest --tier interval.",
+    )
+
+    parser.add_argument(
+        "--sink",
+        dest="sink",
+        choices=["cloudwatch", "emf", "prometheus", "null"],
+        help="Where to send metrics: 'cloudwatch' pushes them with PutMetricData, 'emf' writes them in CloudWatch Embedded Metric Format to --emf-output, for the CloudWatch agent to ship, 'prometheus' serves them for scraping on --prometheus-address, 'null' discards them. Defaults to cloudwatch, or to null with --replay.",
+    )
+
+    parser.add_argument(
+        "--emf-output",
+        dest="emf_output",
+        help="Where --sink emf writes to: '-' for stdout, 'unix:PATH' for a unix socket, or a file path. Defaults to stdout.",
+        default="-",
+    )
+
+    parser.add_argument(
+        "--prometheus-address",
+        dest="prometheus_address",
+        help=f"HOST:PORT on which --sink prometheus serves metrics, under /metrics. Defaults to {DEFAULT_PROMETHEUS_ADDRESS}.",
+        default=DEFAULT_PROMETHEUS_ADDRESS,
+    )
+
+    parser.add_argument(
+        "--max-metrics-per-request",
+        dest="max_metrics_per_request",
+        type=int,
+        help=f"Maximum number of metrics in a single PutMetricData request. Requests are also kept below the 1 MB payload limit. Defaults to {MAX_METRICS_PER_REQUEST}.",
+        default=MAX_METRICS_PER_REQUEST,
+    )
+
+    parser.add_argument(
+        "--max-request-rate",
+        dest="max_request_rate",
+        type=float,
+        help=f"Maximum number of PutMetricData requests per second. The rate is lowered automatically when CloudWatch throttles requests. Defaults to {DEFAULT_MAX_RATE:g}.",
+        default=DEFAULT_MAX_RATE,
+    )
+
+    parser.add_argument(
+        "--max-attempts",
+        dest="max_attempts",
+        type=int,
+        help=f"Maximum number of attempts of a PutMetricData request that failed because of throttling, a server or a network error. Defaults to {DEFAULT_MAX_ATTEMPTS}.",
+        default=DEFAULT_MAX_ATTEMPTS,
+    )
+
+    parser.add_argument(
+        "--spool-dir",
+        dest="spool_dir",
+        help="Directory where PutMetricData requests that failed because of a network or server error are spooled, with the time of their metrics, to be sent once CloudWatch can be reached again.",
+    )
+
+    parser.add_argument(
+        "--spool-max-bytes",
+        dest="spool_max_bytes",
+        type=int,
+        help=f"Maximum size of --spool-dir, beyond which its oldest metrics are dropped. Defaults to {DEFAULT_SPOOL_MAX_BYTES}.",
+        default=DEFAULT_SPOOL_MAX_BYTES,
+    )
+
+    parser.add_argument(
+        "--spool-drain-rate",
+        dest="spool_drain_rate",
+        type=float,
+        help=f"Maximum number of PutMetricData requests per second that send spooled metrics. They are only sent after the current metrics. Defaults to {DEFAULT_DRAIN_RATE:g}.",
+        default=DEFAULT_DRAIN_RATE,
+    )
+
+    parser.add_argument(
+        "--spool-drain-seconds",
+        dest="spool_drain_seconds",
+        type=float,
+        help=f"Number of seconds the exporter keeps sending spooled metrics when it exits, e.g. at the end of a one-shot run. Metrics that are not sent in time stay in --spool-dir. Defaults to {DEFAULT_DRAIN_SECONDS:g}.",
+        default=DEFAULT_DRAIN_SECONDS,
+    )
+
+    parser.add_argument(
+        "--sample-interval",
+        dest="sample_interval",
+        type=float,
+        help="In daemon mode, sample metrics every this many seconds and push them every --interval seconds as statistic sets (count, sum, min and max of the samples).",
+    )
+
+    parser.add_argument(
+        "--max-in-flight",
+        dest="max_in_flight",
+        type=int,
+        help=f"Maximum number of concurrent PutMetricData requests. Defaults to {DEFAULT_MAX_IN_FLIGHT}.",
+        default=DEFAULT_MAX_IN_FLIGHT,
+    )
+
+    parser.add_argument(
+        "--suppress-unchanged",
+        dest="suppress_unchanged",
+        action="store_true",
+        help="Do not push metrics whose value did not change since they were last pushed, except for a heartbeat every --heartbeat-cycles runs. Critical metrics are always pushed.",
+    )
+
+    parser.add_argument(
+        "--suppress-tolerance",
+        dest="suppress_tolerance",
+        type=float,
+        help="Relative change below which a metric is considered unchanged, e.g. 0.01 for 1%%. Defaults to 0.",
+        default=0.0,
+    )
+
+    parser.add_argument(
+        "--heartbeat-cycles",
+        dest="heartbeat_cycles",
+        type=int,
+        help=f"Number of runs after which an unchanged metric is pushed anyway. Defaults to {DEFAULT_HEARTBEAT_CYCLES}.",
+        default=DEFAULT_HEARTBEAT_CYCLES,
+    )
+
+    parser.add_argument(
+        "--counters-as-rates",
+        dest="counters_as_rates",
+        action="store_true",
+        help="Push counters as per-second rates, under their name suffixed with '.rate', instead of as raw totals. In one-shot mode, requires --state-dir to compute rates between runs.",
+    )
+
+    parser.add_argument(
+        "--top-users",
+        dest="top_users",
+        type=int,
+        help="Only push per-user metrics of the K most active users of every node. The other users are summed into a single 'UserId=other' series.",
+    )
+
+    parser.add_argument(
+        "--top-users-by",
+        dest="top_users_by",
+        help=f"Metric by which --top-users ranks users. Counters are ranked by their increase since the previous run. Defaults to '{DEFAULT_RANK_METRIC}'.",
+        default=DEFAULT_RANK_METRIC,
+    )
+
+    parser.add_argument(
+        "--columnar",
+        dest="columnar",
+        action="store_true",
+        help="Filter and convert stats through a columnar (NumPy) representation: the filter is applied while flattening, once per distinct metric name, and units are converted in a single vectorized step. Run 'python -m benchmarks' to compare it with the default path on your number of users and metrics. Cannot be combined with --counters-as-rates.",
+    )
+
+    parser.add_argument(
+        "--state-dir",
+        dest="state_dir",
+        help="Directory where state is kept between runs, for --suppress-unchanged, --counters-as-rates and --top-users in one-shot mode.",
+    )
+
+    parser.add_argument(
+        "--record",
+        dest="record",
+        metavar="PATH",
+        help="Append every snapshot of the stats collected from the cluster to this file, in a compact binary format, for --replay.",
+    )
+
+    parser.add_argument(
+        "--replay",
+        dest="replay",
+        metavar="PATH",
+        help="Instead of collecting stats from a cluster, feed the snapshots recorded with --record to the filter, conversion and push pipeline, then exit.",
+    )
+
+    parser.add_argument(
+        "--replay-speed",
+        dest="replay_speed",
+        type=float,
+        help="Speed factor at which --replay feeds snapshots, relative to the time they were recorded, e.g. 10 to replay 10 times faster. 0 replays as fast as possible. Defaults to 1.",
+        default=1.0,
+    )
+
+    parser.add_argument(
+        "--self-metrics",
+        dest="self_metrics",
+        action="store_true",
+        help=f"Push the exporter's own metrics (time spent per stage, number of metrics, requests, bytes and API errors) under the '<namespace>/{instrument.SUB_NAMESPACE}' namespace.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        help="Profile the first run with cProfile and tracemalloc, and write the results to this directory.",
+    )
+
+    ret = parser.parse_args(argv)
+
+    if ret.interval <= 0:
+        parser.error("--interval must be a positive number of seconds")
+
+    if ret.key_refresh_interval < 0:
+        parser.error("--key-refresh-interval must not be negative")
+
+    if ret.node_timeout <= 0:
+        parser.error("--node-timeout must be a positive number of seconds")
+
+    ret.tiers = [_parse_tier(parser, x) for x in ret.tiers or []]
+    if ret.tiers:
+        if not ret.daemon:
+            parser.error("--tier requires --daemon")
+
+        if ret.sample_interval is not None:
+            parser.error("--tier cannot be combined with --sample-interval")
+
+        tick = _tick_interval(ret)
+        for x in [ret.interval] + [interval for (interval, _) in ret.tiers]:
+            if abs(x / tick - round(x / tick)) > 1e-9:
+                parser.error(
+                    f"--interval and --tier intervals must be multiples of {tick:g}s"
+                )
+
+    if ret.cycle_deadline is None:
+        ret.cycle_deadline = _tick_interval(ret)
+    elif ret.cycle_deadline <= 0:
+        parser.error("--cycle-deadline must be a positive number of seconds")
+
+    if ret.critical_interval is not None:
+        if not ret.daemon:
+            parser.error("--critical-interval requires --daemon")
+
+        if not 0 < ret.critical_interval <= _tick_interval(ret):
+            parser.error(
+                "--critical-interval must be between 0 and --interval, or the shortest --tier interval"
+            )
+
+    if ret.sample_interval is not None:
+        if not ret.daemon:
+            parser.error("--sample-interval requires --daemon")
+
+        if not 0 < ret.sample_interval <= ret.interval:
+            parser.error("--sample-interval must be between 0 and --interval")
+
+    if not 1 <= ret.max_metrics_per_request <= MAX_METRICS_PER_REQUEST:
+        parser.error(
+            f"--max-metrics-per-request must be between 1 and {MAX_METRICS_PER_REQUEST}"
+        )
+
+    if ret.max_request_rate < 1:
+        parser.error("--max-request-rate must be at least 1")
+
+    if ret.max_attempts < 1:
+        parser.error("--max-attempts must be at least 1")
+
+    if ret.sink is None:
+        ret.sink = "null" if ret.replay is not None else "cloudwatch"
+
+    if ret.replay is not None:
+        for arg, x in [
+            ("--daemon", ret.daemon),
+            ("--record", ret.record),
+            ("--config", ret.config),
+        ]:
+            if x:
+                parser.error(f"--replay cannot be used with {arg}")
+
+    if ret.replay_speed < 0:
+        parser.error("--replay-speed must not be negative")
+
+    if ret.record is not None:
+        # A snapshot is the full stats of a single cluster.
+        if ret.tiers:
+            parser.error("--record cannot be used with --tier")
+
+        if ret.config is not None:
+            parser.error("--record cannot be used with --config")
+
+    if ret.spool_dir is not None and ret.sink != "cloudwatch":
+        parser.error("--spool-dir can only be used with --sink cloudwatch")
+
+    if ret.spool_max_bytes < 1:
+        parser.error("--spool-max-bytes must be at least 1")
+
+    if ret.spool_drain_rate <= 0:
+        parser.error("--spool-drain-rate must be a positive number")
+
+    if ret.spool_drain_seconds < 0:
+        parser.error("--spool-drain-seconds must not be negative")
+
+    if ret.sink == "emf" and ret.sample_interval is not None:
+        parser.error("--sample-interval cannot be used with --sink emf")
+
+    if ret.sink == "prometheus":
+        if not ret.daemon:
+            parser.error("--sink prometheus requires --daemon")
+
+        _, sep, port = ret.prometheus_address.rpartition(":")
+        if not sep or not port.isdigit() or int(port) > 65535:
+            parser.error(
+                f"--prometheus-address must be HOST:PORT, got: {ret.prometheus_address}"
+            )
+
+        if ret.sample_interval is not None:
+            parser.error("--sample-interval cannot be used with --sink prometheus")
+
+        if ret.suppress_unchanged:
+            parser.error("--suppress-unchanged cannot be used with --sink prometheus")
+
+    if ret.columnar and ret.counters_as_rates:
+        parser.error("--columnar cannot be combined with --counters-as-rates")
+
+    if ret.top_users is not None and ret.top_users < 1:
+        parser.error("--top-users must be at least 1")
+
+    if ret.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+
+    if ret.max_concurrent_clusters < 1:
+        parser.error("--max-concurrent-clusters must be at least 1")
+
+    if ret.config is not None and ret.sample_interval is not None:
+        parser.error("--sample-interval cannot be used with --config")
+
+    if ret.suppress_tolerance < 0:
+        parser.error("--suppress-tolerance must not be negative")
+
+    if ret.heartbeat_cycles < 1:
+        parser.error("--heartbeat-cycles must be at least 1")
 
     ret.filter_include = _parse_list(ret.filter_include)
     ret.filter_exclude = _parse_list(ret.filter_exclude)
@@ -78,29 +665,662 @@ def get_args():
     if ret.filter_exclude is not None:
         logger.info(f"Using exclude filters: {ret.filter_exclude}")
 
+    ret.clusters = _load_clusters(parser, ret)
+
     return ret
 
 
-def main():
-    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+class _Context:
+    """
+    Long-lived objects that are shared by all runs of a process.
+    """
 
-    args = get_args()
+    def __init__(
+        self,
+        conn,
+        sink,
+        metric_filter,
+        suppressor=None,
+        aggregator=None,
+        rates=None,
+        top_users=None,
+        critical_conn=None,
+        write_probe=None,
+        reader=None,
+    ):
+        self.conn = conn
+        self.sink = sink
+        self.metric_filter = metric_filter
+        self.suppressor = suppressor
+        self.aggregator = aggregator
+        self.rates = rates
+        self.top_users = top_users
+
+        # Critical stats are collected and pushed on their own lane, and by default
+        # connection, alongside the full stats.
+        self.critical_conn = critical_conn or conn
+        self.write_probe = write_probe
+        self.reader = reader
+        self.converter = MetricConverter()
+        self.recorder = None
+        self.critical_lane = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="critical"
+        )
+
+        # (every, ctx) of every collection tier, collected every `every` cycles,
+        # see `_get_tiers`. By default there is a single tier, collected every cycle.
+        self.tiers = [(1, self)]
+        self.cycles = 0
+
+    def close(self):
+        # The sink may be shared with other clusters, it is closed by `main`.
+        self.critical_lane.shutdown(wait=False)
 
-    # Send critical stats first, as getting all stats is expensive when cluster is busy.
+
+def _remaining(deadline):
+    return max(0.0, deadline - time.monotonic())
+
+
+def _node_timeout(args, deadline):
+    return min(args.node_timeout, _remaining(deadline))
+
+
+def _collect_critical(args, ctx, deadline):
     critical_stats = get_critical_stats(
         args.cluster_uri,
         args.cluster_public_key,
         args.user_security_file,
+        conn=ctx.critical_conn,
+        all_nodes=args.all_nodes,
+        node_timeout_seconds=_node_timeout(args, deadline),
+        write_probe=ctx.write_probe,
+    )
+    return _qdb_to_cloudwatch(critical_stats)
+
+
+def _push_critical(args, ctx, deadline):
+    ctx.sink.push(_collect_critical(args, ctx, deadline), args.namespace)
+
+
+def _submit_critical(args, ctx, deadline):
+    """
+    Submits critical stats to the critical lane, unless they have their own loop.
+    """
+    if args.critical_interval is not None:
+        return None
+
+    return ctx.critical_lane.submit(
+        instrument.thread_profiled(_push_critical), args, ctx, deadline
     )
-    push_stats(critical_stats, args.namespace)
 
+
+def _wait_critical(future, deadline):
+    """
+    Waits for the critical lane until `deadline`, and re-raises its errors.
+    """
+    if future is None:
+        return
+
+    try:
+        future.result(timeout=_remaining(deadline))
+    except FutureTimeoutError:
+        logger.error("Critical stats were not pushed before the cycle deadline")
+        instrument.count("critical_late")
+
+
+def _collect(args, ctx, deadline):
+    """
+    Collects, filters and converts all stats to CloudWatch datapoints. Nodes that
+    have not answered by `deadline` are left out.
+    """
     stats = get_all_stats(
         args.cluster_uri,
         args.cluster_public_key,
         args.user_security_file,
+        conn=ctx.conn,
+        all_nodes=args.all_nodes,
+        node_timeout_seconds=_node_timeout(args, deadline),
+        reader=ctx.reader,
+    )
+
+    collected_at = datetime.now(timezone.utc)
+
+    if ctx.recorder is not None:
+        _record(ctx, stats)
+
+    metrics = _convert(args, ctx, stats)
+
+    if args.spool_dir is not None:
+        # Spooled datapoints are backfilled at the time they were collected, rather
+        # than at the time their push failed.
+        metrics = [{**m, "Timestamp": collected_at} for m in metrics]
+
+    return metrics
+
+
+def _record(ctx, stats):
+    """
+    Writes `stats` to --record. Recording is a debugging aid: when it fails, it is
+    disabled, and the stats are still pushed.
+    """
+    try:
+        with instrument.timed("record"):
+            ctx.recorder.write(stats)
+    except Exception as e:
+        logger.error(f"Failed to record stats, recording is disabled: {e}")
+        instrument.count("record_errors")
+
+        recorder, ctx.recorder = ctx.recorder, None
+        try:
+            recorder.close()
+        except OSError:
+            pass
+
+
+def _convert(args, ctx, stats):
+    """
+    Filters and converts stats to CloudWatch datapoints.
+    """
+    # Users are ranked before filtering, which may drop the rank metric, and rolled
+    # up after rates are computed, so that rates are per user.
+    top = ctx.top_users.rank(stats) if ctx.top_users is not None else None
+
+    if args.columnar:
+        # NumPy is only needed, and imported, with --columnar.
+        from . import columnar
+
+        if top is not None:
+            stats = ctx.top_users.rollup(stats, top)
+
+        with instrument.timed("convert"):
+            return columnar.to_cloudwatch(stats, ctx.metric_filter)
+
+    stats = ctx.metric_filter(stats)
+
+    if ctx.rates is not None:
+        stats = ctx.rates(stats)
+
+    if top is not None:
+        stats = ctx.top_users.rollup(stats, top)
+
+    with instrument.timed("convert"):
+        return ctx.converter(stats)
+
+
+def _push(args, ctx, metrics):
+    ctx.sink.push(metrics, args.namespace, ctx.suppressor)
+
+
+def _push_self_metrics(args, ctx):
+    """
+    Logs, and with --self-metrics pushes, the exporter's own metrics of the run.
+
+    With --config, these metrics cover all clusters, and are dimensioned by the host
+    the exporter runs on rather than by a node.
+    """
+    durations, counters = instrument.collect()
+    instrument.log_summary(durations, counters)
+
+    if args.self_metrics:
+        if args.config is None:
+            dims = {"NodeId": _get_endpoint_from_uri(args.cluster_uri)}
+        else:
+            dims = {"Host": socket.gethostname()}
+
+        ctx.sink.push(
+            instrument.to_metrics(durations, counters, dims),
+            f"{args.namespace}/{instrument.SUB_NAMESPACE}",
+        )
+
+
+def _run_cycle(args, ctx):
+    deadline = time.monotonic() + args.cycle_deadline
+
+    # Critical stats go on their own lane: getting all stats is expensive when the
+    # cluster is busy, and alarms should not wait for it.
+    critical = _submit_critical(args, ctx, deadline)
+    errors = []
+
+    # A tier that fails does not stop the others, its error is raised at the end.
+    try:
+        for index, (every, ctx_) in enumerate(ctx.tiers):
+            if ctx.cycles % every != 0:
+                continue
+
+            try:
+                _push(args, ctx_, _collect(args, ctx_, deadline))
+            except Exception as e:
+                if len(ctx.tiers) > 1:
+                    logger.error(f"Failed to export tier {index}: {e}")
+                errors.append(e)
+    finally:
+        ctx.cycles += 1
+        _wait_critical(critical, deadline)
+
+    if errors:
+        raise errors[0]
+
+
+def _run_once(args, ctx):
+    _run_cycle(args, ctx)
+    _push_self_metrics(args, ctx)
+    ctx.sink.flush()
+
+
+def _run_clusters(args, runs, pool):
+    """
+    Runs a cycle of every cluster of `runs`, a list of `(args, ctx)`, on `pool`, then
+    pushes the exporter's own metrics once for all of them.
+
+    A cluster that fails does not stop the others, its error is raised at the end.
+    """
+    run_cycle = instrument.thread_profiled(_run_cycle)
+    futures = [(args_, pool.submit(run_cycle, args_, ctx)) for (args_, ctx) in runs]
+    errors = []
+
+    for args_, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Failed to export cluster {args_.name}: {e}")
+            errors.append(e)
+
+    _push_self_metrics(args, runs[0][1])
+    runs[0][1].sink.flush()
+
+    if errors:
+        raise errors[0]
+
+
+def _replay(args, ctx):
+    """
+    Feeds the snapshots of --replay through the pipeline, spaced like they were
+    recorded divided by --replay-speed.
+    """
+    start = None
+    n = 0
+
+    # Rates are computed between the times snapshots were recorded, whatever the
+    # replay speed.
+    recorded = [None]
+    if ctx.rates is not None:
+        ctx.rates = RateConverter(clock=lambda: recorded[0])
+
+    for timestamp, stats in read_snapshots(args.replay):
+        recorded[0] = timestamp
+        if start is None:
+            start = (timestamp, time.monotonic())
+
+        if args.replay_speed > 0:
+            due = start[1] + (timestamp - start[0]) / args.replay_speed
+            time.sleep(_remaining(due))
+
+        _push(args, ctx, _convert(args, ctx, stats))
+        _push_self_metrics(args, ctx)
+        ctx.sink.flush()
+        n += 1
+
+    logger.info(f"Replayed {n} snapshots from {args.replay}")
+
+
+def _run_critical(args, runs):
+    """
+    Collects the critical stats of every cluster of `runs`, a list of `(args, ctx)`,
+    and pushes them as high-resolution metrics, coalesced into as few requests as
+    possible: one per namespace.
+    """
+    deadline = time.monotonic() + args.critical_interval
+    futures = [
+        (args_, ctx.critical_lane.submit(_collect_critical, args_, ctx, deadline))
+        for (args_, ctx) in runs
+    ]
+    by_namespace = {}
+    errors = []
+
+    for args_, future in futures:
+        try:
+            metrics = future.result(timeout=_remaining(deadline))
+        except FutureTimeoutError:
+            logger.error(f"Critical stats of cluster {args_.name} were late")
+            instrument.count("critical_late")
+            continue
+        except Exception as e:
+            logger.error(f"Failed to check cluster {args_.name}: {e}")
+            errors.append(e)
+            continue
+
+        for m in metrics:
+            m["StorageResolution"] = 1
+
+        by_namespace.setdefault(args_.namespace, []).extend(metrics)
+
+    # The sink is not flushed: that is up to the cycle of the other stats, which may
+    # be halfway through its own pushes.
+    for namespace, metrics in by_namespace.items():
+        runs[0][1].sink.push(metrics, namespace)
+
+    if errors:
+        raise errors[0]
+
+
+def _run_sample(args, ctx, publish):
+    """
+    Takes one sample, and pushes the aggregated samples when `publish` is due.
+    """
+    deadline = time.monotonic() + min(args.cycle_deadline, args.sample_interval)
+    due = publish.remaining() == 0
+
+    critical = None
+    if due:
+        critical = _submit_critical(args, ctx, deadline)
+
+    ctx.aggregator.add(_collect(args, ctx, deadline))
+
+    if due:
+        publish.advance()
+        _push(args, ctx, ctx.aggregator.flush())
+        _wait_critical(critical, deadline)
+        _push_self_metrics(args, ctx)
+        ctx.sink.flush()
+
+
+def _get_suppressor(args):
+    if not args.suppress_unchanged:
+        return None
+
+    if args.state_dir is None and not args.daemon:
+        logger.warning(
+            "--suppress-unchanged without --state-dir has no effect in one-shot mode"
+        )
+
+    return Suppressor(args.suppress_tolerance, args.heartbeat_cycles)
+
+
+def _get_rates(args):
+    if not args.counters_as_rates:
+        return None
+
+    if args.state_dir is None and not args.daemon:
+        logger.warning(
+            "--counters-as-rates without --state-dir does not push any counter in one-shot mode"
+        )
+
+    return RateConverter()
+
+
+def _get_sink(args):
+    if args.sink == "emf":
+        return EmfSink(args.emf_output)
+
+    if args.sink == "null":
+        return NullSink()
+
+    if args.sink == "prometheus":
+        # Series of nodes and users that went away expire after a few cycles, of the
+        # slowest tier.
+        slowest = max([args.interval] + [interval for (interval, _) in args.tiers])
+        return PrometheusSink(args.prometheus_address, 3 * slowest)
+
+    spool = None
+    if args.spool_dir is not None:
+        spool = Spool(args.spool_dir, args.spool_max_bytes)
+
+    return CloudWatchSink(
+        None,
+        args.max_in_flight,
+        RateLimiter(args.max_request_rate),
+        args.max_attempts,
+        args.max_metrics_per_request,
+        spool,
+        args.spool_drain_rate,
+        args.spool_drain_seconds,
     )
-    stats = filter_stats(
-        stats, include=args.filter_include, exclude=args.filter_exclude
+
+
+def _get_reader(args, metric_filter):
+    if not args.filter_pushdown and not args.tiers:
+        return None
+
+    # The metric users are ranked by is needed even if it is not pushed.
+    extra = [args.top_users_by] if args.top_users else []
+    return StatsReader(metric_filter, args.key_refresh_interval, extra)
+
+
+def _get_tiers(args, ctx):
+    """
+    Splits the collection of `ctx` into the tiers of --tier, plus the default tier
+    of --interval for the metrics that belong to no other tier.
+
+    Every tier gets a copy of the context with its own `TierFilter`, which its
+    reader applies before fetching, and its own stateful converters and suppressor.
+    The default tier is `ctx` itself.
+    """
+    tick = _tick_interval(args)
+    filters = [Filter(include=patterns) for (_, patterns) in args.tiers]
+    base = ctx.metric_filter
+
+    ret = []
+    for index, interval in [(None, args.interval)] + list(
+        enumerate(interval for (interval, _) in args.tiers)
+    ):
+        ctx_ = ctx if index is None else copy.copy(ctx)
+        if index is not None:
+            ctx_.suppressor = _get_suppressor(args)
+            ctx_.rates = _get_rates(args)
+            ctx_.top_users = _get_top_users(args)
+            ctx_.converter = MetricConverter()
+
+        ctx_.metric_filter = TierFilter(base, filters, index)
+        ctx_.reader = _get_reader(args, ctx_.metric_filter)
+
+        ret.append((round(interval / tick), ctx_))
+
+    return ret
+
+
+def _get_top_users(args):
+    if not args.top_users:
+        return None
+
+    return TopUsers(args.top_users, args.top_users_by)
+
+
+def _get_context(args, conn, critical_conn=None, sink=None):
+    metric_filter = Filter(include=args.filter_include, exclude=args.filter_exclude)
+
+    ret = _Context(
+        conn,
+        sink or _get_sink(args),
+        metric_filter,
+        _get_suppressor(args),
+        Aggregator() if args.sample_interval is not None else None,
+        _get_rates(args),
+        _get_top_users(args),
+        critical_conn,
+        WriteProbe() if args.write_probe == "rotate" else None,
+        _get_reader(args, metric_filter),
     )
 
-    push_stats(stats, args.namespace)
+    if args.tiers:
+        ret.tiers = _get_tiers(args, ret)
+
+    return ret
+
+
+# Objects of the context that keep state between runs, and their file in --state-dir.
+_state_files = {
+    "suppressor": "suppression.json.gz",
+    "rates": "rates.json.gz",
+    "top_users": "top_users.json.gz",
+}
+
+
+def _stateful(args, ctx):
+    """
+    Yields the stateful objects of `ctx` and of its tiers, with their file in
+    --state-dir. The files of the n-th --tier are prefixed with `tier<n>.`.
+    """
+    for index, (_, ctx_) in enumerate(ctx.tiers):
+        prefix = "" if ctx_ is ctx else f"tier{index}."
+
+        for attr, name in _state_files.items():
+            x = getattr(ctx_, attr)
+            if x is not None:
+                yield x, os.path.join(args.state_dir, prefix + name)
+
+
+def _load_state(args, ctx):
+    if args.state_dir is None:
+        return
+
+    for x, path in _stateful(args, ctx):
+        x.load(path)
+
+
+def _save_state(args, ctx):
+    if args.state_dir is None:
+        return
+
+    os.makedirs(args.state_dir, exist_ok=True)
+
+    for x, path in _stateful(args, ctx):
+        x.save(path)
+
+
+def _profile_first(fn, directory):
+    """
+    Wraps `fn` so that its first invocation is profiled into `directory`, if any.
+    """
+    if directory is None:
+        return fn
+
+    calls = []
+
+    def _fn():
+        if calls:
+            return fn()
+
+        calls.append(1)
+        with instrument.profiled(directory):
+            return fn()
+
+    return _fn
+
+
+def _stop_on_signals(stop):
+    def _handler(signum, frame):
+        logger.info(f"Received signal {signum}, stopping")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _handler)
+    signal.signal(signal.SIGINT, _handler)
+
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    args = get_args()
+
+    with ExitStack() as stack:
+        # All clusters share the same sink, and so the same request rate limit.
+        sink = _get_sink(args)
+        stack.callback(sink.close)
+
+        if args.replay is not None:
+            ctx = _get_context(args, None, sink=sink)
+            stack.callback(ctx.close)
+            _profile_first(lambda: _replay(args, ctx), args.profile)()
+            return
+
+        runs = []
+        for args_ in args.clusters:
+            # The critical lane has its own connection, which never waits on the
+            # full stats, and does not wait longer than a cycle (or a critical
+            # check) to connect.
+            connect_timeout = min(DEFAULT_CONNECT_TIMEOUT_SECONDS, args_.cycle_deadline)
+            if args_.critical_interval is not None:
+                connect_timeout = min(connect_timeout, args_.critical_interval)
+
+            conn = stack.enter_context(
+                Connection(
+                    args_.cluster_uri,
+                    args_.cluster_public_key,
+                    args_.user_security_file,
+                )
+            )
+            critical_conn = stack.enter_context(
+                Connection(
+                    args_.cluster_uri,
+                    args_.cluster_public_key,
+                    args_.user_security_file,
+                    connect_timeout,
+                )
+            )
+
+            ctx = _get_context(args_, conn, critical_conn, sink)
+            stack.callback(ctx.close)
+
+            if args_.record is not None:
+                ctx.recorder = Recorder(args_.record)
+                stack.callback(ctx.recorder.close)
+
+            stack.callback(_save_state, args_, ctx)
+            _load_state(args_, ctx)
+
+            runs.append((args_, ctx))
+
+        if len(runs) == 1:
+            args, ctx = runs[0]
+            run = lambda: _run_once(args, ctx)
+        else:
+            logger.info(f"Exporting {len(runs)} clusters")
+            pool = ThreadPoolExecutor(
+                max_workers=args.max_concurrent_clusters, thread_name_prefix="cluster"
+            )
+            stack.callback(pool.shutdown)
+            run = lambda: _run_clusters(args, runs, pool)
+
+        if not args.daemon:
+            _profile_first(run, args.profile)()
+            return
+
+        logger.info(f"Running as daemon, collecting every {_tick_interval(args)}s")
+
+        stop = threading.Event()
+        _stop_on_signals(stop)
+
+        if args.critical_interval is not None:
+            logger.info(f"Checking critical stats every {args.critical_interval}s")
+
+            critical = threading.Thread(
+                target=run_forever,
+                args=(
+                    Schedule(args.critical_interval),
+                    lambda: _run_critical(args, runs),
+                    stop,
+                ),
+                name="critical",
+                daemon=True,
+            )
+            critical.start()
+
+            # Callbacks run last in, first out: stop the loop, then wait for it.
+            stack.callback(critical.join)
+            stack.callback(stop.set)
+
+        if args.sample_interval is None:
+            run_forever(
+                Schedule(_tick_interval(args)), _profile_first(run, args.profile), stop
+            )
+        else:
+            logger.info(f"Sampling metrics every {args.sample_interval}s")
+
+            # The first window ends one full interval from now.
+            publish = Schedule(args.interval)
+            publish.advance()
+
+            run_forever(
+                Schedule(args.sample_interval),
+                _profile_first(lambda: _run_sample(args, ctx, publish), args.profile),
+                stop,
+            )
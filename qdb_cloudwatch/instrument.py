@@ -0,0 +1,160 @@
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Sub-namespace, appended to --namespace, under which the exporter's own metrics go.
+SUB_NAMESPACE = "Exporter"
+
+# The exporter's own metrics are accumulated process-wide, like log records: the
+# stages they measure are spread over modules and threads.
+_lock = threading.Lock()
+_durations = defaultdict(float)
+_counters = defaultdict(int)
+
+# Profiles of the worker threads, while a `profiled()` block runs.
+_thread_profiles = None
+
+
+@contextmanager
+def timed(stage):
+    """
+    Adds the wall time spent in the `with` block to the duration of `stage`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _durations[stage] += elapsed
+
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+
+def collect():
+    """
+    Returns `(durations, counters)` accumulated since the previous call, and resets
+    them. Durations are in seconds.
+    """
+    with _lock:
+        ret = (dict(_durations), dict(_counters))
+        _durations.clear()
+        _counters.clear()
+
+    return ret
+
+
+# Unit of each counter, counters that are not listed are plain counts.
+_counter_units = {"bytes": "Bytes"}
+
+
+def to_metrics(durations, counters, dimensions):
+    """
+    Converts the output of `collect()` to CloudWatch datapoints, with `dimensions`
+    (name -> value).
+    """
+    dims = [{"Name": k, "Value": str(v)} for k, v in dimensions.items()]
+
+    ret = [
+        {
+            "MetricName": f"{stage}.duration_ms",
+            "Value": seconds * 1000,
+            "Unit": "Milliseconds",
+            "Dimensions": dims,
+        }
+        for stage, seconds in durations.items()
+    ]
+    ret.extend(
+        {
+            "MetricName": name,
+            "Value": float(n),
+            "Unit": _counter_units.get(name, "Count"),
+            "Dimensions": dims,
+        }
+        for name, n in counters.items()
+    )
+
+    return ret
+
+
+def log_summary(durations, counters):
+    stages = ", ".join(f"{k}={v * 1000:.1f}ms" for k, v in sorted(durations.items()))
+    totals = ", ".join(f"{k}={v}" for k, v in sorted(counters.items()))
+    logger.info(f"Run summary: {stages}; {totals}")
+
+
+def thread_profiled(fn):
+    """
+    Returns `fn`, wrapped so that it is profiled in the worker thread it runs on if
+    it is submitted from a `profiled()` block: cProfile only profiles the thread
+    that enables it.
+    """
+    profiles = _thread_profiles
+    if profiles is None:
+        return fn
+
+    def _fn(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # A profiler that sees every thread is already active (Python 3.12+).
+            return fn(*args, **kwargs)
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            profiler.create_stats()
+            with _lock:
+                profiles.append(profiler)
+
+    return _fn
+
+
+@contextmanager
+def profiled(directory):
+    """
+    Profiles the `with` block with cProfile and tracemalloc, and writes the results
+    to `profile.pstats` and `tracemalloc.snapshot` in `directory`.
+
+    Work submitted to other threads is only profiled if it is wrapped with
+    `thread_profiled()`, its profiles are merged into `profile.pstats`.
+    """
+    global _thread_profiles
+
+    os.makedirs(directory, exist_ok=True)
+
+    tracemalloc.start(25)
+    _thread_profiles = profiles = []
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _thread_profiles = None
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        stats = pstats.Stats(profiler)
+        with _lock:
+            for x in profiles:
+                stats.add(x)
+
+        stats.dump_stats(os.path.join(directory, "profile.pstats"))
+        snapshot.dump(os.path.join(directory, "tracemalloc.snapshot"))
+
+        logger.info(f"Wrote profile to {directory}")
@@ -0,0 +1,159 @@
+import logging
+import random
+import threading
+import time
+
+from . import instrument
+
+logger = logging.getLogger(__name__)
+
+# Default upper bound of the PutMetricData request rate, in requests per second.
+DEFAULT_MAX_RATE = 150.0
+
+# Default number of attempts of a single request, including the first one.
+DEFAULT_MAX_ATTEMPTS = 5
+
+_throttling_error_codes = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "TooManyRequestsException",
+}
+
+
+def _error_code(e):
+    return (getattr(e, "response", None) or {}).get("Error", {}).get("Code")
+
+
+def _status_code(e):
+    response = getattr(e, "response", None) or {}
+    return response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+
+
+def is_throttling(e):
+    return _error_code(e) in _throttling_error_codes
+
+
+def is_retryable(e):
+    """
+    Returns `True` for errors that may go away when retrying: throttling, server
+    side (5xx) errors and network errors.
+    """
+    if is_throttling(e):
+        return True
+
+    # Deferred like in `cloudwatch.get_client`: botocore is loaded by then anyway.
+    import botocore.exceptions
+
+    status = _status_code(e)
+    if status is not None and status >= 500:
+        return True
+
+    return isinstance(
+        e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)
+    )
+
+
+class RateLimiter:
+    """
+    Thread-safe rate limiter whose rate adapts to throttling.
+
+    This is a token bucket in its virtual-scheduling form: every request reserves
+    the next free slot, `1 / rate` seconds after the previous one, and sleeps until
+    then. The rate starts at `max_rate`. Every throttled request halves it (down to
+    `min_rate`), every successful one increases it again by a small step (up to
+    `max_rate`): the sender converges to the highest rate the account allows at the
+    time, even when it is shared with other producers.
+    """
+
+    def __init__(
+        self,
+        max_rate=DEFAULT_MAX_RATE,
+        min_rate=1.0,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        if not 0 < min_rate <= max_rate:
+            raise ValueError(
+                f"Invalid rates, expected 0 < min_rate <= max_rate, got: {min_rate}, {max_rate}"
+            )
+
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next = clock()
+
+        # Climb back from `min_rate` to `max_rate` in about a hundred successes.
+        self._step = max_rate / 100
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        with self._lock:
+            now = self._clock()
+            slot = max(now, self._next)
+            self._next = slot + 1 / self.rate
+
+        if slot > now:
+            self._sleep(slot - now)
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self._step)
+
+    def throttled(self):
+        instrument.count("api_throttles")
+
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            logger.warning(f"Throttled, lowering request rate to {self.rate:.1f}/s")
+
+
+def with_retries(
+    fn,
+    limiter=None,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+    base_delay=0.1,
+    max_delay=10.0,
+    sleep=time.sleep,
+    rng=random,
+):
+    """
+    Calls `fn()`, retrying retryable errors with exponential backoff and full jitter.
+
+    When a `limiter` is given, every attempt first waits for it and reports whether
+    it was throttled. The last error is raised once `max_attempts` are exhausted.
+    """
+    attempt = 0
+
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+
+        try:
+            ret = fn()
+        except Exception as e:
+            if limiter is not None and is_throttling(e):
+                limiter.throttled()
+
+            attempt += 1
+            if attempt >= max_attempts or not is_retryable(e):
+                raise
+
+            instrument.count("api_retries")
+            delay = rng.uniform(0, min(max_delay, base_delay * 2**attempt))
+            logger.info(f"Attempt {attempt} failed, retrying in {delay:.2f}s: {e}")
+            sleep(delay)
+            continue
+
+        if limiter is not None:
+            limiter.success()
+
+        return ret
@@ -0,0 +1,110 @@
+import logging
+import time
+
+import quasardb.stats as qdbst
+
+from .state import load_state, save_state
+
+logger = logging.getLogger(__name__)
+
+# Suffix appended to the name of a counter that is published as a per-second rate,
+# so that it does not end up in the same CloudWatch series as the raw totals.
+RATE_SUFFIX = ".rate"
+
+
+def _is_counter(k, v):
+    # `of_node` reports its own `check.*` metrics as accumulators, but they are not.
+    return (
+        v["type"] == qdbst.Type.ACCUMULATOR
+        and not k.startswith("check.")
+        and isinstance(v["value"], (int, float))
+    )
+
+
+class RateConverter:
+    """
+    Converts monotonically increasing counters (`Type.ACCUMULATOR`) into per-second
+    rates.
+
+    The previous value and its timestamp are kept per (node, uid, metric). The first
+    time a counter is seen there is nothing to compare with and it is left out. A
+    counter that went down was reset by a node restart: its current value is then
+    taken as the increase since the previous sample.
+
+    Other metrics are passed through unchanged.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+
+        # "node\tuid\tmetric" -> [value, timestamp]
+        self._prev = {}
+
+    def _rate(self, prev, key, k, v, now):
+        p = self._prev.get(key)
+        prev[key] = [v["value"], now]
+
+        if p is None:
+            return None
+
+        value, t = p
+        elapsed = now - t
+        if elapsed <= 0:
+            return None
+
+        delta = v["value"] - value
+        if delta < 0:
+            logger.info(f"Counter reset detected for {k}, assuming node restart")
+            delta = v["value"]
+
+        return {
+            "value": delta / elapsed,
+            "type": qdbst.Type.GAUGE,
+            "unit": v["unit"],
+            "rate": True,
+        }
+
+    def _convert(self, prev, prefix, metrics, now):
+        ret = {}
+
+        for k, v in metrics.items():
+            if not _is_counter(k, v):
+                ret[k] = v
+                continue
+
+            x = self._rate(prev, f"{prefix}\t{k}", k, v, now)
+            if x is not None:
+                ret[k + RATE_SUFFIX] = x
+
+        return ret
+
+    def __call__(self, stats):
+        """
+        Returns a copy of `stats` where counters are replaced by their rates.
+        """
+        now = self._clock()
+
+        # Only keep the previous samples of metrics that still exist.
+        prev = {}
+        ret = {}
+
+        for node_id, xs in stats.items():
+            ret[node_id] = {
+                "cumulative": self._convert(prev, node_id, xs["cumulative"], now),
+                "by_uid": {
+                    uid: self._convert(prev, f"{node_id}\t{uid}", xs_, now)
+                    for uid, xs_ in xs["by_uid"].items()
+                },
+            }
+
+        self._prev = prev
+        return ret
+
+    def load(self, path):
+        """
+        Restores the previous samples saved by `save()`, if `path` exists.
+        """
+        self._prev = load_state(path) or {}
+
+    def save(self, path):
+        save_state(path, self._prev)
@@ -0,0 +1,72 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Schedule:
+    """
+    Drift-free periodic schedule.
+
+    Deadlines are computed as `start + n * interval` rather than by sleeping
+    `interval` seconds after every run, so the time spent collecting does not
+    accumulate into the period. Ticks that were missed because a run overran
+    are skipped instead of being replayed back-to-back.
+    """
+
+    def __init__(self, interval, clock=time.monotonic):
+        if interval <= 0:
+            raise ValueError(f"Schedule interval must be positive, got: {interval}")
+
+        self.interval = interval
+        self._clock = clock
+        self._start = clock()
+        self._n = 0
+
+    def deadline(self):
+        """
+        Returns the (clock) time of the current tick.
+        """
+        return self._start + self._n * self.interval
+
+    def advance(self):
+        """
+        Moves to the next tick that lies in the future and returns its deadline.
+        """
+        elapsed = self._clock() - self._start
+        n = max(self._n + 1, int(elapsed // self.interval) + 1)
+
+        skipped = n - self._n - 1
+        if skipped > 0:
+            logger.warning(
+                f"Run overran its interval of {self.interval}s, skipping {skipped} tick(s)"
+            )
+
+        self._n = n
+        return self.deadline()
+
+    def remaining(self):
+        """
+        Returns the number of seconds until the current tick, or 0 when it is due.
+        """
+        return max(0.0, self.deadline() - self._clock())
+
+
+def run_forever(schedule, fn, stop=None):
+    """
+    Invokes `fn` on every tick of `schedule` until `stop` (a `threading.Event`) is set.
+
+    Exceptions raised by `fn` are logged and do not end the loop: a failing cycle
+    should not take the exporter down.
+    """
+    stop = stop or threading.Event()
+
+    while not stop.is_set():
+        try:
+            fn()
+        except Exception:
+            logger.exception("Collection cycle failed")
+
+        schedule.advance()
+        stop.wait(schedule.remaining())
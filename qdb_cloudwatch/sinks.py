@@ -0,0 +1,555 @@
+import json
+import logging
+import re
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import instrument
+from .cloudwatch import (
+    DEFAULT_MAX_IN_FLIGHT,
+    MAX_METRICS_PER_REQUEST,
+    BatchResult,
+    get_client,
+    pack_batches,
+    push_metrics,
+)
+from .ratelimit import DEFAULT_MAX_ATTEMPTS, RateLimiter, with_retries
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of metrics in a single EMF document.
+EMF_MAX_METRICS = 100
+
+# Default upper bound of the rate of the PutMetricData requests that send spooled
+# metrics, in requests per second.
+DEFAULT_DRAIN_RATE = 5.0
+
+# Default number of seconds `CloudWatchSink.close()` lets spooled metrics be sent.
+DEFAULT_DRAIN_SECONDS = 10.0
+
+# Address the Prometheus sink listens on by default.
+DEFAULT_PROMETHEUS_ADDRESS = "127.0.0.1:9150"
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class Sink:
+    """
+    Destination of CloudWatch datapoints, as returned by `_qdb_to_cloudwatch`.
+
+    `push()` returns one `BatchResult` per unit of work (request, document, ...)
+    and, when a `suppressor` is given, records the datapoints that were delivered.
+    `flush()` is called once all the pushes of a cycle are done.
+    """
+
+    def push(self, metrics, namespace, suppressor=None):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullSink(Sink):
+    """
+    Accepts datapoints without sending them anywhere, e.g. to replay recorded stats
+    through the pipeline.
+    """
+
+    def push(self, metrics, namespace, suppressor=None):
+        if suppressor is not None:
+            metrics = suppressor.select(metrics)
+            suppressor.record(metrics)
+
+        instrument.count("metrics", len(metrics))
+        return [BatchResult(0, len(metrics), None)]
+
+
+class CloudWatchSink(Sink):
+    """
+    Sends datapoints with PutMetricData, see `push_metrics`.
+
+    Without a `client`, one is created in the background: importing boto3 and
+    loading the CloudWatch service model then overlap with the collection of the
+    first stats, instead of delaying it.
+
+    With a `spool` (a `spool.Spool`), batches that could not be sent are spooled.
+    Once all the pushes of a cycle succeeded, `flush()` drains the spool in the
+    background, at most `drain_rate` requests per second, so that backfilling does
+    not compete with the current metrics. `close()` lets the drain go on for `drain_seconds`,
+    so that a one-shot run also backfills.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+        limiter=None,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        max_metrics_per_request=MAX_METRICS_PER_REQUEST,
+        spool=None,
+        drain_rate=DEFAULT_DRAIN_RATE,
+        drain_seconds=DEFAULT_DRAIN_SECONDS,
+    ):
+        self._client = client
+        self._client_future = None
+        if client is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+            self._client_future = executor.submit(get_client)
+            executor.shutdown(wait=False)
+
+        self.max_in_flight = max_in_flight
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        self.max_metrics_per_request = max_metrics_per_request
+
+        self.spool = spool
+        self.drain_seconds = drain_seconds
+        self._drain_future = None
+        # Whether a push failed since the last `flush()`.
+        self._failed = False
+        self._stop = threading.Event()
+        if spool is not None:
+            self._drain_limiter = RateLimiter(drain_rate, min(1.0, drain_rate))
+            self._drain_lane = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="drain"
+            )
+
+    @property
+    def client(self):
+        """
+        The CloudWatch client, waiting for it to be created if needed.
+        """
+        if self._client is None:
+            self._client = self._client_future.result()
+
+        return self._client
+
+    def push(self, metrics, namespace, suppressor=None):
+        ret = push_metrics(
+            metrics,
+            namespace,
+            client=self.client,
+            max_in_flight=self.max_in_flight,
+            suppressor=suppressor,
+            limiter=self.limiter,
+            max_attempts=self.max_attempts,
+            max_metrics_per_request=self.max_metrics_per_request,
+            spool=self.spool,
+        )
+
+        if any(x.error is not None for x in ret):
+            self._failed = True
+
+        return ret
+
+    def flush(self):
+        failed, self._failed = self._failed, False
+        if self.spool is not None and not failed:
+            self._start_drain()
+
+    def _start_drain(self):
+        if self._drain_future is not None and not self._drain_future.done():
+            return
+
+        if self.spool.pending_bytes() > 0:
+            self._drain_future = self._drain_lane.submit(self._drain)
+
+    def _send_spooled(self, namespace, metrics):
+        for batch in pack_batches(metrics, self.max_metrics_per_request):
+            with_retries(
+                lambda: self.client.put_metric_data(
+                    Namespace=namespace, MetricData=batch
+                ),
+                self._drain_limiter,
+                self.max_attempts,
+            )
+
+        instrument.count("backfilled_metrics", len(metrics))
+
+    def _drain(self):
+        try:
+            n = self.spool.drain(self._send_spooled, self._stop)
+        except Exception as e:
+            logger.warning(f"Stopped sending spooled metrics, will retry later: {e}")
+            return
+
+        logger.info(f"Sent {n} spooled metrics")
+
+    def close(self):
+        # Spooled batches that are not sent in time stay in the spool.
+        if self.spool is not None:
+            if self._drain_future is not None:
+                try:
+                    self._drain_future.result(timeout=self.drain_seconds)
+                except FutureTimeoutError:
+                    logger.info("Leaving the remaining spooled metrics for later")
+
+            self._stop.set()
+            self._drain_lane.shutdown(wait=True)
+
+
+def _timestamp_ms(m, now_ms):
+    ts = m.get("Timestamp")
+    if ts is None:
+        return now_ms
+
+    return int(ts.timestamp() * 1000)
+
+
+def _emf_metric(m):
+    ret = {"Name": m["MetricName"], "Unit": m["Unit"]}
+    if "StorageResolution" in m:
+        ret["StorageResolution"] = m["StorageResolution"]
+
+    return ret
+
+
+def to_emf(metrics, namespace, now_ms=None):
+    """
+    Converts datapoints to CloudWatch Embedded Metric Format documents.
+
+    Datapoints that share the same dimensions (and timestamp) go into the same
+    document, with at most `EMF_MAX_METRICS` metrics per document. Statistic sets
+    cannot be expressed in EMF and are skipped.
+    """
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    groups = {}
+    skipped = 0
+
+    for m in metrics:
+        if "Value" not in m:
+            skipped += 1
+            continue
+
+        dims = tuple((d["Name"], d["Value"]) for d in m["Dimensions"])
+        key = (dims, _timestamp_ms(m, now_ms))
+        groups.setdefault(key, []).append(m)
+
+    if skipped:
+        logger.warning(f"Skipped {skipped} statistic sets, not supported by EMF")
+
+    ret = []
+    for (dims, ts), xs in groups.items():
+        for i in range(0, len(xs), EMF_MAX_METRICS):
+            chunk = xs[i : i + EMF_MAX_METRICS]
+
+            doc = {
+                "_aws": {
+                    "Timestamp": ts,
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": namespace,
+                            "Dimensions": [[k for (k, _) in dims]],
+                            "Metrics": [_emf_metric(m) for m in chunk],
+                        }
+                    ],
+                }
+            }
+            doc.update(dims)
+            doc.update((m["MetricName"], m["Value"]) for m in chunk)
+
+            ret.append((doc, chunk))
+
+    return ret
+
+
+class _UnixSocketWriter:
+    """
+    File-like writer to a unix stream socket, reconnecting after errors.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+
+    def write(self, x):
+        try:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.connect(self.path)
+
+            self._sock.sendall(x.encode("utf-8"))
+        except OSError:
+            self.close()
+            raise
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def _open_output(output):
+    if output == "-":
+        return sys.stdout
+
+    if output.startswith("unix:"):
+        return _UnixSocketWriter(output[len("unix:") :])
+
+    return open(output, "a", encoding="utf-8")
+
+
+class EmfSink(Sink):
+    """
+    Writes datapoints as Embedded Metric Format JSON lines, to be shipped by the
+    CloudWatch agent: a push costs a local write instead of HTTPS requests.
+
+    `output` is `-` for stdout, `unix:PATH` for a unix stream socket, or a file path
+    to append to.
+    """
+
+    def __init__(self, output="-"):
+        self.output = output
+        self._out = _open_output(output)
+        self._lock = threading.Lock()
+
+    def push(self, metrics, namespace, suppressor=None):
+        if suppressor is not None:
+            metrics = suppressor.select(metrics)
+
+        docs = to_emf(metrics, namespace)
+        lines = "".join(
+            json.dumps(doc, separators=(",", ":")) + "\n" for (doc, _) in docs
+        )
+
+        logger.info(f"Writing {len(metrics)} metrics in {len(docs)} EMF documents")
+
+        try:
+            with instrument.timed("push"), self._lock:
+                self._out.write(lines)
+                self._out.flush()
+        except OSError as e:
+            logger.error(f"Failed to write EMF documents to {self.output}: {e}")
+            instrument.count("api_errors")
+            return [BatchResult(i, len(xs), e) for i, (_, xs) in enumerate(docs)]
+
+        instrument.count("batches", len(docs))
+        instrument.count("metrics", sum(len(xs) for (_, xs) in docs))
+        instrument.count("bytes", len(lines))
+
+        if suppressor is not None:
+            for _, xs in docs:
+                suppressor.record(xs)
+
+        return [BatchResult(i, len(xs), None) for i, (_, xs) in enumerate(docs)]
+
+    def close(self):
+        if self._out is not sys.stdout:
+            self._out.close()
+
+
+# CloudWatch unit -> (OpenMetrics unit, factor to that unit). Durations are converted
+# to seconds, the base unit Prometheus expects.
+_openmetrics_units = {
+    "Bytes": ("bytes", 1),
+    "Seconds": ("seconds", 1),
+    "Milliseconds": ("seconds", 1e-3),
+    "Microseconds": ("seconds", 1e-6),
+    "Bytes/Second": ("bytes_per_second", 1),
+    "Count/Second": ("per_second", 1),
+}
+
+_invalid_name_chars = re.compile(r"[^a-zA-Z0-9_]")
+_camel_case = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+
+
+def _openmetrics_name(namespace, metric_name, unit):
+    name = _invalid_name_chars.sub("_", f"{namespace}_{metric_name}")
+    if unit and not name.endswith(f"_{unit}"):
+        name = f"{name}_{unit}"
+
+    return name
+
+
+def _openmetrics_label(name):
+    # NodeId -> node_id
+    return _camel_case.sub("_", name).lower()
+
+
+def _escape_label_value(x):
+    return x.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(x):
+    return repr(float(x))
+
+
+def _openmetrics_families(series):
+    """
+    Renders `series`, a dict of `(name, unit, labels) -> value`, as OpenMetrics
+    metric families, without the final `# EOF`.
+    """
+    by_name = {}
+    for (name, unit, labels), value in series.items():
+        by_name.setdefault((name, unit), []).append((labels, value))
+
+    lines = []
+    for (name, unit), samples in sorted(by_name.items()):
+        lines.append(f"# TYPE {name} gauge")
+        if unit:
+            lines.append(f"# UNIT {name} {unit}")
+
+        for labels, value in sorted(samples):
+            if labels:
+                labels_ = ",".join(
+                    f'{k}="{_escape_label_value(v)}"' for (k, v) in labels
+                )
+                lines.append(f"{name}{{{labels_}}} {_format_value(value)}")
+            else:
+                lines.append(f"{name} {_format_value(value)}")
+
+    return "".join(f"{x}\n" for x in lines).encode("utf-8")
+
+
+def to_openmetrics(series):
+    """
+    Renders `series`, a dict of `(name, unit, labels) -> value`, as an OpenMetrics
+    text exposition. All metrics are gauges.
+    """
+    return _openmetrics_families(series) + b"# EOF\n"
+
+
+class _ScrapeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        # A reference to immutable bytes, swapped by `push()` and `flush()`: no lock needed.
+        body = self.server.sink.body
+        instrument.count("scrapes")
+
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class PrometheusSink(Sink):
+    """
+    Serves the latest datapoints on `http://<address>/metrics` in OpenMetrics text
+    format, for Prometheus (or any OpenMetrics scraper) to scrape.
+
+    Every push updates the latest value of its series, and `flush()` renders the
+    whole response body once per cycle, as bytes: a scrape sees either the previous
+    cycle or the complete current one, never part of it. A scrape only sends these
+    bytes: it never triggers a qdb read, however many scrapers there are and however
+    often they scrape. Series that have not been pushed for `max_age_seconds` are
+    dropped, e.g. those of a removed node or user.
+
+    High-resolution datapoints (`StorageResolution` 1), pushed by the critical loop
+    of --critical-interval on its own schedule, are kept in a block of their own.
+    Their push re-renders that block only, next to the last block of the cycle.
+
+    Names and units follow the CloudWatch datapoints: the namespace and metric name
+    become the metric name, dimensions become labels (`NodeId` -> `node_id`), and
+    durations are converted to seconds. Statistic sets are not supported and are
+    skipped.
+    """
+
+    def __init__(self, address=DEFAULT_PROMETHEUS_ADDRESS, max_age_seconds=None):
+        host, port = address.rsplit(":", 1)
+
+        self.max_age_seconds = max_age_seconds
+        self.body = to_openmetrics({})
+
+        # (name, unit, labels) -> (value, time it was pushed), and rendered block, of
+        # the stats of the cycle and of the high-resolution stats.
+        self._series = {}
+        self._critical = {}
+        self._block = b""
+        self._critical_block = b""
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer((host, int(port)), _ScrapeHandler)
+        self._server.daemon_threads = True
+        self._server.sink = self
+
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="prometheus", daemon=True
+        )
+        self._thread.start()
+
+        logger.info(f"Serving metrics on http://{host}:{self.port}/metrics")
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def _update(self, series, metrics, namespace, now):
+        skipped = 0
+
+        for m in metrics:
+            if "Value" not in m:
+                skipped += 1
+                continue
+
+            unit, factor = _openmetrics_units.get(m["Unit"], ("", 1))
+            name = _openmetrics_name(namespace, m["MetricName"], unit)
+            labels = tuple(
+                sorted(
+                    (_openmetrics_label(d["Name"]), d["Value"]) for d in m["Dimensions"]
+                )
+            )
+            series[(name, unit, labels)] = (m["Value"] * factor, now)
+
+        if skipped:
+            logger.warning(f"Skipped {skipped} statistic sets, not supported")
+
+        if self.max_age_seconds is not None:
+            oldest = now - self.max_age_seconds
+            for k in [k for k, (_, t) in series.items() if t < oldest]:
+                del series[k]
+
+    def _render(self, series):
+        return _openmetrics_families({k: value for k, (value, _) in series.items()})
+
+    def push(self, metrics, namespace, suppressor=None):
+        if suppressor is not None:
+            metrics = suppressor.select(metrics)
+
+        critical = [m for m in metrics if m.get("StorageResolution") == 1]
+        now = time.monotonic()
+
+        with instrument.timed("push"), self._lock:
+            if len(critical) < len(metrics):
+                others = [m for m in metrics if m.get("StorageResolution") != 1]
+                self._update(self._series, others, namespace, now)
+
+            if critical:
+                self._update(self._critical, critical, namespace, now)
+                self._critical_block = self._render(self._critical)
+                self.body = self._block + self._critical_block + b"# EOF\n"
+
+        instrument.count("metrics", len(metrics))
+
+        if suppressor is not None:
+            suppressor.record(metrics)
+
+        return [BatchResult(0, len(metrics), None)]
+
+    def flush(self):
+        with instrument.timed("render"), self._lock:
+            self._block = self._render(self._series)
+            self.body = self._block + self._critical_block + b"# EOF\n"
+
+        instrument.count("bytes", len(self.body))
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
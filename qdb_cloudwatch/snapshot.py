@@ -0,0 +1,144 @@
+import json
+import logging
+import struct
+import time
+import zlib
+
+import quasardb.stats as qdbst
+
+logger = logging.getLogger(__name__)
+
+# First bytes of a snapshot file, the last one is the format version.
+MAGIC = b"QDBSNAP\x01"
+
+# Every frame is prefixed with the size of its payload.
+_frame_header = struct.Struct(">I")
+
+
+def _enum_value(x):
+    # Stats whose type or unit could not be read have None instead.
+    return None if x is None else x.value
+
+
+def _enum(cls, x):
+    return None if x is None else cls(x)
+
+
+def _encode_metrics(xs):
+    return {
+        k: [v["value"], _enum_value(v["type"]), _enum_value(v["unit"])]
+        for k, v in xs.items()
+    }
+
+
+def _decode_metrics(xs):
+    return {
+        k: {
+            "value": value,
+            "type": _enum(qdbst.Type, type_),
+            "unit": _enum(qdbst.Unit, unit),
+        }
+        for k, (value, type_, unit) in xs.items()
+    }
+
+
+def encode(timestamp, stats):
+    """
+    Serializes `stats`, as returned by `get_all_stats`, to a single frame.
+
+    The payload is zlib-compressed JSON. Metrics are `[value, type, unit]` lists
+    with enums as integers (or null), and uids are kept in lists of pairs, as JSON object keys
+    could only be strings.
+    """
+    x = [
+        timestamp,
+        [
+            [
+                node_id,
+                _encode_metrics(xs["cumulative"]),
+                [[uid, _encode_metrics(xs_)] for uid, xs_ in xs["by_uid"].items()],
+            ]
+            for node_id, xs in stats.items()
+        ],
+    ]
+    payload = zlib.compress(json.dumps(x, separators=(",", ":")).encode("utf-8"))
+
+    return _frame_header.pack(len(payload)) + payload
+
+
+def decode(payload):
+    """
+    Returns the `(timestamp, stats)` of a frame payload, see `encode()`.
+    """
+    timestamp, nodes = json.loads(zlib.decompress(payload))
+
+    return (
+        timestamp,
+        {
+            node_id: {
+                "cumulative": _decode_metrics(cumulative),
+                "by_uid": {uid: _decode_metrics(xs) for uid, xs in by_uid},
+            }
+            for node_id, cumulative, by_uid in nodes
+        },
+    )
+
+
+class Recorder:
+    """
+    Appends timestamped stats snapshots to the file at `path`.
+
+    Every snapshot is flushed as a self-contained frame, so that the file can be
+    read while it is still being written, and a crash loses at most the last one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "ab")
+
+        if self._fp.tell() == 0:
+            self._fp.write(MAGIC)
+        else:
+            with open(path, "rb") as fp:
+                if fp.read(len(MAGIC)) != MAGIC:
+                    self._fp.close()
+                    raise ValueError(f"Not a stats snapshot file: {path}")
+
+        logger.info(f"Recording stats snapshots to {path}")
+
+    def write(self, stats, timestamp=None):
+        frame = encode(time.time() if timestamp is None else timestamp, stats)
+
+        self._fp.write(frame)
+        self._fp.flush()
+
+        return len(frame)
+
+    def close(self):
+        self._fp.close()
+
+
+def read_snapshots(path):
+    """
+    Yields the `(timestamp, stats)` snapshots of the file at `path`, in the order
+    they were recorded. A truncated last frame, as left by a crash, is ignored.
+    """
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a stats snapshot file: {path}")
+
+        while True:
+            header = fp.read(_frame_header.size)
+            if not header:
+                return
+
+            payload = None
+            if len(header) == _frame_header.size:
+                (size,) = _frame_header.unpack(header)
+                payload = fp.read(size)
+
+            if payload is None or len(payload) < size:
+                logger.warning(f"Ignoring truncated snapshot at the end of {path}")
+                return
+
+            yield decode(payload)
@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+
+from . import instrument
+
+logger = logging.getLogger(__name__)
+
+# Default upper bound of the size of the spool on disk.
+DEFAULT_SPOOL_MAX_BYTES = 100 * 1024 * 1024
+
+# Size after which a segment is closed and a new one is started.
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+
+# CloudWatch rejects datapoints older than two weeks, keep a margin.
+MAX_BACKFILL_AGE = timedelta(days=14) - timedelta(hours=1)
+
+_segment_name = re.compile(r"^segment-(\d+)\.jsonl$")
+
+
+def _encode(namespace, metrics):
+    return json.dumps(
+        {
+            "namespace": namespace,
+            "metrics": [
+                {**m, "Timestamp": m["Timestamp"].timestamp()} for m in metrics
+            ],
+        },
+        separators=(",", ":"),
+    )
+
+
+def _decode(line):
+    x = json.loads(line)
+    for m in x["metrics"]:
+        m["Timestamp"] = datetime.fromtimestamp(m["Timestamp"], timezone.utc)
+
+    return x["namespace"], x["metrics"]
+
+
+def _decode_fresh(line, oldest):
+    """
+    Returns the namespace of a spooled batch and its datapoints that are not older
+    than `oldest`.
+    """
+    try:
+        namespace, metrics = _decode(line)
+    except ValueError:
+        # E.g. a line cut short by a crash.
+        logger.warning(f"Skipping unreadable spooled batch: {line!r}")
+        return None, []
+
+    fresh = [m for m in metrics if m["Timestamp"] >= oldest]
+    if len(fresh) < len(metrics):
+        instrument.count("spool_expired", len(metrics) - len(fresh))
+
+    return namespace, fresh
+
+
+class Spool:
+    """
+    Bounded, append-only spool of PutMetricData batches on disk, to backfill them
+    once CloudWatch can be reached again.
+
+    Batches are appended as JSON lines to segment files in `directory`. A segment is
+    closed once it reaches `segment_bytes`, and the oldest segments are evicted when
+    the spool grows beyond `max_bytes`. Every datapoint must carry its `Timestamp`,
+    so that it lands where it belongs when it is eventually sent.
+
+    `drain()` sends the batches oldest first, and removes a segment only once all of
+    its batches were sent: batches may be sent twice after a crash, never lost.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_bytes=DEFAULT_SPOOL_MAX_BYTES,
+        segment_bytes=DEFAULT_SEGMENT_BYTES,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max_bytes)
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+
+        # Sequence number -> size of the segments, oldest first.
+        self._segments = {}
+        for name in sorted(os.listdir(directory)):
+            m = _segment_name.match(name)
+            if m:
+                self._segments[int(m.group(1))] = os.path.getsize(
+                    os.path.join(directory, name)
+                )
+
+        # Segment being appended to, and segment being drained, if any.
+        self._active = None
+        self._draining = None
+
+        if self._segments:
+            logger.info(
+                f"Found {self.pending_bytes()} bytes of spooled metrics in {directory}"
+            )
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f"segment-{seq:012d}.jsonl")
+
+    def pending_bytes(self):
+        with self._lock:
+            return sum(self._segments.values())
+
+    def _evict(self):
+        while sum(self._segments.values()) > self.max_bytes:
+            # The segment being appended to holds the latest batch, the one being
+            # drained is released by `drain()`.
+            candidates = [
+                x for x in self._segments if x not in (self._active, self._draining)
+            ]
+            if not candidates:
+                return
+
+            seq = candidates[0]
+            logger.warning(f"Spool is full, evicting its oldest segment {seq}")
+            instrument.count("spool_evicted_bytes", self._segments.pop(seq))
+            os.remove(self._path(seq))
+
+    def append(self, namespace, metrics):
+        """
+        Appends a batch of datapoints, which must all have a `Timestamp`.
+        """
+        line = _encode(namespace, metrics) + "\n"
+
+        with self._lock:
+            if (
+                self._active is None
+                or self._segments.get(self._active, 0) >= self.segment_bytes
+            ):
+                self._active = max(self._segments, default=0) + 1
+                self._segments[self._active] = 0
+
+            with open(self._path(self._active), "a", encoding="utf-8") as fp:
+                fp.write(line)
+
+            self._segments[self._active] += len(line)
+            self._evict()
+
+        instrument.count("spooled_metrics", len(metrics))
+
+    def _take_oldest(self):
+        with self._lock:
+            if not self._segments:
+                return None
+
+            seq = next(iter(self._segments))
+            if seq == self._active:
+                # Further batches go to a new segment.
+                self._active = None
+
+            self._draining = seq
+            return seq
+
+    def _release(self, seq, remaining):
+        with self._lock:
+            self._draining = None
+            if seq not in self._segments:
+                # Evicted in the meantime.
+                return
+
+            path = self._path(seq)
+            if not remaining:
+                os.remove(path)
+                del self._segments[seq]
+                return
+
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as fp:
+                fp.writelines(remaining)
+
+            os.replace(tmp, path)
+            self._segments[seq] = os.path.getsize(path)
+
+    def drain(self, send, stop=None):
+        """
+        Sends spooled batches, oldest first, with `send(namespace, metrics)`, until
+        the spool is empty, `send` raises or `stop` (a `threading.Event`) is set.
+        Returns the number of datapoints sent.
+
+        Datapoints older than `MAX_BACKFILL_AGE` would be rejected, and are dropped.
+        """
+        sent = 0
+
+        while stop is None or not stop.is_set():
+            seq = self._take_oldest()
+            if seq is None:
+                return sent
+
+            with open(self._path(seq), "r", encoding="utf-8") as fp:
+                lines = fp.readlines()
+
+            oldest = datetime.now(timezone.utc) - MAX_BACKFILL_AGE
+            done = 0
+
+            try:
+                for line in lines:
+                    if stop is not None and stop.is_set():
+                        break
+
+                    namespace, metrics = _decode_fresh(line, oldest)
+                    if metrics:
+                        send(namespace, metrics)
+                        sent += len(metrics)
+
+                    done += 1
+            finally:
+                self._release(seq, lines[done:])
+
+            if done < len(lines):
+                return sent
+
+        return sent
@@ -0,0 +1,35 @@
+import gzip
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def load_state(path):
+    """
+    Returns the object saved at `path` by `save_state()`, or None if there is none.
+
+    An unreadable file is logged and ignored: state only saves work, it is never
+    required for correctness.
+    """
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        logger.info(f"No state found at {path}, starting afresh")
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable state {path}: {e}")
+
+    return None
+
+
+def save_state(path, x):
+    """
+    Writes `x` to `path` as gzipped JSON, atomically.
+    """
+    tmp = f"{path}.tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as fp:
+        json.dump(x, fp, separators=(",", ":"))
+
+    os.replace(tmp, path)
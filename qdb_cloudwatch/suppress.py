@@ -0,0 +1,92 @@
+import logging
+
+from .state import load_state, save_state
+
+logger = logging.getLogger(__name__)
+
+# Number of cycles after which an unchanged metric is sent anyway by default.
+DEFAULT_HEARTBEAT_CYCLES = 10
+
+
+def _metric_key(m):
+    dims = ",".join(f"{d['Name']}={d['Value']}" for d in m.get("Dimensions", []))
+    return f"{m['MetricName']}\t{dims}"
+
+
+class Suppressor:
+    """
+    Skips CloudWatch datapoints whose value did not change since it was last sent.
+
+    The last value sent is remembered per (metric, dimensions) key. A datapoint is
+    suppressed when it differs from that value by at most `tolerance` (relative,
+    e.g. 0.01 for 1%), unless it has not been sent for `heartbeat` cycles: the
+    heartbeat keeps alarms from going to INSUFFICIENT_DATA.
+
+    Keys that are not seen during a cycle are forgotten, which keeps the state
+    bounded to the metrics that currently exist.
+    """
+
+    def __init__(self, tolerance=0.0, heartbeat=DEFAULT_HEARTBEAT_CYCLES):
+        if tolerance < 0:
+            raise ValueError(f"Tolerance must not be negative, got: {tolerance}")
+
+        if heartbeat < 1:
+            raise ValueError(f"Heartbeat must be at least 1 cycle, got: {heartbeat}")
+
+        self.tolerance = tolerance
+        self.heartbeat = heartbeat
+
+        # key -> [last value sent, number of cycles since it was sent]
+        self._state = {}
+
+    def _unchanged(self, old, new):
+        return abs(new - old) <= self.tolerance * abs(old)
+
+    def select(self, metrics):
+        """
+        Returns the subset of `metrics` that should be sent this cycle.
+
+        Call `record()` with the metrics that were actually sent afterwards.
+        """
+        state = {}
+        ret = []
+
+        for m in metrics:
+            if "Value" not in m:
+                # Statistic sets etc. are always sent.
+                ret.append(m)
+                continue
+
+            key = _metric_key(m)
+            prev = self._state.get(key)
+
+            if prev is not None:
+                value, age = prev
+                state[key] = [value, age + 1]
+
+                if age + 1 < self.heartbeat and self._unchanged(value, m["Value"]):
+                    continue
+
+            ret.append(m)
+
+        self._state = state
+
+        logger.info(f"Suppressed {len(metrics) - len(ret)} unchanged metrics")
+        return ret
+
+    def record(self, metrics):
+        """
+        Remembers the values of `metrics` as sent during this cycle.
+        """
+        for m in metrics:
+            if "Value" in m:
+                self._state[_metric_key(m)] = [m["Value"], 0]
+
+    def load(self, path):
+        """
+        Restores the state saved by `save()`, if `path` exists.
+        """
+        self._state = load_state(path) or {}
+
+    def save(self, path):
+        save_state(path, self._state)
@@ -0,0 +1,142 @@
+import heapq
+import logging
+
+import quasardb.stats as qdbst
+
+from . import instrument
+from .state import load_state, save_state
+
+logger = logging.getLogger(__name__)
+
+# UserId under which the metrics of all the users that are not in the top K go.
+OTHER_USER_ID = "other"
+
+# Default metric by which users are ranked.
+DEFAULT_RANK_METRIC = "requests.total_count"
+
+
+def _sum_metrics(groups):
+    """
+    Sums metrics by name over several uids. Type and unit are those of the first
+    occurrence, non-numeric values (labels) are left out.
+    """
+    ret = {}
+
+    for xs in groups:
+        for k, v in xs.items():
+            if not isinstance(v["value"], (int, float)):
+                continue
+
+            x = ret.get(k)
+            if x is None:
+                ret[k] = dict(v)
+            else:
+                x["value"] += v["value"]
+
+    return ret
+
+
+class TopUsers:
+    """
+    Keeps the per-user metrics of the `k` most active users of every node, and sums
+    all the other users into a single `UserId=other` group.
+
+    Users are ranked by the `by` metric. When it is a counter, they are ranked by
+    its increase since the previous call rather than by its total, so that users
+    that were busy once but are now idle drop out of the top. Users that do not
+    report the metric rank last. The ranking is a bounded heap of `k` entries,
+    streamed over the users of a node.
+
+    `rank()` and `rollup()` are separate so that users can be ranked on the raw
+    stats, before the rank metric is filtered out or converted to a rate.
+    """
+
+    def __init__(self, k, by=DEFAULT_RANK_METRIC):
+        if k < 1:
+            raise ValueError(f"Invalid number of users, expected k >= 1, got: {k}")
+
+        self.k = k
+        self.by = by
+
+        # "node\tuid" -> previous value of the rank metric, for counters.
+        self._prev = {}
+
+    def _activity(self, prev, node_id, uid, xs):
+        v = xs.get(self.by)
+        if v is None or not isinstance(v["value"], (int, float)):
+            return float("-inf")
+
+        if v["type"] != qdbst.Type.ACCUMULATOR:
+            return v["value"]
+
+        key = f"{node_id}\t{uid}"
+        p = self._prev.get(key)
+        prev[key] = v["value"]
+
+        # Counter reset (node restart): the current value is the increase.
+        if p is None or v["value"] < p:
+            return v["value"]
+
+        return v["value"] - p
+
+    def rank(self, stats):
+        """
+        Returns the uids of the `k` most active users of every node, as a dict of
+        node_id -> set of uids.
+        """
+        prev = {}
+        ret = {}
+
+        for node_id, xs in stats.items():
+            activity = (
+                (self._activity(prev, node_id, uid, xs_), uid)
+                for uid, xs_ in xs["by_uid"].items()
+            )
+            ret[node_id] = {
+                uid for (_, uid) in heapq.nlargest(self.k, activity, key=lambda x: x[0])
+            }
+
+        self._prev = prev
+        return ret
+
+    def rollup(self, stats, top):
+        """
+        Returns a copy of `stats` where the users of every node that are not in
+        `top[node_id]` are summed into `OTHER_USER_ID`.
+        """
+        ret = {}
+
+        for node_id, xs in stats.items():
+            keep = top.get(node_id, ())
+            by_uid = {}
+            others = []
+
+            for uid, xs_ in xs["by_uid"].items():
+                if uid in keep:
+                    by_uid[uid] = xs_
+                else:
+                    others.append(xs_)
+
+            if others:
+                by_uid[OTHER_USER_ID] = _sum_metrics(others)
+                logger.debug(
+                    f"Rolled up {len(others)} users of node {node_id} into '{OTHER_USER_ID}'"
+                )
+
+            instrument.count("users_rolled_up", len(others))
+            ret[node_id] = {"cumulative": xs["cumulative"], "by_uid": by_uid}
+
+        return ret
+
+    def __call__(self, stats):
+        return self.rollup(stats, self.rank(stats))
+
+    def load(self, path):
+        """
+        Restores the previous values of the rank metric saved by `save()`, if `path`
+        exists.
+        """
+        self._prev = load_state(path) or {}
+
+    def save(self, path):
+        save_state(path, self._prev)
@@ -5,6 +5,7 @@ import pprint
 
 import pytest
 import quasardb
+import quasardb.stats as qdbst
 
 from qdb_cloudwatch.check import get_all_stats
 
@@ -90,3 +91,177 @@ def stats(qdbd_settings):
         qdbd_settings.get("security").get("cluster_public_key_file"),
         qdbd_settings.get("security").get("user_security_file"),
     )
+
+
+def _gauge(value, unit=None):
+    return {
+        "value": value,
+        "type": qdbst.Type.GAUGE,
+        "unit": unit if unit is not None else qdbst.Unit.COUNT,
+    }
+
+
+def _make_stats(n_metrics=100, n_uids=0, node_id="127.0.0.1:2836"):
+    """
+    Builds stats shaped like `get_all_stats` output, without needing a qdbd.
+    """
+    return {
+        node_id: {
+            "cumulative": {f"metric.{i}": _gauge(i) for i in range(n_metrics)},
+            "by_uid": {
+                uid: {f"metric.{i}": _gauge(i) for i in range(n_metrics)}
+                for uid in range(n_uids)
+            },
+        }
+    }
+
+
+@pytest.fixture
+def make_stats():
+    return _make_stats
+
+
+class FakeEntry:
+    """
+    In-memory stand-in for the direct integer/blob entries of a `quasardb.Node`.
+    """
+
+    def __init__(self, store, key, kind):
+        self._store = store
+        self._key = key
+        self._kind = kind
+
+    def get(self):
+        if self._key not in self._store:
+            raise quasardb.AliasNotFoundError(self._key)
+
+        value = self._store[self._key]
+        if not isinstance(value, self._kind):
+            raise quasardb.IncompatibleTypeError(self._key)
+
+        return value
+
+    def put(self, value):
+        if self._key in self._store:
+            raise quasardb.AliasAlreadyExistsError(self._key)
+
+        self._store[self._key] = value
+
+    def update(self, value):
+        self._store[self._key] = value
+
+    def remove(self):
+        if self._store.pop(self._key, None) is None:
+            raise quasardb.AliasNotFoundError(self._key)
+
+
+class FakeNode:
+    """
+    In-memory stand-in for `quasardb.Node`, enough for `quasardb.stats.of_node`.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def prefix_get(self, prefix, n):
+        return [k for k in self.store if k.startswith(prefix)][:n]
+
+    def integer(self, key):
+        return FakeEntry(self.store, key, int)
+
+    def blob(self, key):
+        return FakeEntry(self.store, key, bytes)
+
+
+class FakeConnection:
+    """
+    In-memory stand-in for `check.Connection`, serving one `FakeNode` per endpoint.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.forgotten = []
+        self.resets = 0
+
+    def endpoints(self):
+        return list(self.nodes)
+
+    def node(self, endpoint):
+        return self.nodes[endpoint]
+
+    def forget_node(self, endpoint):
+        self.forgotten.append(endpoint)
+
+    def reset(self):
+        self.resets += 1
+
+    def close(self):
+        pass
+
+
+class FakeCluster:
+    """
+    In-memory stand-in for `quasardb.Cluster`, opening a new `FakeNode` handle on
+    every `node()` call.
+    """
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.opened = []
+        self.closed = False
+
+    def endpoints(self):
+        return list(self.stores)
+
+    def node(self, endpoint):
+        self.opened.append(endpoint)
+        return FakeNode(self.stores[endpoint])
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_clusters(monkeypatch):
+    """
+    Replaces `quasardb.Cluster`, and returns the list of the clusters opened since.
+    """
+    ret = []
+
+    def _cluster(uri, **kwargs):
+        ret.append(FakeCluster({"127.0.0.1:2836": _node_store()}))
+        return ret[-1]
+
+    monkeypatch.setattr(quasardb, "Cluster", _cluster)
+    return ret
+
+
+def _node_store(n_uids=2):
+    """
+    Returns the entries of a node holding a few statistics, as qdbd lays them out.
+    """
+    ret = {
+        "$qdb.statistics.startup_epoch": 1700000000,
+        "$qdb.statistics.startup_epoch.type": b"gauge",
+        "$qdb.statistics.startup_epoch.unit": b"epoch",
+    }
+
+    metrics = {
+        "requests.total_count": (b"accumulator", b"count", 1000),
+        "memory.vm.used": (b"gauge", b"bytes", 4096),
+        "engine.latency": (b"gauge", b"nanoseconds", 123456),
+    }
+
+    for name, (type_, unit, value) in metrics.items():
+        for suffix in [""] + [f".uid_{uid}" for uid in range(n_uids)]:
+            k = f"$qdb.statistics.{name}{suffix}"
+            ret[k] = value
+            ret[f"{k}.type"] = type_
+            ret[f"{k}.unit"] = unit
+
+    return ret
+
+
+@pytest.fixture
+def fake_conn():
+    return FakeConnection({"127.0.0.1:2836": FakeNode(_node_store())})
@@ -0,0 +1,48 @@
+import pytest
+
+from qdb_cloudwatch.aggregate import Aggregator
+from qdb_cloudwatch.cloudwatch import _qdb_to_cloudwatch
+
+
+def test_aggregate_statistic_sets(make_stats):
+    agg = Aggregator()
+
+    for value in [3.0, 1.0, 2.0]:
+        stats = make_stats(n_metrics=2, n_uids=1)
+        for node in stats.values():
+            node["cumulative"]["metric.0"]["value"] = value
+        agg.add(_qdb_to_cloudwatch(stats))
+
+    metrics = agg.flush()
+
+    # 2 cumulative + 2 per-uid series, one statistic set each
+    assert len(metrics) == 4
+    assert all("Value" not in m for m in metrics)
+
+    (m,) = [
+        m
+        for m in metrics
+        if m["MetricName"] == "metric.0" and len(m["Dimensions"]) == 1
+    ]
+    assert m["StatisticValues"] == {
+        "SampleCount": 3.0,
+        "Sum": 6.0,
+        "Minimum": 1.0,
+        "Maximum": 3.0,
+    }
+
+
+def test_aggregate_flush_starts_new_window(make_stats):
+    agg = Aggregator()
+    agg.add(_qdb_to_cloudwatch(make_stats(n_metrics=2)))
+
+    assert len(agg.flush()) == 2
+    assert agg.flush() == []
+
+
+def test_aggregate_bounded_series(make_stats):
+    agg = Aggregator(max_series=5)
+    agg.add(_qdb_to_cloudwatch(make_stats(n_metrics=10)))
+
+    assert len(agg) == 5
+    assert len(agg.flush()) == 5
@@ -0,0 +1,24 @@
+import pytest
+
+from benchmarks import run
+from benchmarks.synthetic import cluster_stats
+
+
+def test_synthetic_stats_shape():
+    stats = cluster_stats(n_nodes=2, n_uids=3, n_metrics=10)
+
+    assert len(stats) == 2
+    for xs in stats.values():
+        assert sorted(xs) == ["by_uid", "cumulative"]
+        assert len(xs["by_uid"]) == 3
+        assert "check.online" in xs["cumulative"]
+
+
+def test_benchmarks_run():
+    results = run.run(n_uids=2, n_metrics=10, repeat=1)
+
+    assert len(results) == 6
+    for x in results:
+        assert x["datapoints"] > 0
+        assert x["peak_bytes"] > 0
+        assert x["allocated_blocks"] > 0
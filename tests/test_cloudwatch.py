@@ -0,0 +1,219 @@
+import threading
+import time
+
+import pytest
+import quasardb.stats as qdbst
+from botocore.exceptions import EndpointConnectionError
+from conftest import _gauge, _make_stats
+
+from qdb_cloudwatch.cloudwatch import (
+    COMPRESSION_MIN_BYTES,
+    MAX_REQUEST_BYTES,
+    MetricConverter,
+    _metric_size,
+    _qdb_to_cloudwatch,
+    _payload_size,
+    get_client,
+    pack_batches,
+    push_metrics,
+    push_stats,
+    send_batches,
+)
+from qdb_cloudwatch.spool import Spool
+
+
+class FakeClient:
+    def __init__(self, delay=0.0, fail_on=()):
+        self.delay = delay
+        self.fail_on = fail_on
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def put_metric_data(self, Namespace, MetricData):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            index = len(self.requests)
+            self.requests.append((Namespace, MetricData))
+
+        try:
+            time.sleep(self.delay)
+            if index in self.fail_on:
+                raise RuntimeError("throttled")
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def test_send_batches_bounded_concurrency():
+    client = FakeClient(delay=0.05)
+    batches = [[{"MetricName": "x", "Value": 1.0}]] * 16
+
+    start = time.monotonic()
+    results = send_batches(client, "ns", batches, max_in_flight=4)
+    elapsed = time.monotonic() - start
+
+    assert len(results) == 16
+    assert all(x.error is None for x in results)
+    assert client.max_in_flight == 4
+    # 16 requests, 4 at a time: about 4 round trips instead of 16
+    assert elapsed < 16 * 0.05
+
+
+def test_send_batches_reports_errors_per_batch():
+    client = FakeClient(fail_on=(0,))
+    batches = [[{"MetricName": "x", "Value": 1.0}]] * 3
+
+    results = send_batches(client, "ns", batches, max_in_flight=1)
+
+    assert [x.index for x in results] == [0, 1, 2]
+    assert isinstance(results[0].error, RuntimeError)
+    assert results[1].error is None
+    assert results[2].error is None
+
+
+def test_push_stats_sends_all_metrics(make_stats):
+    client = FakeClient()
+
+    results = push_stats(make_stats(100), "ns", client=client)
+
+    assert sum(x.size for x in results) == 100
+    assert sum(len(req[1]) for req in client.requests) == 100
+
+
+def _metric(i, n_dims=2):
+    return {
+        "MetricName": f"metric.{i}",
+        "Value": float(i),
+        "Unit": "Count",
+        "Dimensions": [{"Name": f"Dim{j}", "Value": "x" * 10} for j in range(n_dims)],
+    }
+
+
+def test_pack_batches_fills_up_to_count_limit():
+    batches = pack_batches([_metric(i) for i in range(2500)])
+
+    assert [len(x) for x in batches] == [1000, 1000, 500]
+
+
+def test_pack_batches_respects_byte_limit():
+    metrics = [_metric(i, n_dims=30) for i in range(1000)]
+    batches = pack_batches(metrics)
+
+    assert len(batches) > 1
+    assert sum(len(x) for x in batches) == 1000
+    assert all(_payload_size(x) <= MAX_REQUEST_BYTES for x in batches)
+
+
+def test_pack_batches_keeps_oversized_metric():
+    batches = pack_batches([_metric(0), _metric(1)], max_bytes=100)
+
+    assert [len(x) for x in batches] == [1, 1]
+
+
+def test_metric_size_is_an_upper_bound():
+    # Actual form-encoded size of a datapoint at the highest member indices.
+    m = _metric(123, n_dims=2)
+    prefix = "MetricData.member.1000."
+    fields = {
+        prefix + "MetricName": m["MetricName"],
+        prefix + "Value": repr(m["Value"]),
+        prefix + "Unit": m["Unit"],
+    }
+    for j, d in enumerate(m["Dimensions"], 1):
+        fields[f"{prefix}Dimensions.member.{j}.Name"] = d["Name"]
+        fields[f"{prefix}Dimensions.member.{j}.Value"] = d["Value"]
+
+    actual = len("&".join(f"{k}={v}" for k, v in fields.items()))
+
+    assert actual <= _metric_size(m)
+
+
+def test_get_client_compresses_requests(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    config = get_client().meta.config
+
+    assert config.disable_request_compression is False
+    assert config.request_min_compression_size_bytes == COMPRESSION_MIN_BYTES
+
+
+def _mixed_stats(n_uids=3):
+    stats = _make_stats(n_metrics=5, n_uids=n_uids)
+    xs = stats["127.0.0.1:2836"]["cumulative"]
+    xs["cpu.user"] = _gauge(10)
+    xs["latency"] = _gauge(1500, qdbst.Unit.NANOSECONDS)
+    xs["version"] = _gauge("3.14.3")
+    xs["requests.rate"] = dict(_gauge(7, qdbst.Unit.COUNT), rate=True)
+    return stats
+
+
+def test_metric_converter_matches_qdb_to_cloudwatch():
+    converter = MetricConverter()
+    stats = _mixed_stats()
+
+    for _ in range(2):
+        assert converter(stats) == _qdb_to_cloudwatch(stats)
+
+
+def test_metric_converter_fills_in_values():
+    converter = MetricConverter()
+    converter(_make_stats(n_metrics=2))
+
+    stats = _make_stats(n_metrics=2)
+    stats["127.0.0.1:2836"]["cumulative"]["metric.1"]["value"] = 42
+
+    assert [m["Value"] for m in converter(stats)] == [0.0, 42.0]
+
+
+def test_metric_converter_shares_dimensions():
+    converter = MetricConverter()
+
+    first = converter(_make_stats(n_metrics=3, n_uids=1))
+    second = converter(_make_stats(n_metrics=3, n_uids=1))
+
+    assert all(m["Dimensions"] is first[0]["Dimensions"] for m in first[:3])
+    assert all(a["Dimensions"] is b["Dimensions"] for a, b in zip(first, second))
+    assert all(a is not b for a, b in zip(first, second))
+
+
+def test_metric_converter_evicts_missing_series():
+    converter = MetricConverter()
+    converter(_make_stats(n_metrics=5, n_uids=3))
+
+    metrics = converter(_make_stats(n_metrics=2, n_uids=1))
+
+    assert len(metrics) == 4
+    assert len(converter._templates) == 4
+    assert len(converter._dims) == 2
+
+
+class UnreachableClient:
+    def put_metric_data(self, Namespace, MetricData):
+        raise EndpointConnectionError(endpoint_url="https://monitoring")
+
+
+def test_push_metrics_spools_failed_batches(tmp_path):
+    spool = Spool(tmp_path)
+    metrics = [_metric(i) for i in range(3)]
+
+    results = push_metrics(
+        metrics, "ns", client=UnreachableClient(), max_attempts=1, spool=spool
+    )
+
+    assert results[0].error is not None
+    sent = []
+    spool.drain(lambda namespace, xs: sent.extend(xs))
+    assert [m["MetricName"] for m in sent] == ["metric.0", "metric.1", "metric.2"]
+    assert all(m["Timestamp"].tzinfo is not None for m in sent)
+
+
+def test_push_metrics_does_not_spool_rejected_batches(tmp_path):
+    spool = Spool(tmp_path)
+
+    push_metrics(
+        [_metric(0)], "ns", client=FakeClient(fail_on=(0,)), max_attempts=1, spool=spool
+    )
+
+    assert spool.pending_bytes() == 0
@@ -0,0 +1,82 @@
+import pytest
+import quasardb.stats as qdbst
+
+from qdb_cloudwatch import columnar
+from qdb_cloudwatch.check import Filter
+from qdb_cloudwatch.cloudwatch import _qdb_to_cloudwatch
+
+
+def _key(m):
+    return (
+        m["MetricName"],
+        m["Value"],
+        m["Unit"],
+        tuple((d["Name"], d["Value"]) for d in m["Dimensions"]),
+    )
+
+
+def _stats(make_stats):
+    stats = make_stats(n_metrics=20, n_uids=5)
+
+    for xs in stats.values():
+        xs["cumulative"]["requests.latency_ns"] = {
+            "value": 12345,
+            "type": qdbst.Type.GAUGE,
+            "unit": qdbst.Unit.NANOSECONDS,
+        }
+        xs["cumulative"]["cpu.user"] = {
+            "value": 1,
+            "type": qdbst.Type.GAUGE,
+            "unit": qdbst.Unit.NONE,
+        }
+        xs["cumulative"]["engine.version"] = {
+            "value": "3.14.3",
+            "type": qdbst.Type.LABEL,
+            "unit": qdbst.Unit.NONE,
+        }
+
+    return stats
+
+
+@pytest.mark.parametrize(
+    "include, exclude",
+    [(None, None), ([r"metric\.1"], None), (None, [r"metric\.1"]), ([r"^r"], None)],
+)
+def test_columnar_matches_dict_pipeline(make_stats, include, exclude):
+    stats = _stats(make_stats)
+    f = Filter(include=include, exclude=exclude)
+
+    expected = sorted(_key(m) for m in _qdb_to_cloudwatch(f(stats)))
+    actual = sorted(_key(m) for m in columnar.to_cloudwatch(stats, f))
+
+    assert actual == expected
+
+
+def test_columnar_converts_nanoseconds(make_stats):
+    metrics = columnar.to_cloudwatch(_stats(make_stats), Filter(include=["latency"]))
+
+    assert len(metrics) == 1
+    assert metrics[0]["Value"] == 12.345
+    assert metrics[0]["Unit"] == "Microseconds"
+
+
+def test_columnar_filters_while_flattening(make_stats):
+    frame = columnar.Frame.from_stats(_stats(make_stats), Filter(include=["latency"]))
+
+    assert frame.metrics == ["requests.latency_ns"]
+    assert len(frame) == 1
+
+
+def test_columnar_without_unit(make_stats):
+    stats = make_stats(n_metrics=2)
+    for xs in stats.values():
+        xs["cumulative"]["metric.0"]["unit"] = None
+
+    expected = sorted(_key(m) for m in _qdb_to_cloudwatch(stats))
+    actual = sorted(_key(m) for m in columnar.to_cloudwatch(stats, Filter()))
+
+    assert actual == expected
+    assert {m["Unit"] for m in columnar.to_cloudwatch(stats, Filter())} == {
+        "None",
+        "Count",
+    }
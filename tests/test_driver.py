@@ -0,0 +1,565 @@
+import errno
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import pytest
+from conftest import FakeConnection, FakeNode, _node_store
+
+from qdb_cloudwatch import driver, instrument
+
+
+class FakeSink:
+    def __init__(self):
+        self.pushes = []
+        self.flushes = 0
+
+    def push(self, metrics, namespace, suppressor=None):
+        if suppressor is not None:
+            metrics = suppressor.select(metrics)
+            suppressor.record(metrics)
+
+        self.pushes.append((namespace, metrics))
+        return []
+
+    def flush(self):
+        self.flushes += 1
+
+    def close(self):
+        pass
+
+
+def _names(sink):
+    return {m["MetricName"] for (_, metrics) in sink.pushes for m in metrics}
+
+
+def _run(argv, fake_conn, n=1):
+    args = driver.get_args(argv + ["--sink", "emf"])
+    ctx = driver._get_context(args, fake_conn)
+    ctx.sink = FakeSink()
+
+    for _ in range(n):
+        driver._run_once(args, ctx)
+
+    return ctx.sink
+
+
+def test_run_once(fake_conn):
+    sink = _run([], fake_conn)
+
+    assert "check.online" in _names(sink)
+    assert "node.writable" in _names(sink)
+    assert "memory.vm.used" in _names(sink)
+    assert sink.flushes == 1
+
+
+def test_run_once_filtered(fake_conn):
+    sink = _run(["--filter-include", "memory"], fake_conn)
+
+    assert "memory.vm.used" in _names(sink)
+    assert "requests.total_count" not in _names(sink)
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["--all-nodes"],
+        ["--columnar"],
+        ["--counters-as-rates"],
+        ["--suppress-unchanged"],
+        ["--self-metrics"],
+        ["--top-users", "1"],
+        ["--filter-pushdown", "--filter-include", "memory"],
+        ["--filter-pushdown", "--filter-include", "memory", "--top-users", "1"],
+        ["--columnar", "--top-users", "1"],
+        ["--counters-as-rates", "--top-users", "1"],
+    ],
+)
+def test_run_once_options(fake_conn, argv):
+    sink = _run(argv, fake_conn, n=2)
+
+    assert "check.online" in _names(sink)
+
+
+def test_counters_as_rates(fake_conn):
+    sink = _run(["--counters-as-rates"], fake_conn, n=2)
+
+    assert "requests.total_count" not in _names(sink)
+    assert "requests.total_count.rate" in _names(sink)
+
+
+def test_invalid_args():
+    with pytest.raises(SystemExit):
+        driver.get_args(["--interval", "0"])
+
+    with pytest.raises(SystemExit):
+        driver.get_args(["--sample-interval", "5"])
+    with pytest.raises(SystemExit):
+        driver.get_args(["--node-timeout", "0"])
+
+    with pytest.raises(SystemExit):
+        driver.get_args(["--columnar", "--counters-as-rates"])
+    with pytest.raises(SystemExit):
+        driver.get_args(["--sink", "prometheus"])
+    with pytest.raises(SystemExit):
+        driver.get_args(
+            ["--sink", "prometheus", "--daemon", "--prometheus-address", "9150"]
+        )
+
+    with pytest.raises(SystemExit):
+        driver.get_args(["--sink", "emf", "--spool-dir", "spool"])
+    with pytest.raises(SystemExit):
+        driver.get_args(["--spool-dir", "spool", "--spool-drain-seconds", "-1"])
+
+
+def test_spooled_metrics_keep_collection_time(fake_conn, tmp_path):
+    args = driver.get_args(["--spool-dir", str(tmp_path)])
+    ctx = driver._get_context(args, fake_conn, sink=FakeSink())
+
+    before = datetime.now(timezone.utc)
+    metrics = driver._collect(args, ctx, time.monotonic() + 10)
+
+    assert {m["Timestamp"] for m in metrics} == {metrics[0]["Timestamp"]}
+    assert before <= metrics[0]["Timestamp"] <= datetime.now(timezone.utc)
+
+
+def test_emf_sink_output(fake_conn, tmp_path):
+    path = tmp_path / "emf.jsonl"
+    args = driver.get_args(["--sink", "emf", "--emf-output", str(path)])
+    ctx = driver._get_context(args, fake_conn)
+
+    driver._run_once(args, ctx)
+    ctx.sink.close()
+
+    docs = [json.loads(x) for x in path.read_text().splitlines()]
+    assert docs
+    assert all(x["_aws"]["CloudWatchMetrics"][0]["Namespace"] for x in docs)
+
+
+def test_top_users(fake_conn):
+    sink = _run(["--top-users", "1"], fake_conn)
+    users = {
+        d["Value"]
+        for (_, metrics) in sink.pushes
+        for m in metrics
+        for d in m["Dimensions"]
+        if d["Name"] == "UserId"
+    }
+
+    assert len(users) == 2
+    assert "other" in users
+
+
+class SlowNode(FakeNode):
+    """
+    Node whose full stats take `delay` seconds, its critical checks are immediate.
+    """
+
+    def __init__(self, store, delay):
+        super().__init__(store)
+        self.delay = delay
+
+    def prefix_get(self, prefix, n):
+        time.sleep(self.delay)
+        return super().prefix_get(prefix, n)
+
+
+def test_cycle_deadline_pushes_partial_results():
+    conn = FakeConnection(
+        {
+            "127.0.0.1:2836": FakeNode(_node_store()),
+            "127.0.0.1:2837": SlowNode(_node_store(), delay=2),
+        }
+    )
+    args = driver.get_args(
+        ["--sink", "emf", "--all-nodes", "--cycle-deadline", "0.5", "--self-metrics"]
+    )
+    ctx = driver._get_context(args, conn)
+    ctx.sink = FakeSink()
+
+    instrument.collect()
+    start = time.monotonic()
+    driver._run_once(args, ctx)
+    elapsed = time.monotonic() - start
+
+    assert elapsed < 2
+    nodes = {}
+    for _, metrics in ctx.sink.pushes:
+        for m in metrics:
+            nodes.setdefault(m["MetricName"], set()).update(
+                d["Value"] for d in m["Dimensions"] if d["Name"] == "NodeId"
+            )
+    # Critical stats of both nodes, full stats of the fast node only.
+    assert nodes["check.online"] == {"127.0.0.1:2836", "127.0.0.1:2837"}
+    assert nodes["memory.vm.used"] == {"127.0.0.1:2836"}
+
+    (dropped,) = [
+        m["Value"]
+        for (_, metrics) in ctx.sink.pushes
+        for m in metrics
+        if m["MetricName"] == "nodes_dropped"
+    ]
+    assert dropped == 1
+
+
+def test_critical_lane_uses_its_own_connection(fake_conn):
+    critical_conn = FakeConnection({"127.0.0.1:2836": FakeNode(_node_store())})
+    args = driver.get_args(["--sink", "emf"])
+    ctx = driver._get_context(args, fake_conn, critical_conn)
+    ctx.sink = FakeSink()
+
+    driver._run_once(args, ctx)
+    ctx.close()
+
+    assert ctx.critical_conn is critical_conn
+    assert "check.online" in _names(ctx.sink)
+
+
+def _write_config(tmp_path, clusters):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({"clusters": clusters}))
+    return str(path)
+
+
+def test_config_clusters(tmp_path):
+    config = _write_config(
+        tmp_path,
+        [
+            {"name": "a", "cluster": "qdb://a:2836", "namespace": "A"},
+            {
+                "cluster": "qdb://b:2836",
+                "filter_include": ["memory"],
+                "cluster_public_key": "b.key",
+            },
+        ],
+    )
+    args = driver.get_args(
+        ["--config", config, "--namespace", "Default", "--state-dir", "/tmp/x"]
+    )
+
+    a, b = args.clusters
+    assert (a.name, a.cluster_uri, a.namespace) == ("a", "qdb://a:2836", "A")
+    assert (b.name, b.namespace, b.filter_include) == ("b_2836", "Default", ["memory"])
+    assert b.cluster_public_key == "b.key"
+    assert a.state_dir == "/tmp/x/a"
+
+
+@pytest.mark.parametrize(
+    "clusters",
+    [
+        [],
+        [{"namespace": "A"}],
+        [{"cluster": "qdb://a:2836", "unknown": 1}],
+        [{"cluster": "qdb://a:2836"}, {"cluster": "qdb://a:2836"}],
+        [{"cluster": "qdb://a:2836", "write_probe": "delete"}],
+        [{"cluster": "qdb://a:2836", "top_users": 0}],
+        [{"cluster": "qdb://a:2836", "top_users": "3"}],
+        [{"cluster": "qdb://a:2836", "all_nodes": "false"}],
+        [{"cluster": "qdb://a:2836", "filter_include": [1]}],
+        [{"cluster": 2836}],
+        [{"cluster": "qdb://a:2836", "name": "../other"}],
+        [{"cluster": "qdb://a:2836", "name": "a/b"}],
+        [{"cluster": "qdb://a:2836", "name": ".."}],
+        [{"cluster": "qdb://a:2836", "name": ""}],
+    ],
+)
+def test_config_invalid(tmp_path, clusters):
+    with pytest.raises(SystemExit):
+        driver.get_args(["--config", _write_config(tmp_path, clusters)])
+
+
+def test_run_clusters_shares_sink(tmp_path):
+    config = _write_config(
+        tmp_path,
+        [
+            {"cluster": "qdb://127.0.0.1:2836", "namespace": "A"},
+            {"cluster": "qdb://127.0.0.1:2837", "namespace": "B"},
+        ],
+    )
+    args = driver.get_args(["--config", config, "--sink", "emf", "--self-metrics"])
+    sink = FakeSink()
+
+    runs = []
+    for args_, port in zip(args.clusters, [2836, 2837]):
+        conn = FakeConnection({f"127.0.0.1:{port}": FakeNode(_node_store())})
+        runs.append((args_, driver._get_context(args_, conn, sink=sink)))
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        driver._run_clusters(args, runs, pool)
+
+    namespaces = [namespace for (namespace, _) in sink.pushes]
+    assert namespaces.count("A") == 2
+    assert namespaces.count("B") == 2
+    # Exporter metrics are pushed once for all clusters, and are not tied to a node.
+    assert namespaces.count("QuasarDB/Exporter") == 1
+    (exporter,) = [xs for (ns, xs) in sink.pushes if ns == "QuasarDB/Exporter"]
+    assert {d["Name"] for m in exporter for d in m["Dimensions"]} == {"Host"}
+    assert sink.flushes == 1
+
+
+class BrokenConnection(FakeConnection):
+    def endpoints(self):
+        raise RuntimeError("cluster is gone")
+
+
+def test_run_clusters_isolates_failures(tmp_path, fake_conn):
+    config = _write_config(
+        tmp_path,
+        [
+            {"cluster": "qdb://127.0.0.1:2836", "all_nodes": True},
+            {"cluster": "qdb://127.0.0.1:2837"},
+        ],
+    )
+    args = driver.get_args(["--config", config, "--sink", "emf"])
+    sink = FakeSink()
+
+    broken = BrokenConnection({})
+    runs = [
+        (args.clusters[0], driver._get_context(args.clusters[0], broken, sink=sink)),
+        (args.clusters[1], driver._get_context(args.clusters[1], fake_conn, sink=sink)),
+    ]
+    # The second cluster is the fake node of 127.0.0.1:2836.
+    args.clusters[1].cluster_uri = "qdb://127.0.0.1:2836"
+
+    with ThreadPoolExecutor(max_workers=2) as pool, pytest.raises(RuntimeError):
+        driver._run_clusters(args, runs, pool)
+
+    assert "memory.vm.used" in _names(sink)
+
+
+def test_tiers_collect_due_groups_only(fake_conn):
+    args = driver.get_args(
+        [
+            "--sink",
+            "emf",
+            "--daemon",
+            "--interval",
+            "20",
+            "--tier",
+            "10:requests",
+            "--tier",
+            "40:memory",
+        ]
+    )
+    sink = FakeSink()
+    ctx = driver._get_context(args, fake_conn, sink=sink)
+
+    cycles = []
+    for _ in range(4):
+        sink.pushes = []
+        driver._run_cycle(args, ctx)
+        cycles.append(_names(sink))
+
+    assert driver._tick_interval(args) == 10
+    assert ["requests.total_count" in x for x in cycles] == [True] * 4
+    assert ["engine.latency" in x for x in cycles] == [True, False, True, False]
+    assert ["memory.vm.used" in x for x in cycles] == [True, False, False, False]
+    # Critical metrics are pushed every cycle.
+    assert all("node.writable" in x for x in cycles)
+
+
+def test_tier_failure_does_not_stop_the_others(fake_conn, monkeypatch):
+    args = driver.get_args(
+        ["--sink", "emf", "--daemon", "--interval", "20", "--tier", "10:requests"]
+    )
+    sink = FakeSink()
+    ctx = driver._get_context(args, fake_conn, sink=sink)
+    _, fast = ctx.tiers[1]
+
+    collect = driver._collect
+    waited = []
+
+    def _collect(args_, ctx_, deadline):
+        if ctx_ is fast:
+            raise RuntimeError("tier is broken")
+
+        return collect(args_, ctx_, deadline)
+
+    def _wait_critical(future, deadline):
+        waited.append(future)
+        future.result()
+
+    monkeypatch.setattr(driver, "_collect", _collect)
+    monkeypatch.setattr(driver, "_wait_critical", _wait_critical)
+
+    with pytest.raises(RuntimeError):
+        driver._run_cycle(args, ctx)
+
+    assert "memory.vm.used" in _names(sink)
+    assert "node.writable" in _names(sink)
+    assert ctx.cycles == 1
+    assert len(waited) == 1
+
+
+def test_tiers_keep_their_own_state(fake_conn, tmp_path):
+    argv = ["--sink", "emf", "--daemon", "--interval", "10", "--tier", "20:memory"]
+    argv += ["--suppress-unchanged", "--counters-as-rates"]
+    args = driver.get_args(argv + ["--state-dir", str(tmp_path)])
+    ctx = driver._get_context(args, fake_conn, sink=FakeSink())
+
+    (_, default), (_, tier) = ctx.tiers
+    assert default is ctx
+    assert tier.suppressor is not ctx.suppressor
+    assert tier.rates is not ctx.rates
+
+    driver._run_cycle(args, ctx)
+    driver._save_state(args, ctx)
+
+    assert sorted(x.name for x in tmp_path.iterdir()) == [
+        "rates.json.gz",
+        "suppression.json.gz",
+        "tier1.rates.json.gz",
+        "tier1.suppression.json.gz",
+    ]
+
+    # A restarted exporter picks up where the tier left off.
+    assert tier.suppressor._state
+    ctx = driver._get_context(args, fake_conn, sink=FakeSink())
+    driver._load_state(args, ctx)
+    assert ctx.tiers[1][1].suppressor._state == tier.suppressor._state
+
+
+def test_tiers_prometheus_expiry():
+    args = driver.get_args(
+        ["--sink", "prometheus", "--prometheus-address", "127.0.0.1:0", "--daemon"]
+        + ["--interval", "10", "--tier", "600:memory"]
+    )
+    sink = driver._get_sink(args)
+    try:
+        assert sink.max_age_seconds == 1800
+    finally:
+        sink.close()
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["--tier", "10:requests"],
+        ["--daemon", "--tier", "requests"],
+        ["--daemon", "--tier", "10:"],
+        ["--daemon", "--interval", "60", "--tier", "25:requests"],
+    ],
+)
+def test_tiers_invalid(argv):
+    with pytest.raises(SystemExit):
+        driver.get_args(argv)
+
+
+def test_record_and_replay(fake_conn, tmp_path):
+    path = str(tmp_path / "stats.qdbsnap")
+
+    args = driver.get_args(["--sink", "emf", "--record", path])
+    ctx = driver._get_context(args, fake_conn, sink=FakeSink())
+    ctx.recorder = driver.Recorder(path)
+    for _ in range(2):
+        driver._run_once(args, ctx)
+    ctx.recorder.close()
+
+    args = driver.get_args(["--replay", path, "--replay-speed", "0"])
+    assert args.sink == "null"
+
+    replayed = FakeSink()
+    driver._replay(args, driver._get_context(args, None, sink=replayed))
+
+    assert len(replayed.pushes) == 2
+    assert "memory.vm.used" in _names(replayed)
+    assert "node.writable" not in _names(replayed)
+
+
+class FullRecorder:
+    def __init__(self):
+        self.writes = 0
+        self.closed = False
+
+    def write(self, stats):
+        self.writes += 1
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def close(self):
+        self.closed = True
+
+
+def test_record_failure_keeps_pushing(fake_conn):
+    args = driver.get_args(["--sink", "emf", "--record", "stats.qdbsnap"])
+    ctx = driver._get_context(args, fake_conn, sink=FakeSink())
+    recorder = ctx.recorder = FullRecorder()
+
+    for _ in range(2):
+        driver._run_once(args, ctx)
+
+    names = [{m["MetricName"] for m in xs} for (_, xs) in ctx.sink.pushes]
+    assert len([x for x in names if "memory.vm.used" in x]) == 2
+    # Recording is disabled after the first failure.
+    assert recorder.writes == 1
+    assert recorder.closed
+    assert ctx.recorder is None
+
+
+def test_replay_at_recorded_speed(tmp_path, make_stats):
+    path = str(tmp_path / "stats.qdbsnap")
+
+    recorder = driver.Recorder(path)
+    recorder.write(make_stats(n_metrics=1), timestamp=100.0)
+    recorder.write(make_stats(n_metrics=1), timestamp=101.0)
+    recorder.close()
+
+    args = driver.get_args(["--replay", path, "--replay-speed", "10"])
+    ctx = driver._get_context(args, None)
+
+    start = time.monotonic()
+    driver._replay(args, ctx)
+
+    assert 0.1 <= time.monotonic() - start < 1.0
+
+
+def test_replay_invalid_args(tmp_path):
+    path = str(tmp_path / "stats.qdbsnap")
+
+    for argv in [
+        ["--replay", path, "--daemon"],
+        ["--replay", path, "--record", path],
+        ["--replay", path, "--replay-speed", "-1"],
+        ["--record", path, "--daemon", "--tier", "600:rocksdb"],
+    ]:
+        with pytest.raises(SystemExit):
+            driver.get_args(argv)
+
+
+def test_critical_loop_coalesces_clusters(tmp_path):
+    config = _write_config(
+        tmp_path,
+        [{"cluster": "qdb://127.0.0.1:2836"}, {"cluster": "qdb://127.0.0.1:2837"}],
+    )
+    args = driver.get_args(
+        ["--config", config, "--sink", "emf", "--daemon", "--critical-interval", "10"]
+    )
+    sink = FakeSink()
+
+    runs = []
+    for args_, port in zip(args.clusters, [2836, 2837]):
+        conn = FakeConnection({f"127.0.0.1:{port}": FakeNode(_node_store())})
+        runs.append((args_, driver._get_context(args_, conn, sink=sink)))
+
+    driver._run_critical(args, runs)
+
+    ((_, metrics),) = sink.pushes
+    assert {m["MetricName"] for m in metrics} >= {"check.online", "node.writable"}
+    assert all(m["StorageResolution"] == 1 for m in metrics)
+    nodes = {d["Value"] for m in metrics for d in m["Dimensions"]}
+    assert nodes == {"127.0.0.1:2836", "127.0.0.1:2837"}
+
+
+def test_critical_loop_leaves_cycle(fake_conn):
+    sink = _run(["--daemon", "--critical-interval", "10"], fake_conn)
+
+    assert "memory.vm.used" in _names(sink)
+    assert "node.writable" not in _names(sink)
+
+
+def test_critical_interval_invalid_args():
+    with pytest.raises(SystemExit):
+        driver.get_args(["--critical-interval", "10"])
+
+    with pytest.raises(SystemExit):
+        driver.get_args(["--daemon", "--interval", "60", "--critical-interval", "90"])
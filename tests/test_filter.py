@@ -1,6 +1,10 @@
+import copy
+
 import pytest
+import quasardb.stats as qdbst
+from conftest import FakeNode, _node_store
 
-from qdb_cloudwatch.check import filter_stats
+from qdb_cloudwatch.check import Filter, StatsReader, TierFilter, filter_stats
 
 
 def test_filter_single_include(stats):
@@ -67,3 +71,145 @@ def test_filter_multiple_exclude(stats):
             for metric_name in stats_[node_id]["by_uid"][uid]:
                 assert "memory." not in metric_name
                 assert "network." not in metric_name
+
+
+def test_filter_does_not_modify_input(make_stats):
+    stats = make_stats(n_metrics=10, n_uids=3)
+    before = copy.deepcopy(stats)
+
+    stats_ = filter_stats(stats, include=[r"metric\.1"], exclude=[r"metric\.0"])
+
+    assert stats == before
+    for node_id in stats_:
+        assert list(stats_[node_id]["cumulative"]) == ["metric.1"]
+        for uid in stats_[node_id]["by_uid"]:
+            assert list(stats_[node_id]["by_uid"][uid]) == ["metric.1"]
+
+
+def test_filter_empty_include_keeps_nothing(make_stats):
+    stats_ = filter_stats(make_stats(n_metrics=10, n_uids=3), include=[])
+
+    for node_id in stats_:
+        assert stats_[node_id]["cumulative"] == {}
+        for uid in stats_[node_id]["by_uid"]:
+            assert stats_[node_id]["by_uid"][uid] == {}
+
+
+def test_filter_reuse_caches_decisions(make_stats):
+    f = Filter(include=[r"metric\.[0-4]$"])
+
+    for _ in range(3):
+        stats_ = f(make_stats(n_metrics=10, n_uids=5))
+
+    for node_id in stats_:
+        assert len(stats_[node_id]["cumulative"]) == 5
+
+    # One decision per distinct metric name, regardless of uids and cycles
+    assert len(f._decisions) == 10
+
+
+class CountingNode(FakeNode):
+    """
+    `FakeNode` that records the keys that are read and how often keys are listed.
+    """
+
+    def __init__(self, store):
+        super().__init__(store)
+        self.read = []
+        self.listed = 0
+
+    def prefix_get(self, prefix, n):
+        self.listed += 1
+        return super().prefix_get(prefix, n)
+
+    def integer(self, key):
+        self.read.append(key)
+        return super().integer(key)
+
+    def blob(self, key):
+        self.read.append(key)
+        return super().blob(key)
+
+
+def _without_duration(stats):
+    del stats["cumulative"]["check.duration_ms"]
+    return stats
+
+
+def test_stats_reader_matches_of_node():
+    node = CountingNode(_node_store())
+
+    expected = _without_duration(qdbst.of_node(node))
+    actual = _without_duration(StatsReader(Filter())(node, "127.0.0.1:2836"))
+
+    assert actual == expected
+
+
+def test_stats_reader_only_reads_matching_keys():
+    node = CountingNode(_node_store())
+    reader = StatsReader(Filter(include=[r"memory\."]))
+
+    stats = reader(node, "127.0.0.1:2836")
+
+    assert set(stats["cumulative"]) == {
+        "memory.vm.used",
+        "check.online",
+        "check.duration_ms",
+    }
+    assert set(stats["by_uid"][0]) == {"memory.vm.used"}
+    assert all("memory.vm.used" in k for k in node.read)
+
+
+def test_stats_reader_caches_keys():
+    node = CountingNode(_node_store())
+    now = [0.0]
+    reader = StatsReader(Filter(), refresh_seconds=60, clock=lambda: now[0])
+
+    reader(node, "127.0.0.1:2836")
+    node.read = []
+    reader(node, "127.0.0.1:2836")
+
+    assert node.listed == 1
+    # Types and units are not read again.
+    assert not any(k.endswith((".type", ".unit")) for k in node.read)
+
+    now[0] = 61.0
+    reader(node, "127.0.0.1:2836")
+    assert node.listed == 2
+
+
+def test_stats_reader_refreshes_when_key_disappears():
+    node = CountingNode(_node_store())
+    reader = StatsReader(Filter())
+
+    reader(node, "127.0.0.1:2836")
+    del node.store["$qdb.statistics.memory.vm.used.uid_1"]
+    stats = reader(node, "127.0.0.1:2836")
+
+    assert "memory.vm.used" not in stats["by_uid"][1]
+    reader(node, "127.0.0.1:2836")
+    assert node.listed == 2
+
+
+def test_stats_reader_keeps_extra_metrics():
+    node = CountingNode(_node_store())
+    reader = StatsReader(Filter(include=[r"memory\."]), extra=["requests.total_count"])
+
+    stats = reader(node, "127.0.0.1:2836")
+
+    assert "requests.total_count" in stats["by_uid"][0]
+
+
+def test_tier_filter_assigns_metrics_to_first_matching_tier():
+    base = Filter(exclude=[r"\.uid_"])
+    tiers = [Filter(include=[r"^requests\."]), Filter(include=[r"requests|memory"])]
+
+    default, fast, slow = [TierFilter(base, tiers, i) for i in [None, 0, 1]]
+
+    assert fast.keep("requests.total_count")
+    assert not slow.keep("requests.total_count")
+    assert slow.keep("memory.vm.used")
+    assert default.keep("engine.latency")
+    assert not default.keep("memory.vm.used")
+    # The base filter still applies.
+    assert not fast.keep("requests.uid_1")
@@ -0,0 +1,84 @@
+import pstats
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from qdb_cloudwatch import instrument
+from qdb_cloudwatch.cloudwatch import push_metrics
+
+
+class FakeClient:
+    def put_metric_data(self, Namespace, MetricData):
+        if any(m["MetricName"] == "fail" for m in MetricData):
+            raise RuntimeError("throttled")
+
+
+def _metric(name="metric.0"):
+    return {"MetricName": name, "Value": 1.0, "Unit": "Count", "Dimensions": []}
+
+
+def test_instrument_push_counters():
+    instrument.collect()
+
+    push_metrics(
+        [_metric()] * 30 + [_metric("fail")],
+        "ns",
+        client=FakeClient(),
+        max_metrics_per_request=20,
+    )
+    durations, counters = instrument.collect()
+
+    assert "push" in durations
+    assert counters["batches"] == 1
+    assert counters["metrics"] == 20
+    assert counters["api_errors"] == 1
+    assert counters["bytes"] > 0
+
+    # Collecting resets
+    assert instrument.collect() == ({}, {})
+
+
+def test_instrument_to_metrics():
+    with instrument.timed("qdb.of_node"):
+        pass
+    instrument.count("bytes", 100)
+
+    metrics = instrument.to_metrics(*instrument.collect(), {"NodeId": "127.0.0.1:2836"})
+    by_name = {m["MetricName"]: m for m in metrics}
+
+    assert by_name["qdb.of_node.duration_ms"]["Unit"] == "Milliseconds"
+    assert by_name["bytes"] == {
+        "MetricName": "bytes",
+        "Value": 100.0,
+        "Unit": "Bytes",
+        "Dimensions": [{"Name": "NodeId", "Value": "127.0.0.1:2836"}],
+    }
+
+
+def test_instrument_profiled(tmp_path):
+    with instrument.profiled(str(tmp_path)):
+        sorted(range(1000))
+
+    pstats.Stats(str(tmp_path / "profile.pstats"))
+    tracemalloc.Snapshot.load(str(tmp_path / "tracemalloc.snapshot"))
+
+
+def _in_worker():
+    return sorted(range(1000))
+
+
+def test_instrument_profiled_threads(tmp_path):
+    with instrument.profiled(str(tmp_path)):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            fn = instrument.thread_profiled(_in_worker)
+            assert [f.result() for f in [pool.submit(fn), pool.submit(fn)]]
+
+    stats = pstats.Stats(str(tmp_path / "profile.pstats"))
+    ((calls, *_),) = [
+        v for (_, _, name), v in stats.stats.items() if name == "_in_worker"
+    ]
+    assert calls == 2
+
+    # Outside of a profiled block, functions are left as they are.
+    assert instrument.thread_profiled(_in_worker) is _in_worker
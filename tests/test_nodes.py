@@ -0,0 +1,195 @@
+import time
+from datetime import timedelta
+
+import pytest
+import quasardb
+import quasardb.stats as qdbst
+from conftest import FakeConnection
+
+from qdb_cloudwatch.check import (
+    Connection,
+    WriteProbe,
+    _check_node_writable,
+    _collect_from_nodes,
+    get_all_stats,
+    get_critical_stats,
+    get_qdb_conn,
+)
+
+
+def _collect(conn, endpoint):
+    if endpoint == "slow:2836":
+        time.sleep(1)
+    elif endpoint == "broken:2836":
+        raise RuntimeError("node is gone")
+
+    return {"cumulative": {}, "by_uid": {}}
+
+
+def test_collect_from_nodes_isolates_slow_and_failing_nodes():
+    conn = FakeConnection({})
+    endpoints = ["a:2836", "b:2836", "slow:2836", "broken:2836"]
+
+    start = time.monotonic()
+    ret = _collect_from_nodes(conn, endpoints, _collect, timeout_seconds=0.2)
+    elapsed = time.monotonic() - start
+
+    assert sorted(ret) == ["a:2836", "b:2836"]
+    assert sorted(conn.forgotten) == ["broken:2836", "slow:2836"]
+    assert conn.resets == 0
+    assert elapsed < 1
+
+
+def test_collect_from_nodes_resets_when_no_node_answers():
+    conn = FakeConnection({})
+
+    ret = _collect_from_nodes(conn, ["slow:2836", "broken:2836"], _collect, 0.2)
+
+    assert ret == {}
+    assert conn.resets == 1
+
+
+def test_collect_from_nodes_without_endpoints():
+    assert _collect_from_nodes(FakeConnection({}), [], _collect, 1) == {}
+
+
+def test_connection_is_reused_across_cycles(fake_clusters):
+    conn = Connection("qdb://127.0.0.1:2836")
+
+    for _ in range(3):
+        stats = get_all_stats("qdb://127.0.0.1:2836", conn=conn)
+        assert "requests.total_count" in stats["127.0.0.1:2836"]["cumulative"]
+
+    (cluster,) = fake_clusters
+    assert cluster.opened == ["127.0.0.1:2836"]
+
+    conn.close()
+    assert cluster.closed
+
+
+def _cluster_is_gone():
+    raise quasardb.Error("cluster is gone")
+
+
+def test_connection_reconnects_after_error(fake_clusters):
+    conn = Connection("qdb://127.0.0.1:2836")
+    conn.cluster().endpoints = _cluster_is_gone
+
+    with pytest.raises(quasardb.Error):
+        get_all_stats("qdb://127.0.0.1:2836", conn=conn, all_nodes=True)
+
+    assert fake_clusters[0].closed
+
+    stats = get_all_stats("qdb://127.0.0.1:2836", conn=conn, all_nodes=True)
+    assert list(stats) == ["127.0.0.1:2836"]
+    assert len(fake_clusters) == 2
+
+
+class BrokenNode:
+    def prefix_get(self, prefix, n):
+        raise quasardb.Error("node handle is broken")
+
+
+def test_node_errors_reset_the_connection(fake_clusters):
+    conn = Connection("qdb://127.0.0.1:2836")
+    conn.cluster().node = lambda endpoint: BrokenNode()
+
+    assert get_all_stats("qdb://127.0.0.1:2836", conn=conn) == {}
+    assert fake_clusters[0].closed
+
+    # The next cycle reconnects, and gets all stats again.
+    stats = get_all_stats("qdb://127.0.0.1:2836", conn=conn)
+    assert list(stats) == ["127.0.0.1:2836"]
+    assert len(fake_clusters) == 2
+
+
+def test_connection_forget_node(fake_clusters):
+    conn = Connection("qdb://127.0.0.1:2836")
+    node = conn.node("127.0.0.1:2836")
+    assert conn.node("127.0.0.1:2836") is node
+
+    conn.forget_node("127.0.0.1:2836")
+
+    assert conn.node("127.0.0.1:2836") is not node
+    # Only the node handle is reopened, not the cluster.
+    (cluster,) = fake_clusters
+    assert cluster.opened == ["127.0.0.1:2836", "127.0.0.1:2836"]
+
+
+def test_check_node_writable_reports_latencies(fake_conn):
+    writable, latencies = _check_node_writable(fake_conn, "127.0.0.1:2836")
+
+    assert writable == 1
+    assert set(latencies) == {
+        "node.writable.put_latency",
+        "node.writable.get_latency",
+    }
+    # The test entry is removed.
+    store = fake_conn.node("127.0.0.1:2836").store
+    assert not any(k.startswith("_qdb_write_check_") for k in store)
+
+
+def test_write_probe_rotates_fixed_keys(fake_conn):
+    probe = WriteProbe("exporter", n_keys=3)
+    store = fake_conn.node("127.0.0.1:2836").store
+
+    for _ in range(10):
+        writable, latencies = probe(fake_conn, "127.0.0.1:2836")
+        assert writable == 1
+        assert "node.writable.put_latency" in latencies
+
+    keys = {k for k in store if k.startswith("_qdb_write_check_")}
+    assert keys == {f"_qdb_write_check_exporter_{i}" for i in range(3)}
+
+
+def test_critical_stats_latencies(fake_conn):
+    stats = get_critical_stats(
+        "qdb://127.0.0.1:2836", conn=fake_conn, write_probe=WriteProbe("exporter")
+    )
+    metrics = stats["127.0.0.1:2836"]["cumulative"]
+
+    assert metrics["node.writable"]["value"] == 1
+    for k in [
+        "check.online.read_latency",
+        "node.writable.put_latency",
+        "node.writable.get_latency",
+    ]:
+        assert metrics[k]["unit"] == qdbst.Unit.MICROSECONDS
+        assert metrics[k]["value"] >= 0
+
+
+def test_critical_stats_offline_has_no_latencies(fake_conn):
+    del fake_conn.node("127.0.0.1:2836").store["$qdb.statistics.startup_epoch"]
+
+    stats = get_critical_stats("qdb://127.0.0.1:2836", conn=fake_conn)
+    metrics = stats["127.0.0.1:2836"]["cumulative"]
+
+    assert metrics["check.online"]["value"] == 0
+    assert "check.online.read_latency" not in metrics
+
+
+def test_critical_stats_single_node_timeout(fake_conn):
+    def _slow_probe(conn, endpoint):
+        time.sleep(1)
+        return 1, {}
+
+    start = time.monotonic()
+    stats = get_critical_stats(
+        "qdb://127.0.0.1:2836",
+        conn=fake_conn,
+        node_timeout_seconds=0.2,
+        write_probe=_slow_probe,
+    )
+    elapsed = time.monotonic() - start
+
+    assert stats["127.0.0.1:2836"]["cumulative"]["check.online"]["value"] == 0
+    assert elapsed < 1
+
+
+def test_insecure_connection_timeout(monkeypatch):
+    calls = []
+    monkeypatch.setattr(quasardb, "Cluster", lambda uri, **kwargs: calls.append(kwargs))
+
+    get_qdb_conn("qdb://127.0.0.1:2836", timeout_seconds=5)
+
+    assert calls == [{"timeout": timedelta(seconds=5)}]
@@ -0,0 +1,96 @@
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from qdb_cloudwatch.ratelimit import RateLimiter, is_retryable, with_retries
+
+
+def _client_error(code, status=400):
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": code},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        },
+        "PutMetricData",
+    )
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Flaky:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def test_is_retryable():
+    assert is_retryable(_client_error("Throttling"))
+    assert is_retryable(_client_error("InternalFailure", 500))
+    assert is_retryable(EndpointConnectionError(endpoint_url="https://example"))
+    assert not is_retryable(_client_error("InvalidParameterValue"))
+    assert not is_retryable(RuntimeError("boom"))
+
+
+def test_retries_throttling():
+    fn = Flaky([_client_error("Throttling"), _client_error("InternalFailure", 503)])
+    delays = []
+
+    assert with_retries(fn, sleep=delays.append) == "ok"
+    assert fn.calls == 3
+    assert len(delays) == 2
+
+
+def test_no_retry_of_client_errors():
+    fn = Flaky([_client_error("InvalidParameterValue")])
+
+    with pytest.raises(ClientError):
+        with_retries(fn, sleep=lambda x: None)
+
+    assert fn.calls == 1
+
+
+def test_retries_are_bounded():
+    fn = Flaky([_client_error("Throttling")] * 10)
+
+    with pytest.raises(ClientError):
+        with_retries(fn, max_attempts=3, sleep=lambda x: None)
+
+    assert fn.calls == 3
+
+
+def test_limiter_adapts_to_throttling():
+    clock = FakeClock()
+    limiter = RateLimiter(max_rate=100, min_rate=1, clock=clock, sleep=clock.sleep)
+    fn = Flaky([_client_error("Throttling")] * 3)
+
+    with_retries(fn, limiter=limiter, sleep=clock.sleep)
+    assert limiter.rate == 100 / 8 + 1
+
+    for _ in range(1000):
+        limiter.success()
+    assert limiter.rate == 100
+
+
+def test_limiter_bounds_request_rate():
+    clock = FakeClock()
+    limiter = RateLimiter(max_rate=10, clock=clock, sleep=clock.sleep)
+
+    for _ in range(101):
+        limiter.acquire()
+
+    # The first request goes out immediately, then 10 per second
+    assert clock.now == pytest.approx(10.0)
@@ -0,0 +1,111 @@
+import sys
+
+import pytest
+import quasardb.stats as qdbst
+
+from qdb_cloudwatch import driver
+from qdb_cloudwatch.check import Filter
+from qdb_cloudwatch.cloudwatch import _qdb_to_cloudwatch
+from qdb_cloudwatch.rates import RateConverter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _counter(value):
+    return {"value": value, "type": qdbst.Type.ACCUMULATOR, "unit": qdbst.Unit.COUNT}
+
+
+def _stats(value, uid_value=None):
+    return {
+        "127.0.0.1:2836": {
+            "cumulative": {
+                "requests.total_count": _counter(value),
+                "memory.vm.used": {
+                    "value": 42,
+                    "type": qdbst.Type.GAUGE,
+                    "unit": qdbst.Unit.BYTES,
+                },
+                "check.online": _counter(1),
+            },
+            "by_uid": {
+                1: {"requests.total_count": _counter(uid_value or value)},
+            },
+        }
+    }
+
+
+def test_rates_of_counters():
+    clock = FakeClock()
+    rates = RateConverter(clock=clock)
+
+    first = rates(_stats(100))["127.0.0.1:2836"]
+
+    # Nothing to compare with yet, gauges and checks are passed through
+    assert sorted(first["cumulative"]) == ["check.online", "memory.vm.used"]
+    assert first["by_uid"][1] == {}
+
+    clock.now += 10
+    second = rates(_stats(150, uid_value=110))["127.0.0.1:2836"]
+
+    assert second["cumulative"]["requests.total_count.rate"]["value"] == 5.0
+    assert second["by_uid"][1]["requests.total_count.rate"]["value"] == 1.0
+    assert second["cumulative"]["memory.vm.used"]["value"] == 42
+
+
+def test_rates_counter_reset():
+    clock = FakeClock()
+    rates = RateConverter(clock=clock)
+
+    rates(_stats(1000))
+    clock.now += 10
+    ret = rates(_stats(20))["127.0.0.1:2836"]
+
+    assert ret["cumulative"]["requests.total_count.rate"]["value"] == 2.0
+
+
+def test_rates_cloudwatch_unit():
+    clock = FakeClock()
+    rates = RateConverter(clock=clock)
+
+    rates(_stats(100))
+    clock.now += 10
+    metrics = _qdb_to_cloudwatch(rates(_stats(200)))
+
+    (m,) = [
+        m
+        for m in metrics
+        if m["MetricName"] == "requests.total_count.rate" and len(m["Dimensions"]) == 1
+    ]
+    assert m["Unit"] == "Count/Second"
+    assert m["Value"] == 10.0
+
+
+def test_rates_state_roundtrip(tmp_path):
+    path = str(tmp_path / "rates.json.gz")
+    clock = FakeClock()
+
+    rates = RateConverter(clock=clock)
+    rates(_stats(100))
+    rates.save(path)
+
+    clock.now += 10
+    rates_ = RateConverter(clock=clock)
+    rates_.load(path)
+    ret = rates_(_stats(200))["127.0.0.1:2836"]
+
+    assert ret["cumulative"]["requests.total_count.rate"]["value"] == 10.0
+
+
+def test_driver_context_rates(monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["qdb-cloudwatch", "--counters-as-rates"])
+    args = driver.get_args()
+
+    ctx = driver._Context(None, None, Filter(), rates=driver._get_rates(args))
+
+    assert isinstance(ctx.rates, RateConverter)
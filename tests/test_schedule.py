@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+from qdb_cloudwatch.schedule import Schedule, run_forever
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_schedule_does_not_drift():
+    clock = FakeClock()
+    schedule = Schedule(10, clock=clock)
+
+    # Each run takes 3 seconds, the next tick must still be aligned on the interval.
+    for i in range(1, 5):
+        clock.now += 3
+        assert schedule.advance() == 100.0 + i * 10
+        assert schedule.remaining() == 7
+        clock.now = schedule.deadline()
+
+
+def test_schedule_skips_missed_ticks():
+    clock = FakeClock()
+    schedule = Schedule(10, clock=clock)
+
+    clock.now += 35
+    assert schedule.advance() == 140.0
+    assert schedule.remaining() == 5
+
+
+def test_schedule_rejects_non_positive_interval():
+    with pytest.raises(ValueError):
+        Schedule(0)
+
+
+def test_run_forever_survives_failures():
+    stop = threading.Event()
+    calls = []
+
+    def _fn():
+        calls.append(1)
+        if len(calls) == 3:
+            stop.set()
+        raise RuntimeError("boom")
+
+    run_forever(Schedule(0.001), _fn, stop)
+
+    assert len(calls) == 3
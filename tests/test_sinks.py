@@ -0,0 +1,368 @@
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+import pytest
+from botocore.exceptions import EndpointConnectionError
+
+from qdb_cloudwatch import sinks
+from qdb_cloudwatch.cloudwatch import _qdb_to_cloudwatch
+from qdb_cloudwatch.sinks import (
+    EMF_MAX_METRICS,
+    EmfSink,
+    PrometheusSink,
+    to_emf,
+    to_openmetrics,
+)
+from qdb_cloudwatch.spool import Spool
+
+
+def test_emf_groups_by_dimensions(make_stats):
+    metrics = _qdb_to_cloudwatch(make_stats(n_metrics=10, n_uids=3))
+
+    docs = to_emf(metrics, "ns", now_ms=1000)
+
+    # One document for the node, one per uid
+    assert len(docs) == 4
+    for doc, chunk in docs:
+        (directive,) = doc["_aws"]["CloudWatchMetrics"]
+        assert doc["_aws"]["Timestamp"] == 1000
+        assert directive["Namespace"] == "ns"
+        assert len(directive["Metrics"]) == len(chunk) == 10
+        for dim in directive["Dimensions"][0]:
+            assert dim in doc
+        for m in chunk:
+            assert doc[m["MetricName"]] == m["Value"]
+
+
+def test_emf_max_metrics_per_document(make_stats):
+    metrics = _qdb_to_cloudwatch(make_stats(n_metrics=250))
+
+    docs = to_emf(metrics, "ns")
+
+    assert [len(chunk) for (_, chunk) in docs] == [EMF_MAX_METRICS, EMF_MAX_METRICS, 50]
+
+
+def test_emf_skips_statistic_sets():
+    m = {
+        "MetricName": "x",
+        "Unit": "Count",
+        "Dimensions": [],
+        "StatisticValues": {
+            "SampleCount": 1.0,
+            "Sum": 1.0,
+            "Minimum": 1.0,
+            "Maximum": 1.0,
+        },
+    }
+
+    assert to_emf([m], "ns") == []
+
+
+def test_emf_sink_unix_socket(make_stats, tmp_path):
+    path = str(tmp_path / "emf.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    received = []
+
+    def _serve():
+        conn, _ = server.accept()
+        with conn, conn.makefile("r") as fp:
+            received.extend(json.loads(line) for line in fp)
+
+    t = threading.Thread(target=_serve)
+    t.start()
+
+    sink = EmfSink(f"unix:{path}")
+    results = sink.push(_qdb_to_cloudwatch(make_stats(n_metrics=5)), "ns")
+    sink.close()
+    t.join(timeout=5)
+    server.close()
+
+    assert len(results) == 1 and results[0].error is None
+    assert len(received) == 1
+
+
+def test_cloudwatch_sink_creates_client_in_background(monkeypatch):
+    created = threading.Event()
+
+    def get_client():
+        created.set()
+        return "client"
+
+    monkeypatch.setattr(sinks, "get_client", get_client)
+    sink = sinks.CloudWatchSink()
+
+    assert created.wait(5)
+    assert sink.client == "client"
+
+
+@pytest.fixture
+def prometheus_sink():
+    sink = PrometheusSink("127.0.0.1:0", max_age_seconds=60)
+    yield sink
+    sink.close()
+
+
+def _scrape(sink, path="/metrics"):
+    with urllib.request.urlopen(f"http://127.0.0.1:{sink.port}{path}") as response:
+        return response.headers["Content-Type"], response.read()
+
+
+def test_to_openmetrics():
+    body = to_openmetrics(
+        {
+            ("ns_latency_seconds", "seconds", (("node_id", 'a"b'),)): 0.5,
+            ("ns_count", "", ()): 3,
+        }
+    ).decode()
+
+    assert body == (
+        "# TYPE ns_count gauge\n"
+        "ns_count 3.0\n"
+        "# TYPE ns_latency_seconds gauge\n"
+        "# UNIT ns_latency_seconds seconds\n"
+        'ns_latency_seconds{node_id="a\\"b"} 0.5\n'
+        "# EOF\n"
+    )
+
+
+def test_prometheus_sink_serves_pushed_metrics(prometheus_sink):
+    metrics = [
+        {
+            "MetricName": "memory.vm.used",
+            "Value": 4096,
+            "Unit": "Bytes",
+            "Dimensions": [
+                {"Name": "UserId", "Value": "1"},
+                {"Name": "NodeId", "Value": "127.0.0.1:2836"},
+            ],
+        },
+        {
+            "MetricName": "engine.latency",
+            "Value": 1500,
+            "Unit": "Microseconds",
+            "Dimensions": [{"Name": "NodeId", "Value": "127.0.0.1:2836"}],
+        },
+    ]
+
+    results = prometheus_sink.push(metrics, "quasardb.cluster")
+    prometheus_sink.flush()
+    content_type, body = _scrape(prometheus_sink)
+
+    assert results[0].size == 2
+    assert content_type.startswith("application/openmetrics-text")
+    lines = body.decode().splitlines()
+    assert (
+        'quasardb_cluster_memory_vm_used_bytes{node_id="127.0.0.1:2836",user_id="1"} 4096.0'
+        in lines
+    )
+    assert (
+        'quasardb_cluster_engine_latency_seconds{node_id="127.0.0.1:2836"} 0.0015'
+        in lines
+    )
+    assert lines[-1] == "# EOF"
+
+
+def test_prometheus_sink_scrapes_are_cached(prometheus_sink, make_stats):
+    prometheus_sink.push(_qdb_to_cloudwatch(make_stats(10)), "ns")
+    prometheus_sink.flush()
+    body = prometheus_sink.body
+
+    for _ in range(3):
+        assert _scrape(prometheus_sink)[1] == body
+
+    # The body is rendered by flush, and only then.
+    assert prometheus_sink.body is body
+
+
+def test_prometheus_sink_renders_once_per_cycle(prometheus_sink):
+    def _metric(name):
+        return [{"MetricName": name, "Value": 1, "Unit": "Count", "Dimensions": []}]
+
+    prometheus_sink.push(_metric("x"), "ns")
+    prometheus_sink.flush()
+    prometheus_sink.push(_metric("y"), "ns")
+
+    # A scrape in the middle of a cycle sees the previous one, whole.
+    body = _scrape(prometheus_sink)[1]
+    assert b"ns_x 1.0\n" in body
+    assert b"ns_y" not in body
+
+    prometheus_sink.flush()
+    assert b"ns_y 1.0\n" in _scrape(prometheus_sink)[1]
+
+
+def test_prometheus_sink_critical_block(prometheus_sink):
+    def _metric(name, **kwargs):
+        return [
+            {
+                "MetricName": name,
+                "Value": 1,
+                "Unit": "Count",
+                "Dimensions": [],
+                **kwargs,
+            }
+        ]
+
+    prometheus_sink.push(_metric("x"), "ns")
+    prometheus_sink.flush()
+    prometheus_sink.push(_metric("y"), "ns")
+
+    # The critical loop publishes its metrics right away, without the part of the
+    # cycle pushed so far.
+    prometheus_sink.push(_metric("online", StorageResolution=1), "ns")
+    body = _scrape(prometheus_sink)[1]
+    assert b"ns_x 1.0\n" in body
+    assert b"ns_online 1.0\n" in body
+    assert b"ns_y" not in body
+    assert body.endswith(b"\nns_online 1.0\n# EOF\n")
+
+    prometheus_sink.flush()
+    body = _scrape(prometheus_sink)[1]
+    assert b"ns_y 1.0\n" in body
+    assert b"ns_online 1.0\n" in body
+
+
+def test_prometheus_sink_keeps_latest_value(prometheus_sink):
+    def _metric(value):
+        return [{"MetricName": "x", "Value": value, "Unit": "Count", "Dimensions": []}]
+
+    prometheus_sink.push(_metric(1), "ns")
+    prometheus_sink.push(_metric(2), "ns")
+    prometheus_sink.flush()
+
+    assert b"ns_x 2.0\n" in _scrape(prometheus_sink)[1]
+
+
+def test_prometheus_sink_not_found(prometheus_sink):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        _scrape(prometheus_sink, "/")
+
+    assert e.value.code == 404
+
+
+class FlakyClient:
+    def __init__(self):
+        self.up = False
+        self.requests = []
+
+    def put_metric_data(self, Namespace, MetricData):
+        if not self.up:
+            raise EndpointConnectionError(endpoint_url="https://monitoring")
+
+        self.requests.append(MetricData)
+
+
+def test_cloudwatch_sink_backfills_spooled_metrics(tmp_path, make_stats):
+    client = FlakyClient()
+    sink = sinks.CloudWatchSink(client, max_attempts=1, spool=Spool(tmp_path))
+
+    sink.push(_qdb_to_cloudwatch(make_stats(n_metrics=5)), "ns")
+    sink.flush()
+    client.up = True
+    sink.push(_qdb_to_cloudwatch(make_stats(n_metrics=2)), "ns")
+
+    # Backfilling waits for the end of the cycle.
+    assert sink._drain_future is None
+    sink.flush()
+
+    sink._drain_future.result(timeout=5)
+    sink.close()
+
+    live, backfilled = client.requests
+    assert len(live) == 2
+    assert len(backfilled) == 5
+    assert all("Timestamp" in m for m in backfilled)
+    assert sink.spool.pending_bytes() == 0
+
+
+def test_cloudwatch_sink_waits_for_a_successful_cycle(tmp_path, make_stats):
+    client = FlakyClient()
+    sink = sinks.CloudWatchSink(client, max_attempts=1, spool=Spool(tmp_path))
+
+    sink.push(_qdb_to_cloudwatch(make_stats(n_metrics=5)), "ns")
+    client.up = True
+    # E.g. the critical metrics went through, but not the rest of the cycle.
+    sink.push(_qdb_to_cloudwatch(make_stats(n_metrics=2)), "ns")
+    sink.flush()
+    assert sink._drain_future is None
+
+    sink.push(_qdb_to_cloudwatch(make_stats(n_metrics=2)), "ns")
+    sink.flush()
+    sink.close()
+
+    assert [len(x) for x in client.requests] == [2, 2, 5]
+
+
+def test_cloudwatch_sink_backfills_before_exiting(tmp_path, make_stats):
+    # One-shot mode: the run pushes once, and the sink is closed right away.
+    client = FlakyClient()
+    sink = sinks.CloudWatchSink(client, max_attempts=1, spool=Spool(tmp_path))
+    sink.push(_qdb_to_cloudwatch(make_stats(n_metrics=5)), "ns")
+    sink.flush()
+    sink.close()
+
+    client.up = True
+    sink = sinks.CloudWatchSink(client, max_attempts=1, spool=Spool(tmp_path))
+    sink.push(_qdb_to_cloudwatch(make_stats(n_metrics=2)), "ns")
+    sink.flush()
+    sink.close()
+
+    assert [len(x) for x in client.requests] == [2, 5]
+    assert sink.spool.pending_bytes() == 0
+
+
+class SlowClient(FlakyClient):
+    def put_metric_data(self, Namespace, MetricData):
+        if self.requests:
+            time.sleep(0.2)
+
+        super().put_metric_data(Namespace, MetricData)
+
+
+def test_cloudwatch_sink_drain_budget(tmp_path, make_stats):
+    now = datetime.now(timezone.utc)
+    spool = Spool(tmp_path)
+    for i in range(10):
+        spool.append("ns", [{"MetricName": "x", "Value": i, "Timestamp": now}])
+
+    client = SlowClient()
+    client.up = True
+    sink = sinks.CloudWatchSink(
+        client, max_attempts=1, spool=spool, drain_rate=100, drain_seconds=0.3
+    )
+    sink.push(_qdb_to_cloudwatch(make_stats(n_metrics=1)), "ns")
+    sink.flush()
+
+    start = time.monotonic()
+    sink.close()
+
+    assert time.monotonic() - start < 1
+    # Batches that were not sent in time are kept for the next run.
+    assert 1 < len(client.requests) < 11
+    assert spool.pending_bytes() > 0
+
+
+def test_emf_storage_resolution():
+    metrics = [
+        {
+            "MetricName": "check.online",
+            "Value": 1.0,
+            "Unit": "None",
+            "Dimensions": [{"Name": "NodeId", "Value": "n"}],
+            "StorageResolution": 1,
+        }
+    ]
+
+    ((doc, _),) = to_emf(metrics, "ns", now_ms=1000)
+
+    (directive,) = doc["_aws"]["CloudWatchMetrics"]
+    assert directive["Metrics"] == [
+        {"Name": "check.online", "Unit": "None", "StorageResolution": 1}
+    ]
@@ -0,0 +1,75 @@
+import pytest
+from conftest import _make_stats
+
+from qdb_cloudwatch.snapshot import MAGIC, Recorder, decode, encode, read_snapshots
+
+
+def test_encode_round_trip(make_stats):
+    stats = make_stats(n_metrics=5, n_uids=3)
+    stats["127.0.0.1:2836"]["cumulative"]["metric.0"]["value"] = "3.14.3"
+
+    frame = encode(12.5, stats)
+
+    assert decode(frame[4:]) == (12.5, stats)
+    # uids are not turned into strings
+    assert list(decode(frame[4:])[1]["127.0.0.1:2836"]["by_uid"]) == [0, 1, 2]
+
+
+def test_encode_without_type_and_unit(make_stats):
+    stats = make_stats(n_metrics=2)
+    stats["127.0.0.1:2836"]["cumulative"]["metric.0"]["type"] = None
+    stats["127.0.0.1:2836"]["cumulative"]["metric.1"]["unit"] = None
+
+    frame = encode(0, stats)
+
+    assert decode(frame[4:]) == (0, stats)
+
+
+def test_encode_is_compact(make_stats):
+    stats = make_stats(n_metrics=200, n_uids=10)
+
+    assert len(encode(0, stats)) < len(repr(stats)) / 10
+
+
+def test_record_and_read(tmp_path):
+    path = tmp_path / "stats.qdbsnap"
+
+    recorder = Recorder(path)
+    recorder.write(_make_stats(n_metrics=1), timestamp=1.0)
+    recorder.close()
+
+    # Appends to an existing file
+    recorder = Recorder(path)
+    recorder.write(_make_stats(n_metrics=2), timestamp=2.0)
+    recorder.close()
+
+    assert list(read_snapshots(path)) == [
+        (1.0, _make_stats(n_metrics=1)),
+        (2.0, _make_stats(n_metrics=2)),
+    ]
+
+
+def test_read_ignores_truncated_frame(tmp_path):
+    path = tmp_path / "stats.qdbsnap"
+
+    recorder = Recorder(path)
+    recorder.write(_make_stats(n_metrics=1), timestamp=1.0)
+    recorder.write(_make_stats(n_metrics=1), timestamp=2.0)
+    recorder.close()
+
+    path.write_bytes(path.read_bytes()[:-3])
+
+    assert [t for (t, _) in read_snapshots(path)] == [1.0]
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "stats.json"
+    path.write_bytes(b"{}")
+
+    with pytest.raises(ValueError):
+        list(read_snapshots(path))
+
+    with pytest.raises(ValueError):
+        Recorder(path)
+
+    assert MAGIC not in path.read_bytes()
@@ -0,0 +1,108 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from qdb_cloudwatch.spool import Spool
+
+
+def _batch(i, age=timedelta(minutes=5)):
+    ts = datetime.now(timezone.utc) - age
+    return [{"MetricName": f"metric.{i}", "Value": float(i), "Timestamp": ts}]
+
+
+def _drain(spool, fail_on=None, stop=None):
+    sent = []
+
+    def _send(namespace, metrics):
+        if metrics[0]["MetricName"] == fail_on:
+            raise RuntimeError("unreachable")
+
+        sent.append((namespace, metrics))
+
+    spool.drain(_send, stop)
+    return sent
+
+
+def test_drain_keeps_timestamps(tmp_path):
+    spool = Spool(tmp_path)
+    batch = _batch(0)
+
+    spool.append("ns", batch)
+
+    assert _drain(spool) == [("ns", batch)]
+    assert spool.pending_bytes() == 0
+    assert _drain(spool) == []
+
+
+def test_drain_is_oldest_first_across_segments(tmp_path):
+    spool = Spool(tmp_path, segment_bytes=1)
+
+    for i in range(5):
+        spool.append("ns", _batch(i))
+
+    assert len(list(tmp_path.iterdir())) == 5
+    names = [metrics[0]["MetricName"] for (_, metrics) in _drain(spool)]
+    assert names == [f"metric.{i}" for i in range(5)]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_evicts_oldest_segments(tmp_path):
+    spool = Spool(tmp_path, segment_bytes=1)
+    spool.append("ns", _batch(0))
+    size = spool.pending_bytes()
+
+    # Room for 3 batches, whose size varies with their timestamp.
+    spool.max_bytes = 3 * size + size // 2
+    for i in range(1, 6):
+        spool.append("ns", _batch(i))
+
+    assert spool.pending_bytes() <= spool.max_bytes
+    names = [metrics[0]["MetricName"] for (_, metrics) in _drain(spool)]
+    assert names == ["metric.3", "metric.4", "metric.5"]
+
+
+def test_failed_drain_keeps_remaining_batches(tmp_path):
+    spool = Spool(tmp_path)
+    for i in range(3):
+        spool.append("ns", _batch(i))
+
+    with pytest.raises(RuntimeError):
+        _drain(spool, fail_on="metric.1")
+
+    # Appends during the outage go to a new segment, after the remaining ones.
+    spool.append("ns", _batch(3))
+
+    names = [metrics[0]["MetricName"] for (_, metrics) in _drain(spool)]
+    assert names == ["metric.1", "metric.2", "metric.3"]
+
+
+def test_drain_stops(tmp_path):
+    spool = Spool(tmp_path)
+    spool.append("ns", _batch(0))
+
+    stop = threading.Event()
+    stop.set()
+
+    assert _drain(spool, stop=stop) == []
+    assert spool.pending_bytes() > 0
+
+
+def test_drain_drops_expired_metrics(tmp_path):
+    spool = Spool(tmp_path)
+    spool.append("ns", _batch(0, age=timedelta(days=15)))
+    spool.append("ns", _batch(1))
+
+    names = [metrics[0]["MetricName"] for (_, metrics) in _drain(spool)]
+    assert names == ["metric.1"]
+
+
+def test_reopens_existing_spool(tmp_path):
+    Spool(tmp_path).append("ns", _batch(0))
+    (tmp_path / "segment-000000000001.jsonl").open("a").write('{"namespace"')
+
+    spool = Spool(tmp_path)
+    spool.append("ns", _batch(1))
+
+    names = [metrics[0]["MetricName"] for (_, metrics) in _drain(spool)]
+    assert names == ["metric.0", "metric.1"]
@@ -0,0 +1,47 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# Time budget of importing the driver and parsing arguments, i.e. everything that
+# happens before the first stats are collected. This is about 0.2s on a laptop, the
+# budget leaves room for slow CI machines but not for importing boto3 eagerly again.
+STARTUP_BUDGET_SECONDS = 1.0
+
+_script = """
+import json, sys, time
+start = time.perf_counter()
+from qdb_cloudwatch import driver
+driver._get_sink(driver.get_args(json.loads(sys.argv[1])))
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+_emf = ["--sink", "emf", "--emf-output", "/dev/null"]
+
+
+def _startup(argv=_emf):
+    out = subprocess.run(
+        [sys.executable, "-c", _script, json.dumps(argv)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(out)
+
+
+def test_startup_does_not_import_boto3():
+    modules = _startup()["modules"]
+
+    assert "boto3" not in modules
+    assert "botocore" not in modules
+
+
+# The CloudWatch sink creates its client in the background, it must not delay the
+# startup either.
+@pytest.mark.parametrize("argv", [_emf, []], ids=["emf", "cloudwatch"])
+def test_startup_time_budget(argv):
+    elapsed = min(_startup(argv)["elapsed"] for _ in range(3))
+
+    assert elapsed < STARTUP_BUDGET_SECONDS
@@ -0,0 +1,77 @@
+import pytest
+
+from qdb_cloudwatch.suppress import Suppressor
+
+
+def _metric(value, name="metric.0", uid="1"):
+    return {
+        "MetricName": name,
+        "Value": value,
+        "Unit": "Count",
+        "Dimensions": [{"Name": "UserId", "Value": uid}],
+    }
+
+
+def _cycle(suppressor, metrics):
+    ret = suppressor.select(metrics)
+    suppressor.record(ret)
+    return ret
+
+
+def test_suppress_unchanged_with_heartbeat():
+    s = Suppressor(heartbeat=3)
+
+    sent = [len(_cycle(s, [_metric(1.0)])) for _ in range(7)]
+
+    assert sent == [1, 0, 0, 1, 0, 0, 1]
+
+
+def test_suppress_sends_changes():
+    s = Suppressor(heartbeat=100)
+
+    assert _cycle(s, [_metric(1.0)])
+    assert not _cycle(s, [_metric(1.0)])
+    assert _cycle(s, [_metric(2.0)])
+
+
+def test_suppress_tolerance_compares_with_last_sent_value():
+    s = Suppressor(tolerance=0.1, heartbeat=100)
+
+    assert _cycle(s, [_metric(100.0)])
+    assert not _cycle(s, [_metric(105.0)])
+    assert not _cycle(s, [_metric(109.0)])
+    # Slow drift is eventually sent, as we compare with 100 rather than 109
+    assert _cycle(s, [_metric(111.0)])
+
+
+def test_suppress_keys_include_dimensions():
+    s = Suppressor(heartbeat=100)
+
+    assert _cycle(s, [_metric(1.0, uid="1")])
+    assert _cycle(s, [_metric(1.0, uid="1"), _metric(1.0, uid="2")]) == [
+        _metric(1.0, uid="2")
+    ]
+
+
+def test_suppress_resends_unrecorded_metrics():
+    s = Suppressor(heartbeat=100)
+
+    # The push failed, nothing gets recorded
+    assert s.select([_metric(1.0)])
+    assert s.select([_metric(1.0)])
+
+
+def test_suppress_state_roundtrip(tmp_path):
+    path = str(tmp_path / "suppression.json.gz")
+
+    s = Suppressor(heartbeat=100)
+    _cycle(s, [_metric(1.0)])
+    s.save(path)
+
+    s_ = Suppressor(heartbeat=100)
+    s_.load(path)
+    assert not _cycle(s_, [_metric(1.0)])
+
+    s_ = Suppressor(heartbeat=100)
+    s_.load(str(tmp_path / "missing.json.gz"))
+    assert _cycle(s_, [_metric(1.0)])
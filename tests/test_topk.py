@@ -0,0 +1,107 @@
+import pytest
+import quasardb.stats as qdbst
+
+from qdb_cloudwatch.cloudwatch import _qdb_to_cloudwatch
+from qdb_cloudwatch.topk import OTHER_USER_ID, TopUsers
+
+
+def _counter(value):
+    return {"value": value, "type": qdbst.Type.ACCUMULATOR, "unit": qdbst.Unit.COUNT}
+
+
+def _stats(requests, node_id="n0"):
+    """
+    Stats of a node whose users have made `requests[uid]` requests so far.
+    """
+    return {
+        node_id: {
+            "cumulative": {"requests.total_count": _counter(sum(requests.values()))},
+            "by_uid": {
+                uid: {
+                    "requests.total_count": _counter(n),
+                    "memory.bytes": {
+                        "value": 10,
+                        "type": qdbst.Type.GAUGE,
+                        "unit": qdbst.Unit.BYTES,
+                    },
+                    "user.name": {
+                        "value": f"user{uid}",
+                        "type": qdbst.Type.LABEL,
+                        "unit": qdbst.Unit.NONE,
+                    },
+                }
+                for uid, n in requests.items()
+            },
+        }
+    }
+
+
+def test_top_users_rollup():
+    top_users = TopUsers(2)
+    stats = top_users(_stats({0: 5, 1: 100, 2: 50, 3: 1}))
+
+    by_uid = stats["n0"]["by_uid"]
+    assert set(by_uid) == {1, 2, OTHER_USER_ID}
+
+    other = by_uid[OTHER_USER_ID]
+    assert other["requests.total_count"]["value"] == 6
+    assert other["memory.bytes"]["value"] == 20
+    assert other["memory.bytes"]["unit"] == qdbst.Unit.BYTES
+    assert "user.name" not in other
+
+    # Cumulative stats are left untouched.
+    assert stats["n0"]["cumulative"]["requests.total_count"]["value"] == 156
+
+
+def test_top_users_does_not_modify_input():
+    stats = _stats({0: 5, 1: 100, 2: 50})
+    TopUsers(1)(stats)
+
+    assert set(stats["n0"]["by_uid"]) == {0, 1, 2}
+    assert stats["n0"]["by_uid"][0]["memory.bytes"]["value"] == 10
+
+
+def test_top_users_ranks_counters_by_increase():
+    top_users = TopUsers(1)
+
+    top_users(_stats({0: 1000, 1: 10}))
+    assert top_users.rank(_stats({0: 1000, 1: 20})) == {"n0": {1}}
+
+
+def test_top_users_no_rollup_when_few_users():
+    stats = TopUsers(10)(_stats({0: 1, 1: 2}))
+
+    assert set(stats["n0"]["by_uid"]) == {0, 1}
+
+
+def test_top_users_missing_rank_metric_ranks_last():
+    stats = _stats({0: 1, 1: 2})
+    del stats["n0"]["by_uid"][1]["requests.total_count"]
+
+    assert TopUsers(1).rank(stats) == {"n0": {0}}
+
+
+def test_top_users_dimension():
+    metrics = _qdb_to_cloudwatch(TopUsers(1)(_stats({0: 1, 1: 2, 2: 3})))
+    users = {
+        d["Value"] for m in metrics for d in m["Dimensions"] if d["Name"] == "UserId"
+    }
+
+    assert users == {"2", OTHER_USER_ID}
+
+
+def test_top_users_state(tmp_path):
+    path = str(tmp_path / "top_users.json.gz")
+
+    top_users = TopUsers(1)
+    top_users.rank(_stats({0: 1000, 1: 10}))
+    top_users.save(path)
+
+    top_users = TopUsers(1)
+    top_users.load(path)
+    assert top_users.rank(_stats({0: 1000, 1: 20})) == {"n0": {1}}
+
+
+def test_top_users_invalid():
+    with pytest.raises(ValueError):
+        TopUsers(0)